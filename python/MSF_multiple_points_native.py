@@ -0,0 +1,610 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+
+"""
+Native counterpart of MSF_multiple_points.py: same inputs, outputs and
+folder layout, computed with msf_engine (NumPy/Numba) instead of ArcPy.
+"""
+# Name: MSF_multiple_points_native.py
+# Description: Runs the MSF model separately for each source point and
+#              combines the results retaining the maximum potential impact
+#              (pqlim) value in any overlapping runout areas.
+#              **Does not require ArcGIS: needs NumPy, rasterio and fiona
+#              (Numba recommended).**
+
+# %% Import system modules
+import os
+import json
+
+import numpy as np
+
+import msf_cache
+import msf_engine
+import msf_ensemble
+import msf_footprints
+import msf_graph
+import msf_index
+import msf_io
+import msf_journal
+import msf_parallel
+import msf_profile
+import msf_pyramid
+import msf_sweep
+import msf_tiled
+import msf_update
+
+# ---------------------------------------------------------------------------
+# Configuration - SET YOUR PATHS AND PARAMETERS HERE
+# ---------------------------------------------------------------------------
+
+# Set the analysis resolution (e.g., "3m", "5m", "10m") - Ensure DEM matches!
+res = "3m"
+print("Analysis resolution is " + res)
+
+# Define Base Workspace and Output Folders - *** MODIFY THESE PATHS ***
+base_path = "C:/test/simulazioni/" + res + "/"
+msfdir = os.path.join(base_path, "MSF") # Folder to store single MSF results
+rasteralldir = os.path.join(base_path, "raster_source_all") # Combined source raster
+pqlimalldir = os.path.join(base_path, "pq_lim_all") # Final combined pq_lim output
+# Cache of DTM-derived grids (fdir, fdir_deg, DTM statistics), shared by all resolutions
+cachedir = "C:/test/simulazioni/cache" # None disables the cache
+cache_max_gb = 20 # Least recently used entries are removed above this size
+# Per-source pq_lim footprints kept in cachedir/footprints: a rerun only computes
+# new or changed sources ("per_source", "parallel" and "pyramid" modes; otherwise
+# they are kept in msfdir/footprints)
+use_result_cache = True
+results_max_gb = 20 # Clean up with pulisci_files_msf.py
+# Run journal in msfdir/run_journal.json ("per_source", "parallel", "pyramid" and "multi_source"
+# modes): a restarted run skips the sources already done and retries the failed ones
+max_attempts = 3 # Runs of a failing source before it is given up (delete the journal to retry them)
+retry_backoff_s = 30 # Wait before retrying a failed source, doubled at every attempt
+checkpoint_interval_s = 60 # Minimum time between two writes of the journal (and running maximum)
+# Incremental update ("per_source" and "parallel" modes, needs cachedir): when the DTM changed
+# only locally since the last run (a landslide, dredging, a check dam, ...), flow direction is
+# computed again around the changes only, only the sources whose propagation can reach a changed
+# cell run again and the combined rasters are patched in place
+incremental_update = True
+build_source_index = True # "Which sources reach this location" index in pq_lim_all/source_index (see msf_index.py)
+
+# Input Shapefile containing source points - *** MODIFY THIS PATH ***
+shp = "C:/test/simulazioni/shape/PuntiInizioDF.shp"
+# Required fields in shapefile: 'Id' (Unique Integer ID), 'Source' (Short Integer, typically 1)
+# A GeoPackage (layer name in shp_layer, None = first layer) or a .csv file with
+# X, Y, Id and Source columns can be used as well
+shp_layer = None
+
+# Input Digital Elevation Model (DEM) - *** MODIFY THIS PATH ***
+DTM = os.path.join(base_path, "dtm_fill.tif") # Assumes DEM is filled
+
+# Model Parameters
+H_L_threshold = "0.19" # Threshold for H/L ratio (mobility) - adjust as needed
+hf_li = msf_engine.HfForward(1.0, 1.0) # Path Distance Allocation (1)
+hf_fri = msf_engine.HfLinear(0.5, 90, 0.011111) # Path Distance Allocation (2)
+vf = msf_engine.VfBinary(1.0, -30, 30)
+use_vertical_raster = False # True uses the DTM as vertical raster (the ArcPy scripts pass "")
+bounded = True # Stop each source where no cell can pass the H/L threshold (same pq_lim, much faster)
+# Run the sources on propagation graphs of the DTM (neighbours, horizontal factor costs,
+# vertical mask) built once and kept in cachedir ("per_source", "parallel", "sweep" and
+# "ensemble" without DTM error)
+use_graph = True
+save_intermediates = False # Debug: save start_z, li, fri, hi, h_l, ... of every source in msfdir
+
+# Run mode:
+# "per_source"   - one MSF run per point, single rasters saved in msfdir (as MSF_multiple_points.py)
+# "multi_source" - all sources of ras_src_all.tif propagated together, only the combined max is saved
+# "parallel"     - one MSF run per point on a pool of worker processes, only pq_lim saved per point
+# "tiled"        - one MSF run per point, tile by tile, for DTMs that do not fit in memory
+# "sweep"        - calibration: combined max for every sweep threshold and factor setting below
+# "ensemble"     - Monte Carlo: exceedance probability and percentile pq_lim rasters under DTM
+#                  error and sampled H_L_threshold / hf_fri (settings below)
+# "pyramid"      - one MSF run per point, first on the DTM coarsened pyramid_factor times, then at
+#                  full resolution only inside the coarse footprint plus pyramid_buffer_m
+run_mode = "per_source"
+batch_size = 1024 # Sources per labelled pass in "multi_source" mode (bounds memory)
+n_workers = None # Worker processes in "parallel" mode (None = all cores)
+tile_size = 1024 # Tile side in cells in "tiled" mode
+memory_mb = 2048 # Memory budget for the tiles kept in memory in "tiled" mode
+# "sweep" mode: li/fri are propagated once per source and shared by all thresholds,
+# and by all the settings with the same li (or fri) factors
+sweep_thresholds = ["0.15", "0.17", "0.19", "0.21", "0.23"]
+sweep_hf_li = [hf_li]
+sweep_hf_fri = [hf_fri] # e.g. [msf_engine.HfLinear(0.5, 90, s) for s in (0.008, 0.011111, 0.014)]
+sweep_vf = [vf]
+# "ensemble" mode: members = DTM realizations x hf_fri samples x H_L_threshold samples; the
+# members of one DTM realization run together (one flow direction, li once per source)
+ensemble_n_dtm = 10 # DTM realizations: DTM + correlated Gaussian error field, filled again
+ensemble_dtm_sd = 0.5 # DTM error standard deviation (m), 0 = no DTM error (one realization)
+ensemble_dtm_corr = 30.0 # DTM error correlation length (m)
+ensemble_h_l = (0.15, 0.23) # H_L_threshold range (uniform, stratified samples)
+ensemble_n_h_l = 5
+ensemble_hf_fri_param = "slope" # Parameter of hf_fri sampled in ensemble_hf_fri_range
+ensemble_hf_fri_range = (0.008, 0.014)
+ensemble_n_hf = 3
+ensemble_levels = [0.0, 1.5] # P(pq_lim >= level) rasters (0 = probability of being reached)
+ensemble_percentiles = [5, 50, 95] # pq_lim percentile rasters
+ensemble_bins = 64 # pq_lim histogram bins per reached cell for the percentiles (memory: 2 bytes each)
+ensemble_max_rasters = None # Member rasters computed together (None: one hf_fri sample at a time;
+                            # more shares the li passes between the hf_fri samples)
+ensemble_seed = 0
+# "pyramid" mode: the fine run of a source only explores its search region; when its fronts
+# reach the edge of the region so that pq_lim could differ, the region is grown and the source
+# run again (the output equals "per_source"; check with pyramid_validate)
+pyramid_factor = 3 # Coarsening factor (3 m DTM -> 9 m coarse DTM)
+pyramid_buffer_m = 30.0 # Safety buffer around the coarse footprint (m)
+pyramid_h_l_scale = 0.9 # Coarse runs use H_L_threshold * pyramid_h_l_scale (< 1: wider footprints)
+pyramid_max_grow = 2 # Times a search region is grown (buffer doubled) before running without region
+pyramid_validate = False # Also run every source at full resolution and report the differences
+
+# Run report: wall/CPU time per stage and per source, cells visited, cache hit rates,
+# peak memory and I/O, saved as pq_lim_all/run_report.json
+write_run_report = True
+# Outputs: tiled GeoTIFFs compressed with output_compress ("deflate", "zstd" where GDAL
+# supports it, "lzw" or "none"); tiles holding only NoData are not written. They are
+# written on a background thread, with at most write_queue rasters waiting
+async_writes = True # False writes in place (blocking the computation)
+write_queue = 4
+output_compress = "deflate"
+output_overviews = True # Overviews of the combined rasters (faster display)
+profile_hooks = [] # External profilers, e.g. [msf_profile.CProfileHook(os.path.join(pqlimalldir, "run.prof"))]
+
+# ---------------------------------------------------------------------------
+# Setup: Create directories if they don't exist
+# ---------------------------------------------------------------------------
+for d in [msfdir, rasteralldir, pqlimalldir]:
+    if not os.path.exists(d):
+        os.makedirs(d)
+        print("Created directory: " + d)
+
+prof = msf_profile.RunProfiler(profile_hooks)
+writer = msf_io.AsyncWriter(write_queue, async_writes, output_compress)
+outputs = []  # recorded in the run report once written
+
+# ---------------------------------------------------------------------------
+# Part 1: Read the source points
+# ---------------------------------------------------------------------------
+print("Reading input features...")
+with prof.stage("read_points"):
+    pt_x, pt_y, pt_id, pt_source = msf_io.read_source_points(shp, layer=shp_layer)
+print("Read {} source points.".format(pt_id.size))
+
+# ---------------------------------------------------------------------------
+# Part 2: Prepare Global Rasters
+# ---------------------------------------------------------------------------
+print("Preparing global rasters...")
+cache = msf_cache.GridCache(cachedir, cache_max_gb * 1024 ** 3) if cachedir else None
+state_path = os.path.join(pqlimalldir, "run_state.json")  # DTM and sources of the last run
+old_grids = None  # grids of the DTM of the last run, for an incremental update
+with prof.stage("dtm_grids"):  # reading the DTM and flow direction, or the cached grids
+    if run_mode == "tiled":
+        grids = msf_tiled.tiled_grids(DTM, cache, tile_size=tile_size)
+    elif incremental_update and cache is not None and run_mode in ("per_source", "parallel"):
+        grids, old_grids = msf_update.dtm_grids_update(DTM, msf_update.read_state(state_path), cache,
+                                                       tile_size)
+    else:
+        grids = msf_cache.dtm_grids(DTM, cache)
+dtm, profile, cellSize, z_min = grids.dtm, grids.profile, grids.cellsize, grids.z_min
+fdir, fdir_deg = grids.fdir, grids.fdir_deg
+print("Processing cell size = " + str(cellSize))
+vertical = dtm if use_vertical_raster else None
+
+with prof.stage("rasterize"):
+    # Source cells (fid, row, col, value) of all points in one step on the DTM grid
+    pt_row, pt_col = msf_io.xy_to_cells(pt_x, pt_y, profile)
+    keep = ((pt_row >= 0) & (pt_row < dtm.shape[0]) & (pt_col >= 0) & (pt_col < dtm.shape[1]) &
+            (pt_source > 0))
+    for fid in pt_id[~keep]:
+        print("  Warning: source outside the DTM or not positive, skipped: Id_" + str(fid))
+    sources = list(zip(pt_id[keep].tolist(), pt_row[keep].tolist(), pt_col[keep].tolist(),
+                       pt_source[keep].tolist()))
+    # Combined source cells (MOST_FREQUENT value per cell)
+    src_cells = msf_engine.most_frequent(pt_row[keep], pt_col[keep], pt_source[keep])
+    raster_src_all_path = os.path.join(rasteralldir, "ras_src_all.tif")
+    print("Creating combined source raster: " + raster_src_all_path)
+    if run_mode == "tiled":
+        writer.write_raster_blocks(raster_src_all_path, profile,
+                                   list(msf_io.cell_blocks(src_cells[0], src_cells[1], src_cells[2], dtm.shape)))
+    else:
+        ras_src_all = np.full(dtm.shape, np.nan)
+        ras_src_all[src_cells[0], src_cells[1]] = src_cells[2]
+        writer.write_raster(raster_src_all_path, ras_src_all, profile)
+outputs.append(raster_src_all_path)
+
+if save_intermediates:
+    layout = msf_tiled.TileLayout(dtm.shape[0], dtm.shape[1], tile_size)
+    writer.write_raster_blocks(os.path.join(msfdir, "fdir.tif"), profile, layout.blocks(fdir),
+                               dtype="int16", nodata=0)
+    writer.write_raster_blocks(os.path.join(msfdir, "fdir_deg.tif"), profile, layout.blocks(fdir_deg))
+print("Finished global rasters.")
+
+# ---------------------------------------------------------------------------
+# Part 3: Process the source points
+# ---------------------------------------------------------------------------
+n_done = 0
+
+# Sparse per-source footprints ("per_source", "parallel" and "pyramid" modes), kept
+# in the result cache or in msfdir/footprints; sources found there are not run again
+results = None
+keys = {}
+all_sources = sources
+journal = None
+if run_mode in ("per_source", "parallel", "pyramid"):
+    for fid, row, col, source in sources:
+        keys[fid] = msf_cache.source_key(grids.key, row, col, source, float(H_L_threshold),
+                                         hf_li, hf_fri, vf, use_vertical_raster)
+    if use_result_cache and cache is not None:
+        results = msf_cache.FootprintCache(os.path.join(cachedir, "footprints"), results_max_gb * 1024 ** 3)
+    else:
+        results = msf_cache.FootprintCache(os.path.join(msfdir, "footprints"))
+    results.keep = set(keys.values())  # never pruned while this run stores new footprints
+    if old_grids is not None:
+        # Footprints the DTM change cannot affect are kept under their new keys
+        old_keys = dict((fid, msf_cache.source_key(old_grids.key, row, col, source, float(H_L_threshold),
+                                                   hf_li, hf_fri, vf, use_vertical_raster))
+                        for fid, row, col, source in sources)
+        results.keep.update(old_keys.values())  # read by carry_over
+        with prof.stage("update_plan"):
+            changed = msf_update.changed_cells(old_grids, grids, tile_size)
+            affected, patch_window = msf_update.carry_over(grids, sources, changed, results, old_keys, keys,
+                                                           float(H_L_threshold), hf_li, hf_fri, vf,
+                                                           use_vertical_raster)
+        print("\nDTM changed in {} cells (elevation or flow direction): {} source points affected".format(
+            changed.size, len(affected)))
+        prof.count("changed_cells", changed.size)
+        # the combined rasters of the last run are patched if they hold the same sources
+        patch_paths = [os.path.join(pqlimalldir, name + ".tif") for name in
+                       ("pq_lim_combined_max", "pq_lim_source_id", "pq_lim_overlap_count")]
+        state = msf_update.read_state(state_path)
+        if not (state and state.get("sources") == msf_update.sources_key(old_keys) and
+                all(os.path.exists(path) for path in patch_paths)):
+            patch_paths = None
+    sources = [s for s in sources if not results.has(keys[s[0]])]
+    prof.count("sources_reused", len(all_sources) - len(sources))
+    print("\n{} source points already done, {} to run.".format(len(all_sources) - len(sources), len(sources)))
+    journal = msf_journal.RunJournal(os.path.join(msfdir, "run_journal.json"),
+                                     msf_journal.run_key(run_mode, sorted(keys.values())),
+                                     max_attempts, retry_backoff_s, checkpoint_interval_s)
+elif run_mode == "multi_source":
+    journal = msf_journal.RunJournal(os.path.join(msfdir, "run_journal.json"),
+                                     msf_journal.run_key(run_mode, grids.key, [a.tolist() for a in src_cells],
+                                                         H_L_threshold, hf_li, hf_fri, vf,
+                                                         use_vertical_raster, batch_size, bounded),
+                                     max_attempts, retry_backoff_s, checkpoint_interval_s)
+
+
+def sources_to_retry(pending):
+    """Failed sources of pending that can run again, once their backoff is over."""
+    retry = set(journal.retry([keys[s[0]] for s in pending]))
+    return [s for s in pending if keys[s[0]] in retry]
+
+
+# Precomputed propagation graphs (not with save_intermediates: only pq_lim is computed)
+graphs = None
+runner = None
+if use_graph and not save_intermediates and run_mode in ("per_source", "parallel", "sweep"):
+    with prof.stage("graph_build"):
+        if run_mode == "sweep":
+            # one graph per horizontal factor (and vertical factor with the vertical raster)
+            graphs = {}
+            for hf in list(sweep_hf_li) + list(sweep_hf_fri):
+                for v in sweep_vf:
+                    vk = v if use_vertical_raster else None
+                    if (hf, vk) not in graphs:
+                        graphs[(hf, vk)] = msf_graph.graph_for(grids, hf, v, use_vertical_raster, cache)
+        else:
+            graphs = (msf_graph.graph_for(grids, hf_li, vf, use_vertical_raster, cache),
+                      msf_graph.graph_for(grids, hf_fri, vf, use_vertical_raster, cache))
+            runner = msf_graph.GraphRunner(dtm, *graphs)
+
+if run_mode == "multi_source":
+    # All sources in labelled passes, one source per cell of ras_src_all
+    print("\nStarting multi-source processing of " + raster_src_all_path)
+    resume = journal.checkpoint()
+    if resume is not None:
+        print("Resuming after {} of {} source cells".format(resume[0], src_cells[0].size))
+
+    def save_checkpoint(n, pq):
+        journal.set_checkpoint(n, pq)
+        journal.save()
+
+    pq_max = msf_engine.run_msf_multi(dtm, src_cells, fdir_deg, cellSize, float(H_L_threshold),
+                                      hf_li, hf_fri, vf, vertical, batch_size, bounded, z_min,
+                                      checkpoint=save_checkpoint, resume=resume, profiler=prof)
+    n_done = src_cells[0].size
+    print("Processed {} source cells.".format(n_done))
+elif run_mode == "parallel":
+    print("\nStarting parallel processing of {} source points...".format(len(sources)))
+    # the combined maximum is rebuilt from the footprints below
+    todo = [s for s in sources if journal.attempts(keys[s[0]]) == 0]
+    while todo:
+        with prof.stage("parallel_runs"):
+            _, failed = msf_parallel.run_parallel(dtm, fdir_deg, cellSize, todo, float(H_L_threshold),
+                                                  hf_li, hf_fri, vf, use_vertical_raster, n_workers,
+                                                  outdir=msfdir if save_intermediates else None,
+                                                  profile=profile, bounded=bounded, z_min=z_min,
+                                                  results=results, keys=keys, graphs=graphs,
+                                                  profiler=prof)
+        failed = dict(failed)
+        for fid, row, col, source in todo:
+            if fid in failed:
+                print("  ERROR processing Id_{}: {}".format(fid, failed[fid]))
+                journal.fail(keys[fid], fid, failed[fid])
+            else:
+                journal.done(keys[fid], fid)
+        todo = sources_to_retry(sources)
+elif run_mode == "sweep":
+    print("\nStarting parameter sweep of {} source points...".format(len(sources)))
+    cases = msf_sweep.sweep_cases(sweep_hf_li, sweep_hf_fri, sweep_vf)
+    with prof.stage("sweep_runs"):
+        pq_sweep, h_l_crit = msf_sweep.run_sweep(dtm, fdir_deg, cellSize, sources, sweep_thresholds, cases,
+                                                 vertical, bounded, z_min, graphs=graphs)
+    sweepdir = os.path.join(pqlimalldir, "sweep")
+    if not os.path.exists(sweepdir):
+        os.makedirs(sweepdir)
+    print("Saving sweep rasters in " + sweepdir)
+    with prof.stage("write_outputs"):
+        for i, case in enumerate(cases):
+            for j, thr in enumerate(sweep_thresholds):
+                path = os.path.join(sweepdir, "pq_lim_max_case{}_HL{}.tif".format(i, thr))
+                writer.write_raster(path, pq_sweep[i][j], profile)
+                outputs.append(path)
+            path = os.path.join(sweepdir, "h_l_crit_case{}.tif".format(i))
+            writer.write_raster(path, h_l_crit[i], profile)
+            outputs.append(path)
+    with open(os.path.join(sweepdir, "sweep_cases.json"), "w") as f:
+        json.dump(dict(thresholds=sweep_thresholds,
+                       cases=[dict((name, [type(v).__name__] + list(v)) for name, v in case._asdict().items())
+                              for case in cases]), f, indent=2)
+    n_done = len(sources)
+    pq_max = None
+elif run_mode == "ensemble":
+    rng = np.random.default_rng(ensemble_seed)
+    ens_thresholds = msf_ensemble.stratified(ensemble_h_l[0], ensemble_h_l[1], ensemble_n_h_l, rng)
+    ens_hf_fri = [hf_fri._replace(**{ensemble_hf_fri_param: v})
+                  for v in msf_ensemble.stratified(ensemble_hf_fri_range[0], ensemble_hf_fri_range[1],
+                                                   ensemble_n_hf, rng)]
+    if use_graph and not ensemble_dtm_sd > 0:
+        vk = vf if use_vertical_raster else None
+        with prof.stage("graph_build"):
+            graphs = dict(((hf, vk), msf_graph.graph_for(grids, hf, vf, use_vertical_raster, cache))
+                          for hf in [hf_li] + ens_hf_fri)
+    print("\nStarting ensemble of {} source points ({} members)...".format(
+        len(sources), (ensemble_n_dtm if ensemble_dtm_sd > 0 else 1) * len(ens_thresholds) * len(ens_hf_fri)))
+    with prof.stage("ensemble_runs"):
+        ens, members = msf_ensemble.run_ensemble(grids, sources, ens_thresholds, ens_hf_fri, ensemble_n_dtm,
+                                                 ensemble_dtm_sd, ensemble_dtm_corr, hf_li, vf,
+                                                 use_vertical_raster, bounded, ensemble_levels,
+                                                 ensemble_bins, ensemble_seed, graphs, ensemble_max_rasters)
+    ensdir = os.path.join(pqlimalldir, "ensemble")
+    if not os.path.exists(ensdir):
+        os.makedirs(ensdir)
+    print("Saving ensemble rasters in " + ensdir)
+    with prof.stage("write_outputs"):
+        for k, level in enumerate(ensemble_levels):
+            path = os.path.join(ensdir, "pq_lim_exceed_{}.tif".format(level))
+            writer.write_raster(path, np.where(np.isnan(dtm), np.nan, ens.exceedance(k)), profile,
+                                overviews=output_overviews)
+            outputs.append(path)
+        for q in ensemble_percentiles:
+            path = os.path.join(ensdir, "pq_lim_p{}.tif".format(q))
+            writer.write_raster(path, ens.percentile(q), profile, overviews=output_overviews)
+            outputs.append(path)
+    with open(os.path.join(ensdir, "ensemble_members.json"), "w") as f:
+        json.dump(dict(n_members=len(members), dtm_sd=ensemble_dtm_sd, dtm_corr=ensemble_dtm_corr,
+                       seed=ensemble_seed, levels=ensemble_levels, percentiles=ensemble_percentiles,
+                       members=[dict(realization=m.realization, H_L_threshold=m.h_l_threshold,
+                                     hf_fri=[type(m.hf_fri).__name__] + list(m.hf_fri)) for m in members]),
+                  f, indent=1)
+    n_done = len(sources)
+    pq_max = None
+elif run_mode == "pyramid":
+    print("\nStarting coarse-to-fine processing of {} source points...".format(len(sources)))
+    with prof.stage("coarse_grids"):
+        pyramid = msf_pyramid.PyramidRunner(grids, pyramid_factor, pyramid_buffer_m, pyramid_h_l_scale,
+                                            hf_li, hf_fri, vf, use_vertical_raster, cache,
+                                            max_grow=pyramid_max_grow)
+    # the footprints are stored like the ones of "per_source" (same keys: the
+    # fine runs equal the unrestricted ones) and combined below
+    validation = {}
+    todo = [s for s in sources if journal.attempts(keys[s[0]]) == 0]
+    while todo:
+        for fid, row, col, source in todo:
+            fc_basename = "Id_" + str(fid)
+            try:
+                print("\nProcessing source: " + fc_basename)
+                with prof.source(fid):
+                    fp, region = pyramid.footprint(row, col, source, float(H_L_threshold), prof)
+                    if region is not None:
+                        prof.count("region_cells", int(region[1].sum()))
+                    if pyramid_validate:
+                        with prof.stage("validate"):
+                            v = pyramid.validate(row, col, source, float(H_L_threshold), fp, region)
+                        validation[fid] = dict(id=fid, **v._asdict())
+                        if v.leaked or v.differ:
+                            print("  Warning: {} cells outside the search region, {} cells differ "
+                                  "(max {:.4g})".format(v.leaked, v.differ, v.max_abs_diff))
+                    with prof.stage("store"):
+                        results.store(keys[fid], fp, dtm.shape)
+                journal.done(keys[fid], fid)
+                n_done += 1
+                print("  Finished processing for " + fc_basename)
+            except Exception as e:
+                print("  UNEXPECTED ERROR processing {}: {}".format(fc_basename, e))
+                journal.fail(keys[fid], fid, e)
+            journal.save()
+        todo = sources_to_retry(sources)
+    if pyramid_validate:
+        path = os.path.join(pqlimalldir, "pyramid_validation.json")
+        n_bad = sum(1 for v in validation.values() if v["leaked"] or v["differ"])
+        print("\nPyramid validation: {} of {} sources differ from the full resolution run ({})".format(
+            n_bad, len(validation), path))
+        with open(path, "w") as f:
+            json.dump(dict(factor=pyramid_factor, buffer_m=pyramid_buffer_m, h_l_scale=pyramid_h_l_scale,
+                           n_differ=n_bad, sources=list(validation.values())), f, indent=1)
+elif run_mode == "tiled":
+    print("\nStarting tiled processing of {} source points...".format(len(sources)))
+    with prof.stage("tiled_runs"):
+        pq_max, failed = msf_tiled.run_tiled(grids, sources, float(H_L_threshold), hf_li, hf_fri, vf,
+                                             use_vertical_raster, tile_size, memory_mb, bounded=bounded)
+    n_done = len(sources) - len(failed)
+else:
+    print("\nStarting processing for individual source points...")
+
+    todo = [s for s in sources if journal.attempts(keys[s[0]]) == 0]
+    while todo:
+        for fid, row, col, source in todo:
+            fc_basename = "Id_" + str(fid)
+            try:
+                print("\nProcessing source: " + fc_basename)
+                with prof.source(fid):
+                    src = (np.array([row]), np.array([col]), np.array([source]))
+
+                    print("  Running MSF...")
+                    if runner is not None:
+                        li_max = fri_max = np.inf
+                        if bounded:
+                            with prof.stage("window"):
+                                _, li_max, fri_max = msf_engine.msf_window(dtm, src[0], src[1], src[2],
+                                                                           cellSize, float(H_L_threshold),
+                                                                           hf_li, hf_fri, vf, vertical, z_min)
+                        fp = runner.footprint(row, col, source, float(H_L_threshold), li_max, fri_max, prof)
+                    else:
+                        if bounded:
+                            result, window = msf_engine.run_msf_bounded(dtm, src, fdir_deg, cellSize,
+                                                                        float(H_L_threshold), hf_li, hf_fri, vf,
+                                                                        vertical, z_min, save_intermediates,
+                                                                        prof)
+                        else:
+                            result = msf_engine.run_msf(dtm, src, fdir_deg, cellSize, float(H_L_threshold),
+                                                        hf_li, hf_fri, vf, vertical, save_intermediates,
+                                                        prof)
+                            window = msf_engine.Window(0, 0, dtm.shape[0], dtm.shape[1])
+                        if save_intermediates:
+                            # only the tiles of the window holding data are written
+                            for name, arr in result._asdict().items():
+                                writer.write_raster(os.path.join(msfdir, name + "_" + fc_basename + ".tif"),
+                                                    arr, profile, window=window)
+                        fp = msf_footprints.footprint(result.pq_lim, window, dtm.shape)
+
+                    with prof.stage("store"):
+                        results.store(keys[fid], fp, dtm.shape)
+                journal.done(keys[fid], fid)
+                n_done += 1
+                print("  Finished processing for " + fc_basename)
+
+            except Exception as e:
+                print("  UNEXPECTED ERROR processing {}: {}".format(fc_basename, e))
+                journal.fail(keys[fid], fid, e)
+                # Continue to the next feature
+            journal.save()
+        todo = sources_to_retry(sources)
+
+if journal is not None:
+    journal.finish()
+    for fid, attempts, error in journal.failed():
+        print("  Warning: Id_{} failed {} times, not in the results: {}".format(fid, attempts, error))
+
+# Combined maximum, winning source Id and overlap count in one pass over the footprints
+src_id = n_overlap = None
+patched = False
+if old_grids is not None and patch_paths is not None and not journal.failed():
+    # Incremental update: only the window of the old and new footprints of the
+    # affected sources is combined again and written in place
+    for fid in affected:
+        patch_window = msf_update.union_window(patch_window, results.load(keys[fid]).window)
+    if patch_window is not None:
+        print("\nPatching the combined rasters over {} x {} cells...".format(patch_window.nrows,
+                                                                          patch_window.ncols))
+        with prof.stage("combine"):
+            msf_update.patch_combined(patch_paths, ((fid, results.load(keys[fid]))
+                                                    for fid, row, col, source in all_sources),
+                                      dtm.shape, patch_window)
+        outputs.extend(patch_paths)
+    else:
+        print("\nNo source point affected by the DTM change: combined rasters unchanged")
+    patched = True
+elif results is not None:
+    print("\nCombining the footprints of {} source points...".format(len(all_sources)))
+    with prof.stage("combine"):
+        pq_max, src_id, n_overlap, n_done = msf_footprints.reduce_footprints(
+            ((fid, results.load(keys[fid])) for fid, row, col, source in all_sources), dtm.shape)
+
+# ---------------------------------------------------------------------------
+# Part 4: Save the combined maximum (CellStatistics MAXIMUM, DATA)
+# ---------------------------------------------------------------------------
+if run_mode == "sweep":
+    print("\nSweep rasters saved in " + sweepdir)
+elif run_mode == "ensemble":
+    print("\nEnsemble rasters saved in " + ensdir)
+elif patched:
+    print("\nFinal combined output (patched): " + patch_paths[0])
+elif n_done:
+    with prof.stage("write_outputs"):
+        pq_lim_all_path = os.path.join(pqlimalldir, "pq_lim_combined_max.tif")
+        print("\nSaving final combined raster: " + pq_lim_all_path)
+        if run_mode == "tiled":
+            # the tiles of pq_max are removed by close(): written in place
+            msf_io.write_raster_blocks(pq_lim_all_path, profile, pq_max.blocks(), compress=output_compress,
+                                       overviews=output_overviews)
+            pq_max.close()
+        else:
+            writer.write_raster(pq_lim_all_path, pq_max, profile, overviews=output_overviews)
+        outputs.append(pq_lim_all_path)
+        print("Final combined output: " + pq_lim_all_path)
+        if src_id is not None:
+            # Source attribution: Id of the source giving the maximum and number of overlapping sources
+            writer.write_raster(os.path.join(pqlimalldir, "pq_lim_source_id.tif"), src_id, profile,
+                                dtype="int32", nodata=-2147483648, overviews=output_overviews)
+            writer.write_raster(os.path.join(pqlimalldir, "pq_lim_overlap_count.tif"), n_overlap, profile,
+                                dtype="int32", nodata=0, overviews=output_overviews)
+            outputs.append(os.path.join(pqlimalldir, "pq_lim_source_id.tif"))
+            outputs.append(os.path.join(pqlimalldir, "pq_lim_overlap_count.tif"))
+else:
+    print("\nWarning: No individual pq_lim rasters were successfully generated.")
+
+if (src_id is not None or patched) and build_source_index:
+    index_dir = os.path.join(pqlimalldir, "source_index")
+    print("Building the source index: " + index_dir)
+    with prof.stage("source_index"):
+        msf_index.build_index(index_dir, lambda: ((fid, results.load(keys[fid]))
+                                                  for fid, row, col, source in all_sources),
+                              dtm.shape, profile)
+
+with prof.stage("write_wait"):  # writes not overlapped with the computation
+    writer.close()
+
+if results is not None:
+    # DTM and sources of the combined rasters, for the next incremental update
+    if (n_done or patched) and not journal.failed():
+        msf_update.write_state(state_path, grids.key, keys)
+    elif os.path.exists(state_path):
+        os.remove(state_path)
+
+if write_run_report:
+    for path in outputs:
+        prof.add_output(path)
+    if cache is not None:
+        prof.add_cache("cache", cache)
+    if results is not None:
+        prof.add_cache("results", results)
+    report_path = os.path.join(pqlimalldir, "run_report.json")
+    prof.write(report_path, run_mode=run_mode, res=res, DTM=DTM, shp=shp, H_L_threshold=H_L_threshold,
+               hf_li=[type(hf_li).__name__] + list(hf_li), hf_fri=[type(hf_fri).__name__] + list(hf_fri),
+               vf=[type(vf).__name__] + list(vf), use_vertical_raster=use_vertical_raster, bounded=bounded,
+               use_graph=use_graph, n_sources=len(all_sources), n_run=len(sources), n_done=int(n_done))
+    print("\nRun report: " + report_path)
+
+print("\nScript finished.")
@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+
+"""
+Benchmark of the native MSF engine on synthetic terrains.
+
+Filled DTMs (inclined plane, cone, V-valley network, fractal terrain) are
+generated at the requested sizes and resolutions, with 1 to 10^4 source
+points on their upper half. Every case (terrain, size, resolution, number
+of sources) runs in its own process, so the peak RSS is the one of that case;
+the kernels are compiled on a small DTM before the clock starts. Modes:
+
+* per_source   - the chain of MSF_multiple_points_native.py, timed by stage:
+                 rasterize (points to cells, ras_src_all), flow_direction,
+                 window (H/L bounds), li_pass, fri_pass, calculator (pq_lim)
+                 and combine (footprints and combined maximum)
+* graph        - per_source on the precomputed propagation graphs
+                 (graph_build, then the same stages)
+* multi_source - labelled passes over all the sources
+* parallel     - per-source runs on 1..N worker processes (scaling)
+
+Every record has the stage times, the throughput in DTM cells per second
+and sources per hour, the cells visited by the passes per second, the peak
+RSS and whether the combined maximum equals the per_source one. Results are
+written as JSON; --compare flags the cases slower than a previous file.
+
+Command line:
+    python msf_benchmark.py --terrains plane cone valleys fractal --sizes 256 512 1024
+                            --sources 1 10 100 1000 10000 --res 3m 10m --workers 1 2 4
+                            --out bench.json [--compare bench_old.json]
+"""
+# Name: msf_benchmark.py
+# Description: Reproducible benchmark (synthetic terrains, source sets,
+#              stage timings, throughput, peak memory, worker scaling) with
+#              JSON output and comparison against a previous run.
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+from collections import OrderedDict
+
+import numpy as np
+from rasterio.transform import from_origin
+
+import msf_cache
+import msf_engine
+import msf_footprints
+import msf_io
+from msf_profile import peak_rss_mb
+from msf_engine import fill_depressions
+
+TERRAINS = ("plane", "cone", "valleys", "fractal")
+MODES = ("per_source", "graph", "multi_source", "parallel")
+
+
+# ---------------------------------------------------------------------------
+# Synthetic terrains
+# ---------------------------------------------------------------------------
+def make_terrain(kind, size, cellsize, seed=0):
+    """Filled synthetic DTM of size x size cells (float64, metres)."""
+    rows, cols = np.mgrid[0:size, 0:size].astype(np.float64) * cellsize
+    extent = size * cellsize
+    if kind == "plane":
+        # 20 % slope towards south, 2 % towards west
+        z = 1000.0 + 0.2 * (extent - rows) + 0.02 * cols
+    elif kind == "cone":
+        r = np.hypot(rows - extent / 2.0, cols - extent / 2.0)
+        z = 1000.0 + 0.4 * (extent / 2.0 - r)
+    elif kind == "valleys":
+        # main valley along the middle row draining west, a tributary every
+        # 64 cells, side slopes steeper than the channels
+        mid = extent / 2.0
+        main = 1000.0 + 0.05 * cols
+        z = main + 0.5 * np.abs(rows - mid)
+        for cj in np.arange(32, size, 64) * cellsize:
+            trib = 1000.0 + 0.05 * cj + 0.15 * np.abs(rows - mid) + 0.5 * np.abs(cols - cj)
+            z = np.minimum(z, trib)
+    elif kind == "fractal":
+        # spectral synthesis (power law spectrum) on a regional slope
+        rng = np.random.RandomState(seed)
+        fy = np.fft.fftfreq(size)[:, None]
+        fx = np.fft.rfftfreq(size)[None, :]
+        f = np.hypot(fx, fy)
+        f[0, 0] = 1.0
+        spectrum = (rng.normal(size=f.shape) + 1j * rng.normal(size=f.shape)) / f ** 1.8
+        spectrum[0, 0] = 0.0
+        noise = np.fft.irfft2(spectrum, s=(size, size))
+        noise *= 0.15 * extent / (noise.max() - noise.min())
+        z = 1000.0 + 0.1 * (extent - rows) + noise
+    else:
+        raise ValueError("unknown terrain: {}".format(kind))
+    return fill_depressions(z)
+
+
+def make_profile(size, cellsize):
+    """Rasterio profile of a synthetic DTM."""
+    return dict(driver="GTiff", height=size, width=size, count=1, dtype="float32", crs=None,
+                transform=from_origin(500000.0, 5000000.0 + size * cellsize, cellsize, cellsize),
+                nodata=msf_io.NODATA)
+
+
+def make_sources(dtm, profile, n, seed=0):
+    """(x, y, ids, values) of n source points on the upper half of a DTM
+    (cell centres, start_z = DTM elevation)."""
+    rng = np.random.RandomState(seed)
+    inner = np.zeros(dtm.shape, dtype=bool)
+    inner[1:-1, 1:-1] = True
+    cells = np.flatnonzero(inner & (dtm >= np.median(dtm)))
+    cells = np.sort(rng.choice(cells, size=min(int(n), cells.size), replace=False))
+    rows, cols = np.divmod(cells, dtm.shape[1])
+    x, y = profile["transform"] * (cols + 0.5, rows + 0.5)
+    return (np.asarray(x), np.asarray(y), np.arange(1, cells.size + 1),
+            dtm.reshape(-1)[cells])
+
+
+def res_to_cellsize(res):
+    """Cell size of a resolution label such as "3m"."""
+    return float(str(res).rstrip("m"))
+
+
+# ---------------------------------------------------------------------------
+# Measurements
+# ---------------------------------------------------------------------------
+class StageTimer:
+    """Accumulated wall time per stage."""
+
+    def __init__(self):
+        self.times = OrderedDict()
+
+    def __call__(self, stage):
+        return _Stage(self, stage)
+
+
+class _Stage:
+    def __init__(self, timer, stage):
+        self.timer, self.stage = timer, stage
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+
+    def __exit__(self, *exc):
+        t = self.timer.times
+        t[self.stage] = t.get(self.stage, 0.0) + time.perf_counter() - self.t0
+
+
+def _chain(dtm, profile, pts, thr, timer, runner=None):
+    """The per-source chain of MSF_multiple_points_native.py with stage timings.
+
+    Returns (pq_max, visited cells)."""
+    x, y, ids, values = pts
+    with timer("rasterize"):
+        rows, cols = msf_io.xy_to_cells(x, y, profile)
+        src_cells = msf_engine.most_frequent(rows, cols, values)
+        ras_src_all = np.full(dtm.shape, np.nan)
+        ras_src_all[src_cells[0], src_cells[1]] = src_cells[2]
+    with timer("flow_direction"):
+        grids = msf_cache.compute_grids(dtm, profile, key="benchmark")
+    if runner == "graph":
+        import msf_graph
+        with timer("graph_build"):
+            runner = msf_graph.GraphRunner(dtm, msf_graph.graph_for(grids, msf_engine.HF_LI),
+                                           msf_graph.graph_for(grids, msf_engine.HF_FRI))
+    footprints = []
+    visited = 0
+    for fid, row, col, value in zip(ids, rows, cols, values):
+        src_r, src_c, src_v = np.array([row]), np.array([col]), np.array([value])
+        with timer("window"):
+            window, li_max, fri_max = msf_engine.msf_window(dtm, src_r, src_c, src_v, grids.cellsize,
+                                                            thr, z_min=grids.z_min)
+        if runner is not None:
+            cell = [row * dtm.shape[1] + col]
+            with timer("li_pass"):
+                li_pass = runner.distances(0, cell, li_max)
+            with timer("fri_pass"):
+                fri_pass = runner.distances(1, cell, fri_max)
+            visited += li_pass[0].size + fri_pass[0].size
+            with timer("calculator"):
+                fp = runner.pq_lim(value, thr, li_pass, fri_pass)
+            with timer("combine"):
+                footprints.append((fid, fp))
+            continue
+        window = window or msf_engine.Window(0, 0, dtm.shape[0], dtm.shape[1])
+        win = msf_engine.window_slices(window)
+        src_w = (src_r - window.row_off, src_c - window.col_off, src_v)
+        with timer("li_pass"):
+            start_z, li, n_li = msf_engine.path_allocation(src_w, grids.fdir_deg[win], grids.cellsize,
+                                                           msf_engine.HF_LI, max_cost=li_max)
+        with timer("fri_pass"):
+            _, fri, n_fri = msf_engine.path_allocation(src_w, grids.fdir_deg[win], grids.cellsize,
+                                                       msf_engine.HF_FRI, max_cost=fri_max)
+        visited += n_li + n_fri
+        with timer("calculator"):
+            pq_lim = msf_engine.pq_lim_fused(dtm[win], start_z, li, fri, thr)
+        with timer("combine"):
+            footprints.append((fid, msf_footprints.footprint(pq_lim, window, dtm.shape)))
+    with timer("combine"):
+        pq_max = msf_footprints.reduce_footprints(footprints, dtm.shape)[0]
+    return pq_max, visited
+
+
+def run_case(case):
+    """All the modes of one case (dict of terrain, size, res, n_sources, modes,
+    workers, thr, seed); returns a list of result records."""
+    if not case.get("warm_up"):
+        # compile the kernels of every mode outside of the measurements
+        run_case(dict(case, size=48, n_sources=4, workers=case["workers"][:1], warm_up=True))
+    cellsize = res_to_cellsize(case["res"])
+    thr = float(case["thr"])
+
+    t0 = time.perf_counter()
+    dtm = make_terrain(case["terrain"], case["size"], cellsize, case["seed"])
+    t_terrain = time.perf_counter() - t0
+    profile = make_profile(case["size"], cellsize)
+    pts = make_sources(dtm, profile, case["n_sources"], case["seed"])
+    n = int(pts[2].size)
+    base = OrderedDict((k, case[k]) for k in ("terrain", "size", "res"))
+    base.update(cellsize=cellsize, cells=int(dtm.size), n_sources=n, terrain_s=round(t_terrain, 4))
+
+    def record(mode, total, stages=None, visited=None, workers=None, equal=None):
+        rec = OrderedDict(base)
+        rec.update(mode=mode, workers=workers, total_s=total,
+                   stages=stages or {}, dtm_cells_per_s=dtm.size / total if total else None,
+                   sources_per_h=n * 3600.0 / total if total else None,
+                   visited_cells_per_s=visited / total if visited and total else None,
+                   visited_cells=visited, peak_rss_mb=peak_rss_mb(), equal=equal)
+        return rec
+
+    out = []
+    reference = None
+    for mode in ("per_source", "graph"):
+        if mode not in case["modes"]:
+            continue
+        timer = StageTimer()
+        t0 = time.perf_counter()
+        pq_max, visited = _chain(dtm, profile, pts, thr, timer, "graph" if mode == "graph" else None)
+        total = time.perf_counter() - t0
+        if reference is None:
+            reference = pq_max
+        out.append(record(mode, total, dict(timer.times), visited, 1,
+                          bool(np.array_equal(pq_max, reference, equal_nan=True))))
+
+    if "multi_source" in case["modes"] or "parallel" in case["modes"]:
+        grids = msf_cache.compute_grids(dtm, profile, key="benchmark")
+        rows, cols = msf_io.xy_to_cells(pts[0], pts[1], profile)
+        sources = list(zip(pts[2].tolist(), rows.tolist(), cols.tolist(), pts[3].tolist()))
+    if "multi_source" in case["modes"]:
+        t0 = time.perf_counter()
+        pq_max = msf_engine.run_msf_multi(dtm, msf_engine.most_frequent(rows, cols, pts[3]),
+                                          grids.fdir_deg, cellsize, thr, z_min=grids.z_min)
+        total = time.perf_counter() - t0
+        equal = None if reference is None else bool(np.array_equal(pq_max.astype(np.float32), reference,
+                                                                   equal_nan=True))
+        out.append(record("multi_source", total, equal=equal, workers=1))
+    if "parallel" in case["modes"]:
+        import msf_parallel
+        t_one = None
+        for w in case["workers"]:
+            t0 = time.perf_counter()
+            pq_max, failed = msf_parallel.run_parallel(dtm, grids.fdir_deg, cellsize, sources, thr,
+                                                       n_workers=w, log=lambda msg: None, z_min=grids.z_min)
+            total = time.perf_counter() - t0
+            t_one = t_one or total
+            equal = None if reference is None else bool(np.array_equal(pq_max, reference, equal_nan=True))
+            rec = record("parallel", total, workers=w, equal=equal and not failed)
+            rec.update(speedup=t_one / total, peak_rss_children_mb=peak_rss_mb(children=True))
+            out.append(rec)
+    return out
+
+
+# ---------------------------------------------------------------------------
+# Driver
+# ---------------------------------------------------------------------------
+def _environment():
+    """Versions and machine the results were measured with."""
+    env = OrderedDict(date=time.strftime("%Y-%m-%dT%H:%M:%S"), python=platform.python_version(),
+                      numpy=np.__version__, platform=platform.platform(), cpu_count=os.cpu_count())
+    try:
+        import numba
+        env["numba"] = numba.__version__
+    except ImportError:
+        env["numba"] = None
+    try:
+        env["git"] = subprocess.check_output(["git", "describe", "--always", "--dirty"],
+                                             cwd=os.path.dirname(os.path.abspath(__file__)),
+                                             stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        env["git"] = None
+    return env
+
+
+def _case_key(rec):
+    return tuple(rec[k] for k in ("terrain", "size", "res", "n_sources", "mode", "workers"))
+
+
+def compare(results, previous, tolerance=0.1, log=print):
+    """Print the total time of every case against a previous run; returns the
+    cases more than tolerance (fraction) slower or no longer equal."""
+    old = dict((_case_key(r), r) for r in previous)
+    worse = []
+    log("{:<44} {:>10} {:>10} {:>7}".format("case", "old s", "new s", "ratio"))
+    for rec in results:
+        prev = old.get(_case_key(rec))
+        if prev is None:
+            continue
+        ratio = rec["total_s"] / prev["total_s"] if prev["total_s"] else float("nan")
+        flag = ""
+        if ratio > 1.0 + tolerance or (prev.get("equal") and rec.get("equal") is False):
+            flag = "  REGRESSION"
+            worse.append(rec)
+        log("{:<44} {:>10.3f} {:>10.3f} {:>7.2f}{}".format(
+            "/".join(str(k) for k in _case_key(rec)), prev["total_s"], rec["total_s"], ratio, flag))
+    return worse
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of the native MSF engine.")
+    parser.add_argument("--terrains", nargs="+", default=list(TERRAINS), choices=TERRAINS)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[256, 512, 1024],
+                        help="DTM side in cells")
+    parser.add_argument("--res", nargs="+", default=["3m"], help="resolutions, e.g. 3m 5m 10m")
+    parser.add_argument("--sources", nargs="+", type=int, default=[1, 10, 100, 1000],
+                        help="numbers of source points")
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=MODES)
+    parser.add_argument("--workers", nargs="+", type=int, default=None,
+                        help="worker counts of the parallel mode (default 1, 2, 4, ... cores)")
+    parser.add_argument("--threshold", type=float, default=0.19, help="H_L_threshold")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="msf_benchmark.json", help="JSON results file")
+    parser.add_argument("--compare", help="previous results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="slowdown (fraction) reported as a regression by --compare")
+    parser.add_argument("--case", help=argparse.SUPPRESS)  # internal: run one case, print JSON
+    args = parser.parse_args(argv)
+
+    if args.case:
+        print(json.dumps(run_case(json.loads(args.case))))
+        return 0
+
+    workers = args.workers
+    if workers is None:
+        workers = [1]
+        while workers[-1] * 2 <= (os.cpu_count() or 1):
+            workers.append(workers[-1] * 2)
+    results = []
+    for terrain in args.terrains:
+        for size in args.sizes:
+            for res in args.res:
+                for n in args.sources:
+                    case = dict(terrain=terrain, size=size, res=res, n_sources=n, modes=args.modes,
+                                workers=workers, thr=args.threshold, seed=args.seed)
+                    print("{} {}x{} {} {} sources...".format(terrain, size, size, res, n))
+                    # one process per case: peak RSS of that case only
+                    proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--case",
+                                           json.dumps(case)], stdout=subprocess.PIPE)
+                    if proc.returncode != 0:
+                        print("  FAILED (exit code {})".format(proc.returncode))
+                        continue
+                    for rec in json.loads(proc.stdout.decode().strip().splitlines()[-1]):
+                        print("  {:<12} workers={!s:<3} {:9.3f} s {:12.0f} cells/s {:10.0f} sources/h"
+                              " {:8.1f} MB{}".format(rec["mode"], rec["workers"], rec["total_s"],
+                                                     rec["dtm_cells_per_s"], rec["sources_per_h"],
+                                                     rec["peak_rss_mb"] or float("nan"),
+                                                     "" if rec["equal"] is not False else "  NOT EQUAL"))
+                        results.append(rec)
+    with open(args.out, "w") as f:
+        json.dump(OrderedDict(environment=_environment(), results=results), f, indent=1)
+    print("Results saved in " + args.out)
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)["results"]
+        if compare(results, previous, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+
+"""
+Persistent caches of the native MSF engine.
+
+GridCache keeps the grids derived from a DTM (flow direction, flow degrees,
+neighbour geometry and DTM statistics). Entries are keyed on a hash of the
+DTM values, its cell size and its georeferencing, and stored as .npy files
+that are memory mapped on load. One cache folder can be shared by the
+3m/5m/10m workspaces: when it grows beyond its size limit the least
+recently used entries are removed.
+
+FootprintCache keeps the sparse pq_lim footprint (see msf_footprints) of
+single sources, keyed on the DTM key, the source cell and value and the
+model parameters, so that a rerun only computes new or changed sources.
+"""
+# Name: msf_cache.py
+# Description: Content-addressed caches of DTM-derived grids (fdir,
+#              fdir_deg, neighbour geometry, statistics) and of per-source
+#              pq_lim footprints, with LRU eviction.
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+import msf_engine
+import msf_footprints
+import msf_io
+
+DTMGrids = namedtuple("DTMGrids", "key dtm profile cellsize fdir fdir_deg nbr_mask nbr_dist "
+                                  "z_min z_max z_mean")
+
+_ARRAYS = ("dtm", "fdir", "fdir_deg", "nbr_mask")
+# Storage type of the cached arrays: fdir_deg only takes multiples of 45
+# degrees (NaN without flow direction), exact in float32
+_DTYPES = dict(dtm=np.float64, fdir=np.uint8, fdir_deg=np.float32, nbr_mask=np.uint8)
+
+# Part of every footprint key: increase it when a change of the engine
+# changes pq_lim, so that older footprints are not reused
+FOOTPRINT_VERSION = 2
+
+
+def dtm_key(dtm, profile):
+    """Content key of a DTM: hash of its values, cell size and georeferencing."""
+    return dtm_key_blocks([dtm], profile)
+
+
+def dtm_key_blocks(blocks, profile):
+    """dtm_key of a DTM given as consecutive blocks of full rows (same key)."""
+    h = hashlib.blake2b(digest_size=16)
+    for block in blocks:
+        h.update(np.ascontiguousarray(block, dtype=np.float64).tobytes())
+    georef = msf_io.profile_to_dict({k: profile.get(k) for k in ("transform", "crs", "width", "height")})
+    georef["cellsize"] = msf_io.cell_size(profile)
+    h.update(json.dumps(georef, sort_keys=True).encode("utf-8"))
+    return h.hexdigest()
+
+
+def neighbour_mask(dtm):
+    """uint8 mask with bit k set where D8 neighbour k is inside the DTM and not NoData."""
+    valid = ~np.isnan(dtm)
+    nrows, ncols = dtm.shape
+    mask = np.zeros(dtm.shape, dtype=np.uint8)
+    for k in range(8):
+        dr, dc = int(msf_engine.D8_DROW[k]), int(msf_engine.D8_DCOL[k])
+        shifted = np.zeros(dtm.shape, dtype=bool)
+        shifted[max(-dr, 0):nrows - max(dr, 0), max(-dc, 0):ncols - max(dc, 0)] = \
+            valid[max(dr, 0):nrows - max(-dr, 0), max(dc, 0):ncols - max(-dc, 0)]
+        mask |= (shifted & valid).astype(np.uint8) << k
+    return mask
+
+
+def neighbour_distances(cellsize):
+    """Step length to each D8 neighbour, in flow direction code order."""
+    return np.where(np.arange(8) % 2 == 1, cellsize * msf_engine.SQRT2, float(cellsize))
+
+
+class GridCache:
+    """Folder of cached DTM-derived grids with a size limit and LRU eviction.
+
+    root      : cache folder (can be shared by several workspaces)
+    max_bytes : total size above which least recently used entries are removed
+    """
+
+    def __init__(self, root, max_bytes=20 * 1024 ** 3):
+        self.root = root
+        self.max_bytes = int(max_bytes)
+        self.stats = {}  # kind -> [hits, misses], see count()
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def count(self, kind, hit):
+        """Record a cache hit (or miss) of a kind of lookup, for the run report."""
+        self.stats.setdefault(kind, [0, 0])[0 if hit else 1] += 1
+
+    # -- paths ---------------------------------------------------------------
+    def _entry(self, key):
+        return os.path.join(self.root, key)
+
+    def _index_path(self):
+        return os.path.join(self.root, "index.json")
+
+    # -- file stat -> key index (skips hashing an unchanged DTM file) ---------
+    def _read_index(self):
+        try:
+            with open(self._index_path()) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _write_index(self, index):
+        tmp = self._index_path() + ".{}.tmp".format(os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp, self._index_path())
+
+    @staticmethod
+    def _stat_id(path):
+        st = os.stat(path)
+        return "{}|{}|{}".format(os.path.abspath(path), st.st_size, st.st_mtime_ns)
+
+    def key_for_file(self, path):
+        """Cached key of a DTM file, None if the file changed since it was cached."""
+        key = self._read_index().get(self._stat_id(path))
+        if key is not None and self.has(key):
+            return key
+        return None
+
+    def remember_file(self, path, key):
+        index = self._read_index()
+        index[self._stat_id(path)] = key
+        # drop index lines pointing to evicted entries
+        index = dict((s, k) for s, k in index.items() if self.has(k))
+        self._write_index(index)
+
+    # -- entries -------------------------------------------------------------
+    def has(self, key):
+        return os.path.exists(os.path.join(self._entry(key), "meta.json"))
+
+    def load(self, key):
+        """Memory-mapped DTMGrids of an entry, None if missing."""
+        entry = self._entry(key)
+        try:
+            with open(os.path.join(entry, "meta.json")) as f:
+                meta = json.load(f)
+            arrays = dict((name, np.load(os.path.join(entry, name + ".npy"), mmap_mode="r"))
+                          for name in _ARRAYS)
+        except (IOError, OSError, ValueError):
+            return None
+        self._touch(key)
+        return DTMGrids(key=key, profile=msf_io.profile_from_dict(meta["profile"]),
+                        cellsize=meta["cellsize"], nbr_dist=neighbour_distances(meta["cellsize"]),
+                        z_min=meta["z_min"], z_max=meta["z_max"], z_mean=meta["z_mean"], **arrays)
+
+    def open_entry(self, key):
+        """Folder of an entry (marked as used), None if missing."""
+        if not self.has(key):
+            return None
+        self._touch(key)
+        return self._entry(key)
+
+    def new_entry(self, key):
+        """Empty temporary folder where the files of an entry can be written."""
+        tmp = self._entry(key) + ".{}.tmp".format(os.getpid())
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        return tmp
+
+    def commit(self, key, tmp, meta):
+        """Publish an entry written in new_entry(key) (atomic rename)."""
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        try:
+            os.rename(tmp, self._entry(key))
+        except OSError:
+            # another run stored the same entry meanwhile
+            shutil.rmtree(tmp, ignore_errors=True)
+        self._touch(key)
+        self.evict(keep=key)
+
+    def store(self, grids):
+        """Write a DTMGrids entry (atomically) and evict old entries if needed."""
+        if self.has(grids.key):
+            return
+        tmp = self.new_entry(grids.key)
+        for name in _ARRAYS:
+            np.save(os.path.join(tmp, name + ".npy"), np.asarray(getattr(grids, name), dtype=_DTYPES[name]))
+        self.commit(grids.key, tmp, grids_meta(grids))
+
+    def _touch(self, key):
+        with open(os.path.join(self._entry(key), "last_used"), "w") as f:
+            f.write(str(time.time()))
+
+    def entries(self):
+        """List of (last_used, bytes, key) of all entries."""
+        out = []
+        for key in os.listdir(self.root):
+            entry = self._entry(key)
+            if not self.has(key):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+            try:
+                with open(os.path.join(entry, "last_used")) as f:
+                    last_used = float(f.read())
+            except (IOError, OSError, ValueError):
+                last_used = 0.0
+            out.append((last_used, size, key))
+        return out
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache fits in max_bytes."""
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        removed = []
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._entry(key), ignore_errors=True)
+            total -= size
+            removed.append(key)
+        return removed
+
+
+def grids_meta(grids):
+    """JSON metadata of a DTMGrids entry."""
+    return dict(profile=msf_io.profile_to_dict(grids.profile), cellsize=grids.cellsize,
+                z_min=grids.z_min, z_max=grids.z_max, z_mean=grids.z_mean)
+
+
+def compute_grids(dtm, profile, key=None):
+    """DTMGrids computed from scratch (no cache)."""
+    cellsize = msf_io.cell_size(profile)
+    fdir = msf_engine.flow_direction(dtm, cellsize).astype(np.uint8)
+    return DTMGrids(key=key or dtm_key(dtm, profile), dtm=dtm, profile=profile, cellsize=cellsize,
+                    fdir=fdir, fdir_deg=msf_engine.fdir_to_degrees(fdir),
+                    nbr_mask=neighbour_mask(dtm), nbr_dist=neighbour_distances(cellsize),
+                    z_min=float(np.nanmin(dtm)), z_max=float(np.nanmax(dtm)),
+                    z_mean=float(np.nanmean(dtm)))
+
+
+def dtm_grids(path, cache=None, log=print):
+    """DTM and derived grids of a DTM file, from the cache when possible.
+
+    A warm start (same file, or same content cached under another path) maps
+    the cached arrays without reading the GeoTIFF or recomputing flow
+    direction. Without a cache everything is computed in memory.
+    """
+    if cache is not None:
+        key = cache.key_for_file(path)
+        if key is not None:
+            grids = cache.load(key)
+            if grids is not None:
+                log("  DTM grids loaded from cache: " + key)
+                cache.count("grids", True)
+                return grids
+    dtm, profile = msf_io.read_raster(path)
+    key = dtm_key(dtm, profile)
+    if cache is not None:
+        grids = cache.load(key)
+        cache.count("grids", grids is not None)
+        if grids is None:
+            log("  Computing DTM grids (cache miss): " + key)
+            cache.store(compute_grids(dtm, profile, key))
+            grids = cache.load(key)
+        else:
+            log("  DTM grids loaded from cache: " + key)
+        cache.remember_file(path, key)
+        return grids
+    return compute_grids(dtm, profile, key)
+
+
+# ---------------------------------------------------------------------------
+# Per-source pq_lim footprints
+# ---------------------------------------------------------------------------
+def _factor_params(factor):
+    return None if factor is None else [type(factor).__name__] + [float(v) for v in factor]
+
+
+def source_key(dtm_key, row, col, value, h_l_threshold, hf_li=msf_engine.HF_LI,
+               hf_fri=msf_engine.HF_FRI, vf=msf_engine.VF_MSF, use_vertical_raster=False):
+    """Key of the pq_lim footprint of one source cell.
+
+    Built from everything pq_lim depends on: the DTM content key, the source
+    cell and value (start_z), H_L_threshold and the factors (the vertical
+    factor only counts when a vertical raster is used).
+    """
+    params = dict(version=FOOTPRINT_VERSION, dtm=dtm_key, cell=[int(row), int(col)],
+                  value=float(value), h_l_threshold=float(h_l_threshold),
+                  hf_li=_factor_params(hf_li), hf_fri=_factor_params(hf_fri),
+                  vf=_factor_params(vf) if use_vertical_raster else None)
+    h = hashlib.blake2b(json.dumps(params, sort_keys=True).encode("utf-8"), digest_size=16)
+    return h.hexdigest()
+
+
+class FootprintCache:
+    """Folder of per-source pq_lim footprints (one .npz per source key).
+
+    root      : cache folder
+    max_bytes : total size above which least recently used footprints are
+                removed; store() prunes the cache down to 90 % of it when it
+                is exceeded, never removing the keys in self.keep (set by
+                the caller, e.g. the sources of the current run)
+    The size count and the pruning are shared by the threads of the process
+    (the service stores footprints from its request threads).
+    """
+
+    def __init__(self, root, max_bytes=20 * 1024 ** 3):
+        self.root = root
+        self.max_bytes = int(max_bytes)
+        self.stats = {}  # kind -> [hits, misses], see count()
+        self._bytes = None  # total size, listed at the first store()
+        self.keep = set()  # keys store() never prunes
+        self._lock = threading.Lock()
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def __getstate__(self):
+        # sent to the worker processes of msf_parallel: locks are not picklable
+        state = dict(self.__dict__)
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def count(self, kind, hit):
+        """Record a cache hit (or miss) of a kind of lookup, for the run report."""
+        self.stats.setdefault(kind, [0, 0])[0 if hit else 1] += 1
+
+    def _path(self, key):
+        # two-character subfolders keep folder listings short
+        return os.path.join(self.root, key[:2], key + ".npz")
+
+    def has(self, key):
+        return os.path.exists(self._path(key))
+
+    def load(self, key):
+        """msf_footprints.Footprint of a key, None if missing."""
+        path = self._path(key)
+        try:
+            fp = msf_footprints.load(path)
+            os.utime(path, None)  # last use, for LRU pruning
+        except (IOError, OSError, ValueError, KeyError):
+            self.count("footprints", False)
+            return None
+        self.count("footprints", True)
+        return fp
+
+    def store(self, key, fp, shape):
+        """Write the footprint of a key (shape: shape of the DTM)."""
+        path = self._path(key)
+        folder = os.path.dirname(path)
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        # process and thread in the name: the service runs sources on threads
+        tmp = "{}.{}.{}.tmp.npz".format(path[:-4], os.getpid(), threading.get_ident())
+        msf_footprints.save(tmp, fp, shape)
+        size = os.path.getsize(tmp)
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = sum(s for _, s, _ in self.entries())
+            if os.path.exists(path):
+                self._bytes -= os.path.getsize(path)
+            os.replace(tmp, path)
+            self._bytes += size
+            if self._bytes > self.max_bytes:
+                self._prune(self.keep, None, 0.9 * self.max_bytes)
+
+    def entries(self):
+        """List of (last_used, bytes, key) of all footprints."""
+        out = []
+        for sub in os.listdir(self.root):
+            folder = os.path.join(self.root, sub)
+            if not os.path.isdir(folder):
+                continue
+            for name in os.listdir(folder):
+                if name.endswith(".npz") and ".tmp" not in name:
+                    st = os.stat(os.path.join(folder, name))
+                    out.append((st.st_mtime, st.st_size, name[:-4]))
+        return out
+
+    def prune(self, keep=(), max_age_days=None, max_bytes=None):
+        """Remove footprints not used for max_age_days (None: no age limit),
+        then least recently used ones until the cache fits in max_bytes
+        (default self.max_bytes). Keys in keep are never removed. Returns the
+        removed keys."""
+        with self._lock:
+            return self._prune(keep, max_age_days, self.max_bytes if max_bytes is None else max_bytes)
+
+    def _prune(self, keep, max_age_days, max_bytes):
+        keep = set(keep)
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        oldest = -np.inf if max_age_days is None else time.time() - max_age_days * 86400.0
+        removed = []
+        for last_used, size, key in entries:
+            if key in keep or (last_used >= oldest and total <= max_bytes):
+                continue
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                continue
+            total -= size
+            removed.append(key)
+        self._bytes = total
+        return removed
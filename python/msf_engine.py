@@ -0,0 +1,888 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+
+"""
+Native (ArcPy-free) MSF engine working on NumPy arrays.
+
+Re-implements the Spatial Analyst steps used by MSF_multiple_points.py:
+
+* FlowDirection (D8, "NORMAL" edge handling)
+* the Con(Log2(fdir) ...) conversion of the D8 codes to degrees
+* PathAllocation with a horizontal raster (HfForward / HfLinear) and an
+  optional vertical raster (VfBinary)
+* the raster calculator chain start_z, li, fri -> hi, h_l, h_l_lim, pqi, pq_lim
+
+Numba is used when available; without it the same kernels run as plain
+Python (identical results, much slower).
+"""
+# Name: msf_engine.py
+# Description: D8 flow direction, anisotropic path distance allocation and
+#              MSF raster calculator chain on NumPy arrays.
+#              **Requires NumPy. Numba is optional but strongly recommended.**
+
+import math
+import heapq
+from collections import namedtuple
+
+import numpy as np
+
+import msf_profile
+
+try:
+    from numba import njit
+except ImportError:  # Numba not installed: run the kernels as plain Python
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+# ---------------------------------------------------------------------------
+# Constants
+# ---------------------------------------------------------------------------
+# D8 neighbours in ArcGIS flow direction code order:
+# 1=E, 2=SE, 4=S, 8=SW, 16=W, 32=NW, 64=N, 128=NE
+D8_CODES = np.array([1, 2, 4, 8, 16, 32, 64, 128], dtype=np.int64)
+D8_DROW = np.array([0, 1, 1, 1, 0, -1, -1, -1], dtype=np.int64)
+D8_DCOL = np.array([1, 1, 0, -1, -1, -1, 0, 1], dtype=np.int64)
+# Moving direction of each neighbour in degrees clockwise from north, the same
+# convention produced by the fdir_deg formula and read by PathAllocation
+D8_AZIMUTH = np.array([90.0, 135.0, 180.0, 225.0, 270.0, 315.0, 0.0, 45.0])
+SQRT2 = math.sqrt(2.0)
+
+# Epsilon added to the denominators of the raster calculator divisions
+# (same value used in MSF_multiple_points.py)
+EPS = 1e-9
+
+# Horizontal / vertical factor kinds passed to the kernels
+_HF_NONE = 0
+_HF_FORWARD = 1
+_HF_LINEAR = 2
+_HF_BINARY = 3
+
+# ---------------------------------------------------------------------------
+# Horizontal and vertical factor objects (same names and arguments as arcpy.sa)
+# ---------------------------------------------------------------------------
+HfForward = namedtuple("HfForward", "zero_factor side_value")
+HfForward.__new__.__defaults__ = (0.5, 1.0)
+
+HfLinear = namedtuple("HfLinear", "zero_factor cut_angle slope")
+HfLinear.__new__.__defaults__ = (0.5, 181.0, 1.0 / 90.0)
+
+HfBinary = namedtuple("HfBinary", "zero_factor cut_angle")
+HfBinary.__new__.__defaults__ = (1.0, 45.0)
+
+VfBinary = namedtuple("VfBinary", "zero_factor low_cut_angle high_cut_angle")
+VfBinary.__new__.__defaults__ = (1.0, -30.0, 30.0)
+
+# Factors used by the two PathAllocation calls of the MSF model
+HF_LI = HfForward(1.0, 1.0)
+HF_FRI = HfLinear(0.5, 90, 0.011111)
+VF_MSF = VfBinary(1.0, -30, 30)
+
+MSFResult = namedtuple("MSFResult", "start_z li fri PathAll_Sour1 hi h_l h_l_lim pqi pq_lim")
+PathResult = namedtuple("PathResult", "allocation distance visited")
+
+
+def _hf_args(hf):
+    """Flatten a horizontal factor object to (kind, p0, p1, p2) for the kernels."""
+    if hf is None:
+        return _HF_NONE, 1.0, 0.0, 0.0
+    if isinstance(hf, HfForward):
+        return _HF_FORWARD, float(hf.zero_factor), float(hf.side_value), 0.0
+    if isinstance(hf, HfLinear):
+        return _HF_LINEAR, float(hf.zero_factor), float(hf.cut_angle), float(hf.slope)
+    if isinstance(hf, HfBinary):
+        return _HF_BINARY, float(hf.zero_factor), float(hf.cut_angle), 0.0
+    raise ValueError("Unsupported horizontal factor: {}".format(hf))
+
+
+def _vf_args(vf, vertical):
+    """Flatten a vertical factor object to (use_vf, zero_factor, low_cut, high_cut)."""
+    # As in PathAllocation, the vertical factor is only applied when a
+    # vertical raster is given (MSF_multiple_points.py passes "")
+    if vf is None or vertical is None:
+        return False, 1.0, -90.0, 90.0
+    if isinstance(vf, VfBinary):
+        return True, float(vf.zero_factor), float(vf.low_cut_angle), float(vf.high_cut_angle)
+    raise ValueError("Unsupported vertical factor: {}".format(vf))
+
+
+# ---------------------------------------------------------------------------
+# Flow direction
+# ---------------------------------------------------------------------------
+# Flat distance codes used while resolving flats (see _flat_distance_kernel)
+FLAT_NODATA = -1
+FLAT_DEFINED = 0
+FLAT_UNRESOLVED = 2 ** 30
+
+
+@njit(cache=True)
+def _d8_steepest_kernel(z_h, cellsize, row_off, col_off, nrows_all, ncols_all, fdir, fd):
+    # z_h is the block with a 1 cell halo (NaN outside the raster); fdir and fd
+    # cover the block without halo. row_off/col_off place the block in a
+    # raster of nrows_all x ncols_all cells (for the "NORMAL" edge rule).
+    nrows, ncols = fdir.shape
+    for r in range(nrows):
+        for c in range(ncols):
+            zc = z_h[r + 1, c + 1]
+            if math.isnan(zc):
+                fdir[r, c] = 0
+                fd[r, c] = FLAT_NODATA
+                continue
+            best = 0.0
+            best_k = -1
+            for k in range(8):
+                zn = z_h[r + 1 + D8_DROW[k], c + 1 + D8_DCOL[k]]
+                if math.isnan(zn):
+                    continue
+                step = cellsize * SQRT2 if k % 2 == 1 else cellsize
+                drop = (zc - zn) / step
+                if drop > best:
+                    best = drop
+                    best_k = k
+            gr = row_off + r
+            gc = col_off + c
+            fd[r, c] = FLAT_DEFINED
+            if best_k >= 0:
+                fdir[r, c] = D8_CODES[best_k]
+            elif gr == 0 or gc == 0 or gr == nrows_all - 1 or gc == ncols_all - 1:
+                # "NORMAL": edge cells without a downslope neighbour flow out
+                if gr == 0 and gc == 0:
+                    fdir[r, c] = 32
+                elif gr == 0 and gc == ncols_all - 1:
+                    fdir[r, c] = 128
+                elif gr == nrows_all - 1 and gc == 0:
+                    fdir[r, c] = 8
+                elif gr == nrows_all - 1 and gc == ncols_all - 1:
+                    fdir[r, c] = 2
+                elif gr == 0:
+                    fdir[r, c] = 64
+                elif gr == nrows_all - 1:
+                    fdir[r, c] = 4
+                elif gc == 0:
+                    fdir[r, c] = 16
+                else:
+                    fdir[r, c] = 1
+            else:
+                fdir[r, c] = 0
+                fd[r, c] = FLAT_UNRESOLVED
+
+
+@njit(cache=True)
+def _flat_distance_kernel(z_h, fd_h):
+    # Distance (in steps through cells of the same elevation) from every flat
+    # cell to the nearest cell with a direction: 1 next to such a cell, d + 1
+    # next to a flat cell at distance d. Updates the block inside the halo of
+    # fd_h in place, using the halo values as fixed boundary conditions, and
+    # returns True if a cell on the block border changed (its neighbour
+    # blocks must then be updated again).
+    nrows, ncols = fd_h.shape
+    heap = [(np.int64(0), np.int64(0))]
+    heap.pop()
+    border = False
+    for r in range(1, nrows - 1):
+        for c in range(1, ncols - 1):
+            if fd_h[r, c] < 1:
+                continue
+            best = fd_h[r, c]
+            for k in range(8):
+                rr = r + D8_DROW[k]
+                cc = c + D8_DCOL[k]
+                if z_h[rr, cc] != z_h[r, c]:
+                    continue
+                fv = fd_h[rr, cc]
+                if fv == FLAT_DEFINED:
+                    best = min(best, 1)
+                elif 1 <= fv < FLAT_UNRESOLVED:
+                    best = min(best, fv + 1)
+            if best < fd_h[r, c]:
+                fd_h[r, c] = best
+                heapq.heappush(heap, (np.int64(best), np.int64(r * ncols + c)))
+                if r == 1 or c == 1 or r == nrows - 2 or c == ncols - 2:
+                    border = True
+    while len(heap) > 0:
+        d, idx = heapq.heappop(heap)
+        r = idx // ncols
+        c = idx - r * ncols
+        if d > fd_h[r, c]:
+            continue
+        for k in range(8):
+            rr = r + D8_DROW[k]
+            cc = c + D8_DCOL[k]
+            if rr < 1 or rr > nrows - 2 or cc < 1 or cc > ncols - 2:
+                continue
+            if fd_h[rr, cc] > d + 1 and z_h[rr, cc] == z_h[r, c]:
+                fd_h[rr, cc] = d + 1
+                heapq.heappush(heap, (np.int64(d + 1), np.int64(rr * ncols + cc)))
+                if rr == 1 or cc == 1 or rr == nrows - 2 or cc == ncols - 2:
+                    border = True
+    return border
+
+
+@njit(cache=True)
+def _flat_assign_kernel(z_h, fd_h, fdir):
+    # Every resolved flat cell drains to its lowest-code neighbour of the same
+    # elevation one step closer to the outlet. Remaining zeros are true sinks
+    # (undefined direction, NoData in degrees).
+    nrows, ncols = fdir.shape
+    for r in range(nrows):
+        for c in range(ncols):
+            d = fd_h[r + 1, c + 1]
+            if d < 1 or d >= FLAT_UNRESOLVED:
+                continue
+            for k in range(8):
+                rr = r + 1 + D8_DROW[k]
+                cc = c + 1 + D8_DCOL[k]
+                if z_h[rr, cc] != z_h[r + 1, c + 1]:
+                    continue
+                fv = fd_h[rr, cc]
+                if (d == 1 and fv == FLAT_DEFINED) or (d > 1 and fv == d - 1):
+                    fdir[r, c] = D8_CODES[k]
+                    break
+
+
+def flow_direction(dtm, cellsize):
+    """D8 flow direction of a (filled) DTM, ArcGIS codes 1..128, 0 where undefined.
+
+    Equivalent of arcpy.gp.FlowDirection_sa(DTM, fdir, "NORMAL"). NoData must
+    be NaN. Ties between equally steep neighbours go to the lowest code; flat
+    cells drain towards the nearest cell with a direction.
+    """
+    z_h = np.pad(np.asarray(dtm, dtype=np.float64), 1, constant_values=np.nan)
+    nrows, ncols = z_h.shape[0] - 2, z_h.shape[1] - 2
+    fdir = np.zeros((nrows, ncols), dtype=np.int32)
+    fd = np.zeros((nrows, ncols), dtype=np.int32)
+    _d8_steepest_kernel(z_h, float(cellsize), 0, 0, nrows, ncols, fdir, fd)
+    fd_h = np.pad(fd, 1, constant_values=FLAT_NODATA)
+    del fd
+    _flat_distance_kernel(z_h, fd_h)
+    _flat_assign_kernel(z_h, fd_h, fdir)
+    return fdir
+
+
+def fdir_to_degrees(fdir):
+    """Convert D8 codes to degrees clockwise from north (the fdir_deg raster).
+
+    Same formula as MSF_multiple_points.py:
+    Con(Log2(fdir) < 6, (Log2(fdir) + 2) * 45, (Log2(fdir) - 6) * 45)
+    """
+    fdir = np.asarray(fdir, dtype=np.float64)
+    deg = np.full(fdir.shape, np.nan)
+    valid = fdir > 0
+    lg = np.log2(fdir[valid])
+    deg[valid] = np.where(lg < 6, (lg + 2) * 45.0, (lg - 6) * 45.0)
+    return deg
+
+
+@njit(cache=True)
+def _fill_kernel(z):
+    # Priority-flood depression filling: cells are taken from the border (of
+    # the raster or of NoData) inwards in order of elevation and raised to
+    # the level of their spill
+    nrows, ncols = z.shape
+    done = np.zeros((nrows, ncols), dtype=np.bool_)
+    heap = [(0.0, np.int64(0))]
+    heap.pop()
+    for r in range(nrows):
+        for c in range(ncols):
+            if np.isnan(z[r, c]):
+                done[r, c] = True
+                continue
+            border = r == 0 or c == 0 or r == nrows - 1 or c == ncols - 1
+            for k in range(8):
+                if not border and np.isnan(z[r + D8_DROW[k], c + D8_DCOL[k]]):
+                    border = True
+            if border:
+                done[r, c] = True
+                heapq.heappush(heap, (z[r, c], np.int64(r * ncols + c)))
+    while len(heap) > 0:
+        level, i = heapq.heappop(heap)
+        r = i // ncols
+        c = i - r * ncols
+        for k in range(8):
+            rr = r + D8_DROW[k]
+            cc = c + D8_DCOL[k]
+            if rr < 0 or rr >= nrows or cc < 0 or cc >= ncols or done[rr, cc]:
+                continue
+            done[rr, cc] = True
+            if z[rr, cc] < level:
+                z[rr, cc] = level
+            heapq.heappush(heap, (z[rr, cc], np.int64(rr * ncols + cc)))
+
+
+def fill_depressions(dtm):
+    """Filled copy of a DTM (priority flood, NaN is NoData), as arcpy.sa.Fill."""
+    z = np.array(dtm, dtype=np.float64)
+    _fill_kernel(z)
+    return z
+
+
+# ---------------------------------------------------------------------------
+# Path distance allocation
+# ---------------------------------------------------------------------------
+@njit(cache=True)
+def _horizontal_factor(kind, p0, p1, p2, hfd, move_az):
+    if kind == _HF_NONE:
+        return 1.0
+    if math.isnan(hfd):
+        return math.inf
+    # Horizontal relative moving angle, 0..180 degrees
+    hrma = abs(move_az - hfd) % 360.0
+    if hrma > 180.0:
+        hrma = 360.0 - hrma
+    if kind == _HF_FORWARD:
+        if hrma < 45.0:
+            return p0
+        if hrma < 90.0:
+            return p1
+        return math.inf
+    if kind == _HF_LINEAR:
+        if hrma >= p1:
+            return math.inf
+        return p0 + p2 * hrma
+    # _HF_BINARY
+    if hrma < p1:
+        return p0
+    return math.inf
+
+
+@njit(cache=True)
+def _vertical_pass(r, c, k, vz, cellsize, vf_lo, vf_hi):
+    """True if the vertical relative moving angle of a move is inside the VfBinary cut angles."""
+    dz = vz[r + D8_DROW[k], c + D8_DCOL[k]] - vz[r, c]
+    if math.isnan(dz):
+        return False
+    step = cellsize * SQRT2 if k % 2 == 1 else cellsize
+    vrma = math.degrees(math.atan(dz / step))
+    return vf_lo < vrma < vf_hi
+
+
+@njit(cache=True)
+def _edge_cost(r, c, k, hdir, vz, cellsize, hf_kind, hf0, hf1, hf2, use_vf, vf0, vf_lo, vf_hi):
+    """Cost of moving from (r, c) to its neighbour k, inf if the move is blocked."""
+    rr = r + D8_DROW[k]
+    cc = c + D8_DCOL[k]
+    step = cellsize * SQRT2 if k % 2 == 1 else cellsize
+    az = D8_AZIMUTH[k]
+    ha = _horizontal_factor(hf_kind, hf0, hf1, hf2, hdir[r, c], az)
+    if ha == math.inf:
+        return math.inf
+    hb = _horizontal_factor(hf_kind, hf0, hf1, hf2, hdir[rr, cc], az)
+    if hb == math.inf:
+        return math.inf
+    vf = 1.0
+    if use_vf:
+        if not _vertical_pass(r, c, k, vz, cellsize, vf_lo, vf_hi):
+            return math.inf
+        vf = vf0
+    # Cost = surface distance * (friction_a * HF_a + friction_b * HF_b) / 2 * VF
+    return step * (ha + hb) * 0.5 * vf
+
+
+@njit(cache=True)
+def _path_allocation_kernel(src_r, src_c, src_val, hdir, vz, cellsize,
+                            hf_kind, hf0, hf1, hf2, use_vf, vf0, vf_lo, vf_hi,
+                            max_cost, dist, alloc):
+    nrows, ncols = hdir.shape
+    heap = [(0.0, np.int64(0))]
+    heap.pop()
+    for k in range(src_r.size):
+        r = src_r[k]
+        c = src_c[k]
+        if dist[r, c] > 0.0:
+            dist[r, c] = 0.0
+            alloc[r, c] = src_val[k]
+            heapq.heappush(heap, (0.0, np.int64(r * ncols + c)))
+    visited = 0
+    while len(heap) > 0:
+        d, idx = heapq.heappop(heap)
+        r = idx // ncols
+        c = idx - r * ncols
+        if d > dist[r, c]:
+            continue
+        visited += 1
+        for k in range(8):
+            rr = r + D8_DROW[k]
+            cc = c + D8_DCOL[k]
+            if rr < 0 or rr >= nrows or cc < 0 or cc >= ncols:
+                continue
+            cost = _edge_cost(r, c, k, hdir, vz, cellsize, hf_kind, hf0, hf1, hf2,
+                              use_vf, vf0, vf_lo, vf_hi)
+            nd = d + cost
+            if nd > max_cost:
+                continue
+            if nd < dist[rr, cc]:
+                dist[rr, cc] = nd
+                alloc[rr, cc] = alloc[r, c]
+                heapq.heappush(heap, (nd, np.int64(rr * ncols + cc)))
+    return visited
+
+
+def _check_sources(src_r, src_c, shape):
+    if np.any((src_r < 0) | (src_r >= shape[0]) | (src_c < 0) | (src_c >= shape[1])):
+        raise ValueError("Source cells outside the raster extent")
+
+
+def _as_source_cells(sources):
+    """(rows, cols, values) arrays of a source raster or of a (rows, cols, values) tuple."""
+    if isinstance(sources, tuple):
+        src_r, src_c, src_val = sources
+    else:
+        src_r, src_c, src_val = source_cells(sources)
+    return (np.asarray(src_r, dtype=np.int64), np.asarray(src_c, dtype=np.int64),
+            np.asarray(src_val, dtype=np.float64))
+
+
+def source_cells(sources):
+    """Rows, cols and values of the source cells of a source raster.
+
+    Cells that are NaN or <= 0 are not sources, as in
+    SetNull(Raster(src) <= 0, Raster(src)).
+    """
+    sources = np.asarray(sources, dtype=np.float64)
+    mask = sources > 0  # NaN compares False
+    rows, cols = np.nonzero(mask)
+    return rows.astype(np.int64), cols.astype(np.int64), sources[rows, cols]
+
+
+def most_frequent(rows, cols, values):
+    """One value per cell for points falling in the same cell.
+
+    Same rule as PointToRaster(..., "MOST_FREQUENT"): the most frequent value
+    of the cell, the lowest one on ties. Returns the (rows, cols, values)
+    arrays of the distinct cells, sorted by row and column.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    if rows.size == 0:
+        return rows, cols, values
+    # count every distinct (cell, value) pair
+    order = np.lexsort((values, cols, rows))
+    r, c, v = rows[order], cols[order], values[order]
+    new = np.ones(r.size, dtype=bool)
+    new[1:] = (r[1:] != r[:-1]) | (c[1:] != c[:-1]) | (v[1:] != v[:-1])
+    start = np.flatnonzero(new)
+    counts = np.diff(np.append(start, r.size))
+    r, c, v = r[start], c[start], v[start]
+    # first pair of every cell by decreasing count, then increasing value
+    order = np.lexsort((v, -counts, c, r))
+    r, c, v = r[order], c[order], v[order]
+    first = np.ones(r.size, dtype=bool)
+    first[1:] = (r[1:] != r[:-1]) | (c[1:] != c[:-1])
+    return r[first], c[first], v[first]
+
+
+def path_allocation(sources, hdir, cellsize, hf=HF_LI, vf=None, vertical=None,
+                    max_cost=np.inf):
+    """Anisotropic path distance allocation (ArcGIS PathAllocation without cost
+    and surface rasters).
+
+    sources  : source raster, or a (rows, cols, values) tuple of source cells
+    hdir     : horizontal raster (fdir_deg), degrees clockwise from north;
+               NaN cells are barriers
+    hf       : HfForward / HfLinear / HfBinary
+    vf       : VfBinary, applied only if a vertical raster is given
+    vertical : vertical raster (e.g. the DTM) or None
+    max_cost : accumulated cost beyond which propagation stops
+
+    Returns a PathResult of allocation (source value), distance (accumulated
+    cost), both NaN where unreached, and the number of cells visited.
+    """
+    src_r, src_c, src_val = _as_source_cells(sources)
+    hdir = np.ascontiguousarray(hdir, dtype=np.float64)
+    _check_sources(src_r, src_c, hdir.shape)
+    hf_kind, hf0, hf1, hf2 = _hf_args(hf)
+    use_vf, vf0, vf_lo, vf_hi = _vf_args(vf, vertical)
+    if use_vf:
+        vz = np.ascontiguousarray(vertical, dtype=np.float64)
+    else:
+        vz = np.empty((1, 1))
+    dist = np.full(hdir.shape, np.inf)
+    alloc = np.full(hdir.shape, np.nan)
+    visited = _path_allocation_kernel(src_r, src_c, src_val, hdir, vz, float(cellsize),
+                                      hf_kind, hf0, hf1, hf2, use_vf, vf0, vf_lo, vf_hi,
+                                      float(max_cost), dist, alloc)
+    dist[np.isinf(dist)] = np.nan
+    return PathResult(alloc, dist, visited)
+
+
+# ---------------------------------------------------------------------------
+# MSF model
+# ---------------------------------------------------------------------------
+def msf_calculator(dtm, start_z, li, fri, h_l_threshold):
+    """Raster calculator chain of the MSF model.
+
+    Returns hi, h_l, h_l_lim, pqi, pq_lim (NaN is NoData), with the same
+    epsilon on the denominators as MSF_multiple_points.py.
+    """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        hi = start_z - dtm
+        h_l = hi / (li + EPS)
+        h_l_lim = np.where(h_l >= float(h_l_threshold), h_l, np.nan)
+        pqi = li / (fri + EPS)
+        pq_lim = np.where(np.isnan(h_l_lim), np.nan, pqi)
+    return hi, h_l, h_l_lim, pqi, pq_lim
+
+
+@njit(cache=True)
+def _pq_lim_kernel(dtm, start_z, li, fri, thr, out):
+    nrows, ncols = out.shape
+    for r in range(nrows):
+        for c in range(ncols):
+            l = li[r, c]
+            # h_l >= thr is False for NoData (NaN) cells
+            if (start_z[r, c] - dtm[r, c]) / (l + EPS) >= thr:
+                out[r, c] = l / (fri[r, c] + EPS)
+            else:
+                out[r, c] = np.nan
+
+
+def pq_lim_fused(dtm, start_z, li, fri, h_l_threshold, out=None):
+    """pq_lim straight from start_z, li and fri in a single pass.
+
+    Same values as msf_calculator(...)[-1] without building hi, h_l,
+    h_l_lim and pqi. Writes into out when given.
+    """
+    if out is None:
+        out = np.empty(np.shape(li), dtype=np.float64)
+    _pq_lim_kernel(dtm, start_z, li, fri, float(h_l_threshold), out)
+    return out
+
+
+@njit(cache=True)
+def _pq_max_sparse_kernel(cell, z, start_z, li, fri, thr, pq_max):
+    for i in range(cell.size):
+        l = li[i]
+        if (start_z[i] - z[cell[i]]) / (l + EPS) >= thr:
+            v = l / (fri[i] + EPS)
+            # CellStatistics MAXIMUM, DATA: NoData never wins
+            if not math.isnan(v) and not v <= pq_max[cell[i]]:
+                pq_max[cell[i]] = v
+
+
+def _msf_result(dtm, start_z, li, fri, path_all, h_l_threshold, intermediates):
+    if intermediates:
+        hi, h_l, h_l_lim, pqi, pq_lim = msf_calculator(dtm, start_z, li, fri, h_l_threshold)
+        return MSFResult(start_z, li, fri, path_all, hi, h_l, h_l_lim, pqi, pq_lim)
+    pq_lim = pq_lim_fused(dtm, start_z, li, fri, h_l_threshold)
+    return MSFResult(start_z, li, fri, path_all, None, None, None, None, pq_lim)
+
+
+def run_msf(dtm, sources, fdir_deg, cellsize, h_l_threshold=0.19,
+            hf_li=HF_LI, hf_fri=HF_FRI, vf=VF_MSF, vertical=None, intermediates=True,
+            profiler=None):
+    """Run the full MSF chain for one source raster.
+
+    dtm      : filled DTM, NaN is NoData
+    sources  : source raster (values > 0 are sources, the value is start_z)
+               or a (rows, cols, values) tuple
+    fdir_deg : flow direction in degrees (fdir_to_degrees(flow_direction(dtm)))
+    vertical : vertical raster for VfBinary; None mirrors the "" passed to
+               PathAllocation in MSF_multiple_points.py
+    intermediates : False computes pq_lim with the fused kernel and leaves
+               hi, h_l, h_l_lim and pqi as None
+    profiler : msf_profile.RunProfiler timing the li_pass, fri_pass and
+               calculator stages and counting the cells visited
+
+    Returns an MSFResult with every intermediate raster of the ArcPy pipeline.
+    """
+    dtm = np.asarray(dtm, dtype=np.float64)
+    prof = profiler or msf_profile.NULL
+    # Path Distance Allocation (1): start_z (allocation) and li (distance)
+    with prof.stage("li_pass"):
+        start_z, li, n_li = path_allocation(sources, fdir_deg, cellsize, hf_li, vf, vertical)
+    # Path Distance Allocation (2): PathAll_Sour1 (allocation) and fri (distance)
+    with prof.stage("fri_pass"):
+        path_all, fri, n_fri = path_allocation(sources, fdir_deg, cellsize, hf_fri, vf, vertical)
+    prof.count("li_visited", n_li)
+    prof.count("fri_visited", n_fri)
+    with prof.stage("calculator"):
+        return _msf_result(dtm, start_z, li, fri, path_all, h_l_threshold, intermediates)
+
+
+# ---------------------------------------------------------------------------
+# Bounded propagation (H/L threshold pruning)
+# ---------------------------------------------------------------------------
+# A cell survives Con(h_l >= H_L_threshold) only if
+#     li <= (start_z - z) / H_L_threshold <= (start_z - z_min) / H_L_threshold
+# so the li front can stop there. The cost of every step per unit length lies
+# between the smallest and largest finite factor (HF * VF), which bounds the
+# geometric length of the paths and the fri cost of the surviving cells.
+Window = namedtuple("Window", "row_off col_off nrows ncols")
+
+
+def window_slices(window):
+    """Row and column slices of a Window."""
+    return (slice(window.row_off, window.row_off + window.nrows),
+            slice(window.col_off, window.col_off + window.ncols))
+
+
+def _factor_range(hf):
+    """Smallest and largest finite HF and the HRMA from which HF is infinite."""
+    kind, p0, p1, p2 = _hf_args(hf)
+    if kind == _HF_NONE:
+        return 1.0, 1.0, math.inf
+    if kind == _HF_FORWARD:
+        return min(p0, p1), max(p0, p1), 90.0
+    cutoff = p1 if p1 <= 180.0 else math.inf
+    if kind == _HF_LINEAR:
+        ends = (p0, p0 + p2 * min(p1, 180.0))
+        return min(ends), max(ends), cutoff
+    return p0, p0, cutoff
+
+
+def propagation_bounds(start_z, z_min, h_l_threshold, hf_li=HF_LI, hf_fri=HF_FRI,
+                       vf=VF_MSF, vertical=None):
+    """Largest li and fri costs and distance from the source that can still matter.
+
+    Returns (li_max, fri_max, radius); any cell farther than these cannot pass
+    the H/L threshold, so stopping the fronts there leaves pq_lim unchanged.
+    Unbounded values are inf: always for thresholds <= 0, and for fri when
+    the two horizontal factors do not block the same moves (the fri path of
+    a surviving cell can then be arbitrarily long).
+    """
+    thr = float(h_l_threshold)
+    lo_li, hi_li, cut_li = _factor_range(hf_li)
+    lo_fri, hi_fri, cut_fri = _factor_range(hf_fri)
+    use_vf, vf0, _, _ = _vf_args(vf, vertical)
+    if use_vf:
+        lo_li, lo_fri, hi_fri = lo_li * vf0, lo_fri * vf0, hi_fri * vf0
+    if thr <= 0 or lo_li <= 0:
+        return math.inf, math.inf, math.inf
+    # small relative slack so that rounding never drops a boundary cell
+    li_max = max(float(start_z) - float(z_min), 0.0) / thr * (1.0 + 1e-9)
+    length = li_max / lo_li
+    if cut_li != cut_fri or lo_fri <= 0:
+        return li_max, math.inf, math.inf
+    fri_max = hi_fri * length * (1.0 + 1e-9)
+    return li_max, fri_max, max(length, fri_max / lo_fri)
+
+
+def msf_window(dtm, src_r, src_c, start_z, cellsize, h_l_threshold, hf_li=HF_LI,
+               hf_fri=HF_FRI, vf=VF_MSF, vertical=None, z_min=None):
+    """Window and cost bounds of the MSF run of a group of source cells.
+
+    Returns (window, li_max, fri_max); window is None when the propagation
+    cannot be bounded. The DTM minimum inside the first window is used to
+    shrink it again (every surviving cell lies inside it).
+    """
+    nrows, ncols = dtm.shape
+    if z_min is None:
+        z_min = np.nanmin(dtm)
+    top = float(np.max(start_z))
+    window = None
+    for _ in range(3):
+        li_max, fri_max, radius = propagation_bounds(top, z_min, h_l_threshold,
+                                                     hf_li, hf_fri, vf, vertical)
+        if not np.isfinite(radius):
+            return None, li_max, fri_max
+        k = int(math.ceil(radius / float(cellsize)))
+        r0 = max(int(src_r.min()) - k, 0)
+        c0 = max(int(src_c.min()) - k, 0)
+        r1 = min(int(src_r.max()) + k + 1, nrows)
+        c1 = min(int(src_c.max()) + k + 1, ncols)
+        window = Window(r0, c0, r1 - r0, c1 - c0)
+        with np.errstate(invalid="ignore"):
+            z_win = np.nanmin(dtm[r0:r1, c0:c1])
+        if not z_win > z_min:
+            break
+        z_min = z_win
+    return window, li_max, fri_max
+
+
+def run_msf_bounded(dtm, sources, fdir_deg, cellsize, h_l_threshold=0.19,
+                    hf_li=HF_LI, hf_fri=HF_FRI, vf=VF_MSF, vertical=None, z_min=None,
+                    intermediates=True, profiler=None, region=None):
+    """run_msf cropped to the window the sources can reach.
+
+    Returns (result, window): result is an MSFResult covering only the window
+    (window_slices(window) places it in the full extent). pq_lim and h_l_lim
+    are the same as with run_msf; li, fri and the other intermediates are
+    NoData beyond the bounds. z_min (the DTM minimum) can be passed to avoid
+    scanning the whole DTM for every source. profiler: as in run_msf, plus
+    the window stage.
+
+    region : optional (Window, mask) restricting the propagation to the True
+             cells of mask (a boolean array covering Window), e.g. the search
+             region of msf_pyramid. Cells outside are impassable (as NoData
+             in fdir_deg), so pq_lim may differ from the unrestricted one.
+    """
+    dtm = np.asarray(dtm, dtype=np.float64)
+    prof = profiler or msf_profile.NULL
+    src_r, src_c, src_val = _as_source_cells(sources)
+    _check_sources(src_r, src_c, dtm.shape)
+    with prof.stage("window"):
+        window, li_max, fri_max = msf_window(dtm, src_r, src_c, src_val, cellsize, h_l_threshold,
+                                             hf_li, hf_fri, vf, vertical, z_min)
+    if window is None:
+        window = Window(0, 0, dtm.shape[0], dtm.shape[1])
+    if region is not None:
+        reg, mask = region
+        r0, c0 = max(window.row_off, reg.row_off), max(window.col_off, reg.col_off)
+        r1 = min(window.row_off + window.nrows, reg.row_off + reg.nrows)
+        c1 = min(window.col_off + window.ncols, reg.col_off + reg.ncols)
+        window = Window(r0, c0, max(r1 - r0, 0), max(c1 - c0, 0))
+        mask = mask[r0 - reg.row_off:r1 - reg.row_off, c0 - reg.col_off:c1 - reg.col_off]
+    rows, cols = window_slices(window)
+    dtm_w = dtm[rows, cols]
+    hdir_w = np.asarray(fdir_deg)[rows, cols]
+    if region is not None:
+        hdir_w = np.where(mask, hdir_w, np.nan)
+    vertical_w = None if vertical is None else np.asarray(vertical)[rows, cols]
+    src_w = (src_r - window.row_off, src_c - window.col_off, src_val)
+    with prof.stage("li_pass"):
+        start_z, li, n_li = path_allocation(src_w, hdir_w, cellsize, hf_li, vf, vertical_w, li_max)
+    with prof.stage("fri_pass"):
+        path_all, fri, n_fri = path_allocation(src_w, hdir_w, cellsize, hf_fri, vf, vertical_w, fri_max)
+    prof.count("li_visited", n_li)
+    prof.count("fri_visited", n_fri)
+    with prof.stage("calculator"):
+        result = _msf_result(dtm_w, start_z, li, fri, path_all, h_l_threshold, intermediates)
+    return result, window
+
+
+# ---------------------------------------------------------------------------
+# Multi-source MSF (one labelled propagation for many sources)
+# ---------------------------------------------------------------------------
+@njit(cache=True)
+def _labelled_kernel(src_cell, hdir, vz, cellsize, hf_kind, hf0, hf1, hf2,
+                     use_vf, vf0, vf_lo, vf_hi, max_cost):
+    # Every source (label) spreads its own front through a shared priority
+    # queue; costs are kept per (label, cell) key so the fronts never interact
+    # and each label gets exactly the distances of a single-source run.
+    nrows, ncols = hdir.shape
+    ncells = nrows * ncols
+    best = dict()
+    heap = [(0.0, np.int64(0), np.int64(0))]
+    heap.pop()
+    for lab in range(src_cell.size):
+        best[lab * ncells + src_cell[lab]] = 0.0
+        heapq.heappush(heap, (0.0, np.int64(src_cell[lab]), np.int64(lab)))
+    out_keys = np.empty(1024, dtype=np.int64)
+    out_cost = np.empty(1024, dtype=np.float64)
+    n = 0
+    while len(heap) > 0:
+        d, idx, lab = heapq.heappop(heap)
+        key = lab * ncells + idx
+        if d > best[key]:
+            continue
+        if n == out_keys.size:
+            out_keys = np.concatenate((out_keys, np.empty(n, dtype=np.int64)))
+            out_cost = np.concatenate((out_cost, np.empty(n, dtype=np.float64)))
+        out_keys[n] = key
+        out_cost[n] = d
+        n += 1
+        r = idx // ncols
+        c = idx - r * ncols
+        for k in range(8):
+            rr = r + D8_DROW[k]
+            cc = c + D8_DCOL[k]
+            if rr < 0 or rr >= nrows or cc < 0 or cc >= ncols:
+                continue
+            nd = d + _edge_cost(r, c, k, hdir, vz, cellsize, hf_kind, hf0, hf1, hf2,
+                                use_vf, vf0, vf_lo, vf_hi)
+            if nd > max_cost[lab]:
+                continue
+            nkey = lab * ncells + rr * ncols + cc
+            if nkey not in best or nd < best[nkey]:
+                best[nkey] = nd
+                heapq.heappush(heap, (nd, np.int64(rr * ncols + cc), lab))
+    return out_keys[:n], out_cost[:n]
+
+
+def labelled_distances(src_rows, src_cols, hdir, cellsize, hf=HF_LI, vf=None,
+                       vertical=None, max_cost=np.inf):
+    """Path distances of several sources in one labelled propagation.
+
+    Returns (keys, cost) for every (label, cell) reached, sorted by key, with
+    key = label * hdir.size + row * ncols + col and label the position of the
+    source in src_rows / src_cols. max_cost is a scalar or one bound per source.
+    """
+    hdir = np.ascontiguousarray(hdir, dtype=np.float64)
+    hf_kind, hf0, hf1, hf2 = _hf_args(hf)
+    use_vf, vf0, vf_lo, vf_hi = _vf_args(vf, vertical)
+    if use_vf:
+        vz = np.ascontiguousarray(vertical, dtype=np.float64)
+    else:
+        vz = np.empty((1, 1))
+    src_rows = np.asarray(src_rows, dtype=np.int64)
+    src_cols = np.asarray(src_cols, dtype=np.int64)
+    _check_sources(src_rows, src_cols, hdir.shape)
+    src_cell = src_rows * hdir.shape[1] + src_cols
+    max_cost = np.broadcast_to(np.asarray(max_cost, dtype=np.float64), src_cell.shape).copy()
+    keys, cost = _labelled_kernel(src_cell, hdir, vz, float(cellsize), hf_kind, hf0, hf1, hf2,
+                                  use_vf, vf0, vf_lo, vf_hi, max_cost)
+    order = np.argsort(keys, kind="stable")
+    return keys[order], cost[order]
+
+
+def run_msf_multi(dtm, sources, fdir_deg, cellsize, h_l_threshold=0.19,
+                  hf_li=HF_LI, hf_fri=HF_FRI, vf=VF_MSF, vertical=None,
+                  batch_size=1024, bounded=True, z_min=None, checkpoint=None, resume=None,
+                  profiler=None):
+    """Combined (per-cell maximum) pq_lim of many sources without per-source rasters.
+
+    Same result as running run_msf on each source cell on its own and taking
+    CellStatistics(MAXIMUM, DATA) of the pq_lim rasters. Sources are given as
+    a source raster (e.g. ras_src_all.tif, one source per cell > 0) or a
+    (rows, cols, values) tuple; they are propagated in labelled passes of
+    batch_size sources to bound memory. With bounded=True every front stops
+    at the cost beyond which no cell can pass the H/L threshold
+    (see propagation_bounds).
+
+    checkpoint : callable(n, pq_max) called after every batch with the number
+                 of sources done and the running maximum (flat, float64)
+    resume     : (n, pq_max) of a checkpoint of the same run to continue from
+    profiler   : msf_profile.RunProfiler (li_pass, fri_pass, calculator stages)
+    """
+    prof = profiler or msf_profile.NULL
+    dtm = np.asarray(dtm, dtype=np.float64)
+    src_r, src_c, src_val = _as_source_cells(sources)
+    li_max = np.full(src_val.shape, np.inf)
+    fri_max = np.full(src_val.shape, np.inf)
+    if bounded:
+        if z_min is None:
+            z_min = np.nanmin(dtm)
+        for i, value in enumerate(src_val):
+            li_max[i], fri_max[i], _ = propagation_bounds(value, z_min, h_l_threshold,
+                                                          hf_li, hf_fri, vf, vertical)
+    ncells = dtm.size
+    z = np.ascontiguousarray(dtm).ravel()
+    pq_max = np.full(ncells, np.nan)
+    first = 0
+    if resume is not None:
+        first = int(resume[0])
+        pq_max[:] = np.asarray(resume[1]).ravel()
+    for start in range(first, src_r.size, int(batch_size)):
+        sl = slice(start, start + int(batch_size))
+        with prof.stage("li_pass"):
+            keys_li, li = labelled_distances(src_r[sl], src_c[sl], fdir_deg, cellsize,
+                                             hf_li, vf, vertical, li_max[sl])
+        with prof.stage("fri_pass"):
+            keys_fri, fri = labelled_distances(src_r[sl], src_c[sl], fdir_deg, cellsize,
+                                               hf_fri, vf, vertical, fri_max[sl])
+        prof.count("li_visited", keys_li.size)
+        prof.count("fri_visited", keys_fri.size)
+        with prof.stage("calculator"):
+            keys, i_li, i_fri = np.intersect1d(keys_li, keys_fri, assume_unique=True,
+                                               return_indices=True)
+            _pq_max_sparse_kernel(keys % ncells, z, src_val[sl][keys // ncells], li[i_li],
+                                  fri[i_fri], float(h_l_threshold), pq_max)
+        if checkpoint is not None:
+            checkpoint(min(start + int(batch_size), src_r.size), pq_max)
+    return pq_max.reshape(dtm.shape)
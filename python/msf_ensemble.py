@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+
+"""
+Monte Carlo ensemble of MSF runs under DTM and parameter uncertainty.
+
+Members combine n_dtm DTM realizations (the DTM plus a spatially correlated
+Gaussian error field, filled again) with sampled H_L_threshold values and
+fri horizontal factors. The members of one DTM realization are run in
+batches of msf_sweep.run_sweep: flow direction is computed once per
+realization, li and fri once per source and batch of fri factors, and
+every threshold only changes the final mask. Without DTM error there is a
+single realization on the cached grids (and propagation graphs).
+
+The combined pq_lim of each member is added to per-cell counters as soon
+as it is complete (msf_sweep.sweep_members) and discarded, so memory does
+not grow with the number of members: exceedance counts per level give
+P(pq_lim >= level) exactly, and a histogram of pq_lim per cell (bins over
+the range pq_lim can take) gives the percentiles, to the bin width. The
+counters are only kept for the cells some member reaches.
+"""
+# Name: msf_ensemble.py
+# Description: Monte Carlo ensemble (correlated DTM error fields, sampled
+#              thresholds and factors) run in batches per DTM realization,
+#              with streaming exceedance probability and percentile rasters.
+
+import math
+from collections import namedtuple
+
+import numpy as np
+
+import msf_engine
+import msf_sweep
+
+Member = namedtuple("Member", "realization h_l_threshold hf_fri")
+
+
+def stratified(lo, hi, n, rng):
+    """n samples of the uniform distribution on [lo, hi], one in each of n
+    equal-probability strata (Latin hypercube), in random order. A single
+    sample is the midpoint."""
+    if n <= 1:
+        return [0.5 * (float(lo) + float(hi))]
+    u = (np.arange(n) + rng.random(n)) / n
+    return (float(lo) + (float(hi) - float(lo)) * rng.permutation(u)).tolist()
+
+
+def noise_field(shape, cellsize, sd, corr_length, rng):
+    """Gaussian random field of zero mean and standard deviation sd with
+    correlation exp(-(h / corr_length)^2) at distance h (metres)."""
+    # white noise smoothed with a Gaussian kernel of standard deviation
+    # corr_length / 2 has that correlation; the padding avoids the
+    # wrap-around of the FFT convolution
+    sigma = 0.5 * float(corr_length) / float(cellsize)
+    pad = int(math.ceil(3.0 * sigma))
+    white = rng.standard_normal((shape[0] + 2 * pad, shape[1] + 2 * pad))
+    if sigma > 0:
+        fy = np.fft.fftfreq(white.shape[0])[:, None]
+        fx = np.fft.rfftfreq(white.shape[1])[None, :]
+        gain = np.exp(-2.0 * (math.pi * sigma) ** 2 * (fx ** 2 + fy ** 2))
+        white = np.fft.irfft2(np.fft.rfft2(white) * gain, s=white.shape)
+    field = white[pad:pad + shape[0], pad:pad + shape[1]]
+    return field * (float(sd) / field.std())
+
+
+def pq_range(hf_li, hf_fri_list):
+    """Smallest and largest pq_lim = li / fri the factors allow (the vertical
+    factor multiplies both passes and cancels); inf when unbounded. The
+    smallest is 0, the pq_lim of the source cells (li = 0)."""
+    _, hi_li, _ = msf_engine._factor_range(hf_li)
+    hi = 0.0
+    for hf_fri in hf_fri_list:
+        lo_fri, _, _ = msf_engine._factor_range(hf_fri)
+        hi = max(hi, hi_li / lo_fri if lo_fri > 0 else math.inf)
+    return 0.0, hi
+
+
+def _grow(arr, size):
+    """Copy of arr with size rows, the new rows zero."""
+    out = np.zeros((size,) + arr.shape[1:], dtype=arr.dtype)
+    out[:arr.shape[0]] = arr
+    return out
+
+
+class EnsembleStats:
+    """Per-cell statistics of the members' pq_lim, updated one member at a time.
+
+    levels : pq_lim levels of the exceedance counts (a level <= 0 counts the
+             members reaching the cell)
+    edges  : histogram bin edges of pq_lim (values outside go to the first
+             or last bin)
+    Memory: one int32 per cell, plus (len(levels) + len(edges) - 1)
+    counters (uint16 up to 65535 members, uint32 above) per cell reached by
+    at least one member.
+    """
+
+    def __init__(self, shape, levels, edges, n_max=65535):
+        self.shape = tuple(shape)
+        self.levels = [float(v) for v in levels]
+        self.edges = np.asarray(edges, dtype=np.float64)
+        dtype = np.uint16 if n_max <= np.iinfo(np.uint16).max else np.uint32
+        # row of every reached cell in exceed and hist (-1: never reached),
+        # rows added in the order the cells are first reached
+        self.row = np.full(self.shape[0] * self.shape[1], -1, dtype=np.int32)
+        self.cells = np.zeros(0, dtype=np.int64)
+        self.n_cells = 0
+        self.exceed = np.zeros((0, len(self.levels)), dtype=dtype)
+        self.hist = np.zeros((0, self.edges.size - 1), dtype=dtype)
+        self.n = 0
+
+    def _rows(self, cells):
+        """Rows of cells in exceed and hist, added for the cells reached for the first time."""
+        new = cells[self.row[cells] < 0]
+        end = self.n_cells + new.size
+        if end > self.cells.size:
+            # the capacity doubles, so the copies cost O(cells reached) overall
+            size = max(end, 2 * self.cells.size)
+            self.cells = _grow(self.cells, size)
+            self.exceed = _grow(self.exceed, size)
+            self.hist = _grow(self.hist, size)
+        self.row[new] = np.arange(self.n_cells, end)
+        self.cells[self.n_cells:end] = new
+        self.n_cells = end
+        return self.row[cells]
+
+    def add(self, pq_lim):
+        """Add the pq_lim raster (NaN where not reached) of one member."""
+        pq = np.asarray(pq_lim).reshape(-1)
+        cells = np.flatnonzero(~np.isnan(pq))
+        values = pq[cells]
+        rows = self._rows(cells)
+        for k, level in enumerate(self.levels):
+            self.exceed[rows[values >= level], k] += 1
+        b = np.clip(np.searchsorted(self.edges, values, side="right") - 1, 0, self.edges.size - 2)
+        self.hist[rows, b] += 1  # cells are unique within a member
+        self.n += 1
+
+    def _raster(self, values):
+        """float32 raster of the values of the reached cells, NaN elsewhere."""
+        out = np.full(self.row.size, np.nan, dtype=np.float32)
+        out[self.cells[:self.n_cells]] = values
+        return out.reshape(self.shape)
+
+    def exceedance(self, k):
+        """Probability that pq_lim >= levels[k] (float32 raster)."""
+        out = self._raster(self.exceed[:self.n_cells, k] / float(max(self.n, 1)))
+        out[np.isnan(out)] = 0.0
+        return out
+
+    def percentile(self, q, block=65536):
+        """q-th percentile (0 < q <= 100) of pq_lim, members not reaching a cell
+        counting as below every value: NaN where more than 100 - q % of the
+        members do not reach the cell. Interpolated within the histogram bins."""
+        out = np.full(self.n_cells, np.nan, dtype=np.float32)
+        rank = float(q) / 100.0 * self.n
+        width = np.diff(self.edges)
+        for start in range(0, self.n_cells, block):
+            h = self.hist[start:min(start + block, self.n_cells)].astype(np.int64)
+            cum = np.cumsum(h, axis=1)
+            below = self.n - cum[:, -1]  # members not reaching the cell
+            ok = np.flatnonzero(below < rank)
+            if not ok.size:
+                continue
+            cum = cum[ok] + below[ok, None]
+            b = np.argmax(cum >= rank, axis=1)
+            count = h[ok, b]
+            before = cum[np.arange(ok.size), b] - count
+            frac = np.clip((rank - before) / np.maximum(count, 1), 0.0, 1.0)
+            out[start + ok] = self.edges[b] + frac * width[b]
+        return self._raster(out)
+
+
+def run_ensemble(grids, sources, thresholds, hf_fri_list, n_dtm=1, dtm_sd=0.0, dtm_corr=0.0,
+                 hf_li=msf_engine.HF_LI, vf=msf_engine.VF_MSF, use_vertical_raster=False, bounded=True,
+                 levels=(0.0,), bins=64, seed=0, graphs=None, max_rasters=None, log=print):
+    """Run the members (DTM realization x fri factor x threshold) and return
+    (EnsembleStats, list of Member).
+
+    grids       : msf_cache.DTMGrids of the DTM
+    sources     : list of (fid, row, col, value)
+    thresholds  : H_L_threshold samples, hf_fri_list: fri horizontal factor samples
+    n_dtm       : DTM realizations with an error field of standard deviation
+                  dtm_sd and correlation length dtm_corr (metres); the source
+                  values (start_z) move with the DTM at their cell
+    graphs      : dict (hf, vf) -> msf_graph.Graph of the unperturbed DTM,
+                  used when dtm_sd is 0 (see msf_sweep.run_sweep)
+    max_rasters : member rasters computed together (see
+                  msf_sweep.sweep_members; default one fri factor at a time)
+    """
+    if dtm_sd <= 0:
+        n_dtm = 1
+    cases = msf_sweep.sweep_cases([hf_li], hf_fri_list, [vf])
+    lo, hi = pq_range(hf_li, hf_fri_list)
+    if not math.isfinite(hi):
+        hi = 10.0 * max(lo, 1.0)
+        log("  Warning: pq_lim is not bounded by the factors, histogram up to {}".format(hi))
+    n_members = n_dtm * len(cases) * len(thresholds)
+    stats = EnsembleStats(grids.dtm.shape, levels, np.linspace(lo, hi, int(bins) + 1), n_members)
+    members = []
+    for r in range(n_dtm):
+        if dtm_sd > 0:
+            rng = np.random.default_rng([int(seed), r])
+            dtm = msf_engine.fill_depressions(grids.dtm + noise_field(grids.dtm.shape, grids.cellsize,
+                                                                      dtm_sd, dtm_corr, rng))
+            fdir_deg = msf_engine.fdir_to_degrees(msf_engine.flow_direction(dtm, grids.cellsize))
+            shift = dtm - grids.dtm
+            run_sources = [(fid, row, col, value + shift[row, col]) for fid, row, col, value in sources]
+            z_min, run_graphs = float(np.nanmin(dtm)), None
+        else:
+            dtm, fdir_deg, run_sources = grids.dtm, grids.fdir_deg, sources
+            z_min, run_graphs = grids.z_min, graphs
+        log("  DTM realization {}/{}: {} members".format(r + 1, n_dtm, len(cases) * len(thresholds)))
+        for i, j, pq_max in msf_sweep.sweep_members(dtm, fdir_deg, grids.cellsize, run_sources, thresholds,
+                                                    cases, dtm if use_vertical_raster else None, bounded,
+                                                    z_min, lambda msg: None, run_graphs, max_rasters):
+            stats.add(pq_max)
+            members.append(Member(r, float(thresholds[j]), cases[i].hf_fri))
+    return stats, members
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+
+"""
+Sparse per-source pq_lim footprints.
+
+A footprint keeps only the cells a source reaches (flat cell indices in the
+DTM and float32 pq_lim values) and their bounding window, instead of a
+full-extent raster that is almost entirely NoData. The combined maximum of
+many footprints, the Id of the source giving the maximum in every cell and
+the number of overlapping sources are built in one streaming pass.
+"""
+# Name: msf_footprints.py
+# Description: Sparse pq_lim footprints, their on-disk format and the
+#              streaming max / argmax / overlap count reduction.
+
+from collections import namedtuple
+
+import numpy as np
+
+from msf_engine import Window
+
+Footprint = namedtuple("Footprint", "cells values window")
+
+
+def from_cells(cells, values, ncols):
+    """Footprint of flat cell indices (raster of ncols columns) and pq_lim values."""
+    cells = np.asarray(cells, dtype=np.int64)
+    bbox = None
+    if cells.size:
+        rows, cols = np.divmod(cells, ncols)
+        bbox = Window(int(rows.min()), int(cols.min()), int(rows.max() - rows.min() + 1),
+                      int(cols.max() - cols.min() + 1))
+    return Footprint(cells, np.asarray(values, dtype=np.float32), bbox)
+
+
+def footprint(pq_lim, window, shape):
+    """Footprint of the valid cells of a pq_lim array covering window of a
+    raster of the given shape (window_slices(window) places pq_lim in it)."""
+    rows, cols = np.nonzero(~np.isnan(pq_lim))
+    cells = (rows + window.row_off).astype(np.int64) * shape[1] + cols + window.col_off
+    return from_cells(cells, pq_lim[rows, cols], shape[1])
+
+
+def crop(fp, window, shape):
+    """Part of a footprint inside window of a raster of the given shape, with
+    cell indices of the window (nrows x ncols raster); None if fp is None."""
+    if fp is None:
+        return None
+    rows, cols = np.divmod(fp.cells, shape[1])
+    rows, cols = rows - window.row_off, cols - window.col_off
+    inside = (rows >= 0) & (rows < window.nrows) & (cols >= 0) & (cols < window.ncols)
+    return from_cells(rows[inside] * window.ncols + cols[inside], fp.values[inside], window.ncols)
+
+
+def save(path, fp, shape):
+    """Write a footprint to a compressed .npz file.
+
+    Cells are stored relative to the bounding window: uint32 (with the
+    float32 values, 8 bytes per reached cell before compression), uint64
+    when the window has more cells than uint32 can index (12 bytes).
+    """
+    if fp.window is None:
+        local = np.zeros(0, dtype=np.uint32)
+        window = np.zeros(0, dtype=np.int64)
+    else:
+        rows, cols = np.divmod(fp.cells, shape[1])
+        big = fp.window.nrows * fp.window.ncols > np.iinfo(np.uint32).max
+        local = ((rows - fp.window.row_off) * fp.window.ncols + cols - fp.window.col_off).astype(
+            np.uint64 if big else np.uint32)
+        window = np.array(fp.window, dtype=np.int64)
+    np.savez_compressed(path, cells=local, values=np.asarray(fp.values, dtype=np.float32),
+                        window=window, shape=np.array(shape, dtype=np.int64))
+
+
+def load(path):
+    """Read a footprint written by save()."""
+    with np.load(path) as data:
+        local, values, window = data["cells"], data["values"], data["window"]
+        ncols = int(data["shape"][1])
+    if window.size == 0:
+        return Footprint(np.zeros(0, dtype=np.int64), values, None)
+    window = Window(*(int(v) for v in window))
+    rows, cols = np.divmod(local.astype(np.int64), window.ncols)
+    cells = (rows + window.row_off) * ncols + cols + window.col_off
+    return Footprint(cells, values, window)
+
+
+def reduce_footprints(footprints, shape):
+    """Combined maximum, winning source and overlap count of many footprints.
+
+    footprints : iterable of (fid, Footprint); read one at a time, so a
+                 generator loading them from disk keeps memory bounded
+    shape      : shape of the DTM
+
+    Returns (pq_max, src_id, count, n): pq_max float32 (NaN where no source
+    arrives, same as CellStatistics MAXIMUM, DATA), src_id float64 with the
+    Id of the source giving pq_max (the first one in input order on ties),
+    count int32 with the number of sources reaching each cell, n the number
+    of footprints combined. Footprints given as None are skipped.
+    """
+    size = int(shape[0]) * int(shape[1])
+    pq_max = np.full(size, np.nan, dtype=np.float32)
+    src_id = np.full(size, np.nan)
+    count = np.zeros(size, dtype=np.int32)
+    n = 0
+    for fid, fp in footprints:
+        if fp is None:
+            continue
+        current = pq_max[fp.cells]
+        better = ~(fp.values <= current)  # NaN (no value yet) compares False
+        pq_max[fp.cells[better]] = fp.values[better]
+        src_id[fp.cells[better]] = fid
+        count[fp.cells] += 1
+        n += 1
+    return pq_max.reshape(shape), src_id.reshape(shape), count.reshape(shape), n
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+
+"""
+Precomputed propagation graph of a DTM.
+
+Every PathAllocation call evaluates the same moves again: the D8 step, the
+horizontal factor from fdir_deg at both ends and the VfBinary slope gate.
+The graph keeps the moves that the horizontal factor does not block as a
+compressed sparse row (CSR) adjacency: for every cell (row * ncols + col)
+the edges indptr[cell]:indptr[cell + 1] with the neighbour cell, the D8
+direction (edge length = msf_cache.neighbour_distances(cellsize)[direction]),
+the horizontal cost step * (HF_a + HF_b) / 2 and the vertical pass/fail
+mask. The arrays are saved as .npy files (in the DTM grid cache) and memory
+mapped, so all sources, sweeps, reruns and worker processes share one copy.
+Distances are identical to the ones of path_allocation.
+"""
+# Name: msf_graph.py
+# Description: CSR propagation graph (edges, lengths, horizontal factor
+#              costs, vertical mask) built once per DTM and factor, and the
+#              MSF run of one source on it.
+
+import os
+import json
+import math
+import heapq
+import atexit
+import shutil
+import hashlib
+import tempfile
+from collections import namedtuple
+
+import numpy as np
+
+import msf_engine
+import msf_footprints
+import msf_profile
+from msf_engine import njit, D8_DROW, D8_DCOL
+
+Graph = namedtuple("Graph", "indptr indices direction hcost vpass shape use_vf vf0 folder")
+
+_ARRAYS = ("indptr", "indices", "direction", "hcost", "vpass")
+
+
+@njit(cache=True)
+def _graph_kernel(hdir, vz, cellsize, hf_kind, hf0, hf1, hf2, use_vf, vf_lo, vf_hi,
+                  count_only, indptr, indices, direction, hcost, vpass):
+    # First call (count_only): number of edges of every cell in indptr[1:].
+    # Second call: edges written in cell order, D8 code order inside a cell.
+    nrows, ncols = hdir.shape
+    e = 0
+    for r in range(nrows):
+        for c in range(ncols):
+            n = 0
+            for k in range(8):
+                rr = r + D8_DROW[k]
+                cc = c + D8_DCOL[k]
+                if rr < 0 or rr >= nrows or cc < 0 or cc >= ncols:
+                    continue
+                h = msf_engine._edge_cost(r, c, k, hdir, vz, cellsize, hf_kind, hf0, hf1, hf2,
+                                          False, 1.0, -90.0, 90.0)
+                if h == math.inf:
+                    continue
+                n += 1
+                if count_only:
+                    continue
+                indices[e] = rr * ncols + cc
+                direction[e] = k
+                hcost[e] = h
+                vpass[e] = (not use_vf) or msf_engine._vertical_pass(r, c, k, vz, cellsize,
+                                                                     vf_lo, vf_hi)
+                e += 1
+            if count_only:
+                indptr[r * ncols + c + 1] = n
+
+
+def graph_key(dtm_key, hf, vf=None, use_vertical_raster=False):
+    """Cache key of the graph of a DTM for a horizontal (and vertical) factor."""
+    params = dict(graph=1, dtm=dtm_key, hf=[type(hf).__name__] + [float(v) for v in hf],
+                  vf=[type(vf).__name__] + [float(v) for v in vf] if use_vertical_raster and vf else None)
+    return hashlib.blake2b(json.dumps(params, sort_keys=True).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def build_graph(folder, fdir_deg, cellsize, hf, vf=None, vertical=None):
+    """Build the graph of a horizontal raster and factors into folder (.npy files)."""
+    hdir = np.asarray(fdir_deg, dtype=np.float64)
+    shape = hdir.shape
+    hf_kind, hf0, hf1, hf2 = msf_engine._hf_args(hf)
+    use_vf, vf0, vf_lo, vf_hi = msf_engine._vf_args(vf, vertical)
+    vz = np.asarray(vertical, dtype=np.float64) if use_vf else np.empty((1, 1))
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    def create(name, dtype, size):
+        return np.lib.format.open_memmap(os.path.join(folder, name + ".npy"), mode="w+",
+                                         dtype=dtype, shape=(size,))
+
+    indptr = create("indptr", np.int64, hdir.size + 1)
+    indptr[0] = 0
+    dummy = np.empty(0, dtype=np.int64)
+    _graph_kernel(hdir, vz, float(cellsize), hf_kind, hf0, hf1, hf2, use_vf, vf_lo, vf_hi, True,
+                  indptr, dummy, dummy.astype(np.uint8), dummy.astype(np.float64),
+                  dummy.astype(np.bool_))
+    np.cumsum(indptr, out=indptr)
+    n_edges = int(indptr[-1])
+    arrays = dict(indices=create("indices", np.int64, n_edges),
+                  direction=create("direction", np.uint8, n_edges),
+                  hcost=create("hcost", np.float64, n_edges),
+                  vpass=create("vpass", np.bool_, n_edges))
+    _graph_kernel(hdir, vz, float(cellsize), hf_kind, hf0, hf1, hf2, use_vf, vf_lo, vf_hi, False,
+                  indptr, arrays["indices"], arrays["direction"], arrays["hcost"], arrays["vpass"])
+    for arr in [indptr] + list(arrays.values()):
+        arr.flush()
+    meta = dict(shape=list(shape), use_vf=bool(use_vf), vf0=vf0, n_edges=n_edges)
+    with open(os.path.join(folder, "graph.json"), "w") as f:
+        json.dump(meta, f)
+    return meta
+
+
+def load_graph(folder):
+    """Memory-mapped Graph saved by build_graph."""
+    with open(os.path.join(folder, "graph.json")) as f:
+        meta = json.load(f)
+    arrays = dict((name, np.load(os.path.join(folder, name + ".npy"), mmap_mode="r"))
+                  for name in _ARRAYS)
+    return Graph(shape=tuple(meta["shape"]), use_vf=meta["use_vf"], vf0=meta["vf0"], folder=folder,
+                 **arrays)
+
+
+def graph_for(grids, hf, vf=None, use_vertical_raster=False, cache=None, log=print):
+    """Graph of a DTM (msf_cache.DTMGrids) for one factor setting.
+
+    With a cache (msf_cache.GridCache) the graph is built once and stored
+    next to the DTM grids; later runs and other processes map the same
+    files. Without a cache it is built in a temporary folder, removed at exit.
+    """
+    vertical = grids.dtm if use_vertical_raster else None
+    if cache is None:
+        folder = tempfile.mkdtemp(prefix="msf_graph_")
+        atexit.register(shutil.rmtree, folder, True)
+        build_graph(folder, grids.fdir_deg, grids.cellsize, hf, vf, vertical)
+        return load_graph(folder)
+    key = graph_key(grids.key, hf, vf, use_vertical_raster)
+    folder = cache.open_entry(key)
+    cache.count("graphs", folder is not None)
+    if folder is None:
+        log("  Building propagation graph ({}): {}".format(type(hf).__name__, key))
+        tmp = cache.new_entry(key)
+        meta = build_graph(tmp, grids.fdir_deg, grids.cellsize, hf, vf, vertical)
+        cache.commit(key, tmp, meta)
+        folder = cache.open_entry(key)
+    return load_graph(folder)
+
+
+@njit(cache=True, nogil=True)  # nogil: concurrent runs on threads (msf_service.py)
+def _csr_kernel(indptr, indices, hcost, vpass, use_vf, vf0, src_cell, max_cost, dist, touched):
+    # Dijkstra on the CSR graph. dist is a full-size buffer of inf, the cells
+    # reached are listed in touched (grown when needed) so that the caller
+    # can read and reset them without scanning the whole raster.
+    heap = [(0.0, np.int64(0))]
+    heap.pop()
+    n = 0
+    for s in src_cell:
+        if dist[s] > 0.0:
+            if dist[s] == math.inf:
+                touched[n] = s
+                n += 1
+            dist[s] = 0.0
+            heapq.heappush(heap, (0.0, np.int64(s)))
+    while len(heap) > 0:
+        d, i = heapq.heappop(heap)
+        if d > dist[i]:
+            continue
+        for e in range(indptr[i], indptr[i + 1]):
+            if use_vf:
+                if not vpass[e]:
+                    continue
+                nd = d + hcost[e] * vf0
+            else:
+                nd = d + hcost[e]
+            if nd > max_cost:
+                continue
+            j = indices[e]
+            if nd < dist[j]:
+                if dist[j] == math.inf:
+                    if n == touched.size:
+                        touched = np.concatenate((touched, np.empty(n, dtype=np.int64)))
+                    touched[n] = j
+                    n += 1
+                dist[j] = nd
+                heapq.heappush(heap, (nd, j))
+    return touched[:n]
+
+
+def distances(graph, cells, max_cost, dist):
+    """(cells, cost) sorted by cell of the path distance from source cells.
+
+    dist is a buffer of graph size filled with inf; it is left filled with
+    inf again, so the same buffer serves every run on the graph.
+    """
+    touched = _csr_kernel(graph.indptr, graph.indices, graph.hcost, graph.vpass, graph.use_vf,
+                          float(graph.vf0), np.asarray(cells, dtype=np.int64), float(max_cost),
+                          dist, np.empty(1024, dtype=np.int64))
+    touched = np.sort(touched)
+    cost = dist[touched]
+    dist[touched] = np.inf
+    return touched, cost
+
+
+def window_distance(graph, cells, max_cost, dist, window):
+    """distances() as an array covering window (NaN where not reached), as
+    the distance of path_allocation run on the window."""
+    cells, cost = distances(graph, cells, max_cost, dist)
+    rows, cols = np.divmod(cells, graph.shape[1])
+    rows, cols = rows - window.row_off, cols - window.col_off
+    inside = (rows >= 0) & (rows < window.nrows) & (cols >= 0) & (cols < window.ncols)
+    out = np.full((window.nrows, window.ncols), np.nan)
+    out[rows[inside], cols[inside]] = cost[inside]
+    return out
+
+
+class GraphRunner:
+    """MSF runs of single sources on the li and fri graphs of a DTM.
+
+    Keeps one full-size distance buffer per pass that is reset after every
+    run, so a run only touches the cells its fronts reach.
+    """
+
+    def __init__(self, dtm, graph_li, graph_fri):
+        self.z = np.asarray(dtm).reshape(-1)
+        self.shape = graph_li.shape
+        self.graphs = (graph_li, graph_fri)
+        self._dist = [np.full(self.z.size, np.inf) for _ in self.graphs]
+
+    def distances(self, i, cells, max_cost=np.inf):
+        """(cells, cost) sorted by cell of the pass i (0: li, 1: fri) from source cells."""
+        return distances(self.graphs[i], cells, max_cost, self._dist[i])
+
+    def footprint(self, row, col, value, h_l_threshold, li_max=np.inf, fri_max=np.inf,
+                  profiler=None):
+        """msf_footprints.Footprint of the pq_lim of one source cell (profiler:
+        msf_profile.RunProfiler timing the li_pass, fri_pass and calculator stages)."""
+        prof = profiler or msf_profile.NULL
+        cell = [int(row) * self.shape[1] + int(col)]
+        with prof.stage("li_pass"):
+            li_pass = self.distances(0, cell, li_max)
+        with prof.stage("fri_pass"):
+            fri_pass = self.distances(1, cell, fri_max)
+        prof.count("li_visited", li_pass[0].size)
+        prof.count("fri_visited", fri_pass[0].size)
+        with prof.stage("calculator"):
+            return self.pq_lim(value, h_l_threshold, li_pass, fri_pass)
+
+    def pq_lim(self, value, h_l_threshold, li_pass, fri_pass):
+        """Footprint of pq_lim from the (cells, cost) of the li and fri passes."""
+        cells, i_li, i_fri = np.intersect1d(li_pass[0], fri_pass[0], assume_unique=True,
+                                            return_indices=True)
+        li, fri = li_pass[1][i_li], fri_pass[1][i_fri]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            keep = (float(value) - self.z[cells]) / (li + msf_engine.EPS) >= float(h_l_threshold)
+            values = li[keep] / (fri[keep] + msf_engine.EPS)
+        return msf_footprints.from_cells(cells[keep], values, self.shape[1])
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+
+"""
+"Which sources reach this location": inverted index of the per-source
+footprints of a run.
+
+For every reached cell the index lists the Id of the sources reaching it
+and their pq_lim (cells sorted, one offset per cell, as a compressed sparse
+row table). It is stored as .npy files in pq_lim_all/source_index and memory
+mapped when loaded, so point, bounding box and polygon queries only read
+the cells they need.
+
+Command line:
+    python msf_index.py <index folder> point X Y
+    python msf_index.py <index folder> bbox XMIN YMIN XMAX YMAX
+    python msf_index.py <index folder> polygon <polygons file (shapefile, GeoPackage, GeoJSON)>
+(add --json for JSON output)
+"""
+# Name: msf_index.py
+# Description: Inverted cell -> (source Id, pq_lim) index built from the
+#              footprints of a run, with point/bbox/polygon queries (Python
+#              API and command line).
+
+import os
+import json
+import argparse
+
+import numpy as np
+
+import msf_io
+
+_ARRAYS = ("cells", "offsets", "ids", "values")
+
+
+def build_index(folder, footprints, shape, profile):
+    """Build the index of a run from its footprints and save it in folder.
+
+    footprints : callable returning a new iterable of (fid, Footprint) each
+                 time it is called (the footprints are read twice: counting,
+                 then filling), e.g. a generator function loading them from
+                 the footprint cache. None footprints are skipped.
+    """
+    size = int(shape[0]) * int(shape[1])
+    count = np.zeros(size, dtype=np.int32)
+    for fid, fp in footprints():
+        if fp is not None:
+            count[fp.cells] += 1
+    cells = np.flatnonzero(count)
+    offsets = np.zeros(cells.size + 1, dtype=np.int64)
+    np.cumsum(count[cells], out=offsets[1:])
+    del count
+    ids = np.zeros(offsets[-1], dtype=np.int64)
+    values = np.zeros(offsets[-1], dtype=np.float32)
+    filled = np.zeros(cells.size, dtype=np.int64)
+    for fid, fp in footprints():
+        if fp is None:
+            continue
+        k = np.searchsorted(cells, fp.cells)
+        at = offsets[k] + filled[k]
+        ids[at] = fid
+        values[at] = fp.values
+        filled[k] += 1
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    for name, arr in zip(_ARRAYS, (cells, offsets, ids, values)):
+        np.save(os.path.join(folder, name + ".npy"), arr)
+    with open(os.path.join(folder, "meta.json"), "w") as f:
+        json.dump(dict(shape=[int(shape[0]), int(shape[1])], profile=msf_io.profile_to_dict(profile)), f)
+    return SourceIndex(folder)
+
+
+def _ranges(starts, ends):
+    """Concatenation of np.arange(s, e) for all (s, e) pairs."""
+    lengths = ends - starts
+    first = np.cumsum(lengths) - lengths
+    return np.arange(lengths.sum(), dtype=np.int64) + np.repeat(starts - first, lengths)
+
+
+def _inside(px, py, rings):
+    """Even-odd point in polygon test of arrays of points against a list of rings."""
+    inside = np.zeros(px.shape, dtype=bool)
+    for ring in rings:
+        ring = np.asarray(ring, dtype=np.float64)[:, :2]
+        x0, y0 = ring[:, 0], ring[:, 1]
+        x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+        for a, b, c, d in zip(x0, y0, x1, y1):
+            if b == d:
+                continue
+            crosses = (b > py) != (d > py)
+            xc = a + (py - b) * (c - a) / (d - b)
+            inside ^= crosses & (px < xc)
+    return inside
+
+
+class SourceIndex:
+    """Index of a run loaded (memory mapped) from the folder written by build_index."""
+
+    def __init__(self, folder):
+        with open(os.path.join(folder, "meta.json")) as f:
+            meta = json.load(f)
+        self.shape = tuple(meta["shape"])
+        self.profile = msf_io.profile_from_dict(meta["profile"])
+        for name in _ARRAYS:
+            setattr(self, name, np.load(os.path.join(folder, name + ".npy"), mmap_mode="r"))
+
+    def _summary(self, k):
+        """(Id, max pq_lim, reached cells) of the sources reaching the cells at positions k."""
+        if k.size == 0:
+            return []
+        # positions of the (Id, pq_lim) entries of all these cells
+        pos = _ranges(np.asarray(self.offsets[k]), np.asarray(self.offsets[k + 1]))
+        ids = np.asarray(self.ids[pos])
+        values = np.asarray(self.values[pos])
+        uid, inverse, n_cells = np.unique(ids, return_inverse=True, return_counts=True)
+        best = np.full(uid.size, -np.inf, dtype=np.float32)
+        np.maximum.at(best, inverse, values)
+        order = np.argsort(-best, kind="stable")
+        return [(int(uid[i]), float(best[i]), int(n_cells[i])) for i in order]
+
+    def _window(self, xmin, ymin, xmax, ymax):
+        """Positions in self.cells of the reached cells inside a bounding box."""
+        rows, cols = msf_io.xy_to_cells([xmin, xmax], [ymax, ymin], self.profile)
+        r0, r1 = max(int(rows.min()), 0), min(int(rows.max()), self.shape[0] - 1)
+        c0, c1 = max(int(cols.min()), 0), min(int(cols.max()), self.shape[1] - 1)
+        if r0 > r1 or c0 > c1:
+            return np.zeros(0, dtype=np.int64)
+        # cells are sorted, so every row of the box is one range of positions
+        first = np.arange(r0, r1 + 1, dtype=np.int64) * self.shape[1]
+        return _ranges(np.searchsorted(self.cells, first + c0, "left"),
+                       np.searchsorted(self.cells, first + c1, "right"))
+
+    def cell(self, row, col):
+        """Sources reaching a cell: list of (Id, pq_lim, 1), highest pq_lim first."""
+        cell = int(row) * self.shape[1] + int(col)
+        k = np.searchsorted(self.cells, [cell])
+        if k[0] >= self.cells.size or self.cells[k[0]] != cell:
+            return []
+        return self._summary(k)
+
+    def point(self, x, y):
+        """Sources reaching the cell containing map coordinates (x, y)."""
+        rows, cols = msf_io.xy_to_cells([x], [y], self.profile)
+        if not (0 <= rows[0] < self.shape[0] and 0 <= cols[0] < self.shape[1]):
+            return []
+        return self.cell(rows[0], cols[0])
+
+    def bbox(self, xmin, ymin, xmax, ymax):
+        """Sources reaching any cell of a bounding box: list of (Id, max pq_lim,
+        reached cells in the box), highest pq_lim first."""
+        return self._summary(self._window(xmin, ymin, xmax, ymax))
+
+    def _polygon(self, rings):
+        """Positions in self.cells of the reached cells whose centre lies in a polygon."""
+        xy = np.concatenate([np.asarray(r, dtype=np.float64)[:, :2] for r in rings])
+        k = self._window(xy[:, 0].min(), xy[:, 1].min(), xy[:, 0].max(), xy[:, 1].max())
+        rows, cols = np.divmod(np.asarray(self.cells[k]), self.shape[1])
+        px, py = self.profile["transform"] * (cols + 0.5, rows + 0.5)
+        return k[_inside(np.asarray(px), np.asarray(py), rings)]
+
+    def polygon(self, rings):
+        """Sources reaching any cell whose centre lies in a polygon (list of
+        rings of (x, y) vertices, holes included; even-odd rule)."""
+        return self._summary(self._polygon(rings))
+
+    def polygons(self, polygons):
+        """Sources reaching any cell whose centre lies in one of several
+        polygons (list of lists of rings); a cell covered by overlapping
+        polygons counts once."""
+        k = [self._polygon(rings) for rings in polygons]
+        return self._summary(np.unique(np.concatenate(k)) if k else np.zeros(0, dtype=np.int64))
+
+
+def _polygon_rings(path):
+    """Rings of every polygon feature of a vector file."""
+    import fiona  # Requires fiona only when reading vector files
+    out = []
+    with fiona.open(path) as src:
+        for feat in src:
+            geom = feat["geometry"]
+            polygons = [geom["coordinates"]] if geom["type"] == "Polygon" else geom["coordinates"]
+            out.extend(polygons)
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Which MSF sources reach a location.")
+    parser.add_argument("index", help="index folder (pq_lim_all/source_index)")
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--json", action="store_true", help="print the result as JSON")
+    sub = parser.add_subparsers(dest="query")
+    p = sub.add_parser("point", parents=[common], help="sources reaching the cell of a point")
+    p.add_argument("x", type=float)
+    p.add_argument("y", type=float)
+    p = sub.add_parser("bbox", parents=[common], help="sources reaching a bounding box")
+    for name in ("xmin", "ymin", "xmax", "ymax"):
+        p.add_argument(name, type=float)
+    p = sub.add_parser("polygon", parents=[common], help="sources reaching the polygons of a file")
+    p.add_argument("path", help="polygons (shapefile, GeoPackage, GeoJSON)")
+    args = parser.parse_args(argv)
+
+    index = SourceIndex(args.index)
+    if args.query == "point":
+        result = index.point(args.x, args.y)
+    elif args.query == "bbox":
+        result = index.bbox(args.xmin, args.ymin, args.xmax, args.ymax)
+    elif args.query == "polygon":
+        result = index.polygons(_polygon_rings(args.path))
+    else:
+        parser.error("a query (point, bbox or polygon) is required")
+    if args.json:
+        print(json.dumps([dict(Id=fid, pq_lim=value, cells=n) for fid, value, n in result]))
+    else:
+        print("{:>10} {:>12} {:>8}".format("Id", "pq_lim", "cells"))
+        for fid, value, n in result:
+            print("{:>10} {:>12.6g} {:>8}".format(fid, value, n))
+
+
+if __name__ == "__main__":
+    main()
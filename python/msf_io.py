@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+
+"""
+Raster and point I/O for the native MSF engine (replaces Raster(), .save()
+and arcpy.da.SearchCursor).
+
+Rasters are written as tiled, compressed GeoTIFFs. Tiles holding only NoData
+are not written at all (SPARSE_OK), so a pq_lim raster costs about the
+size of the cells it reaches. AsyncWriter moves the writes to a background
+thread so the computation does not wait on the disk.
+"""
+# Name: msf_io.py
+# Description: GeoTIFF read/write with NaN as in-memory NoData (tiled,
+#              compressed, sparse, background writer), and reading of the
+#              source points (shapefile, GeoPackage or CSV).
+#              **Requires rasterio (GDAL). Reading shapefiles requires fiona.**
+
+import queue
+import threading
+
+import numpy as np
+import rasterio  # Requires rasterio (bundles GDAL)
+
+# NoData written to float GeoTIFFs (ArcGIS default for 32 bit float rasters)
+NODATA = -3.4028234663852886e+38
+# Tile side and default compression of the GeoTIFFs written ("deflate",
+# "zstd" where GDAL supports it, "lzw" or "none")
+BLOCK = 256
+COMPRESS = "deflate"
+
+
+def read_raster(path):
+    """Read band 1 of a raster as float64 with NoData set to NaN.
+
+    Returns (array, profile); the profile is the rasterio profile of the
+    dataset and is passed back to write_raster.
+    """
+    with rasterio.open(path) as src:
+        arr = src.read(1, masked=True).astype(np.float64)
+        profile = src.profile.copy()
+    return arr.filled(np.nan), profile
+
+
+def cell_size(profile):
+    """Cell size of a raster profile (meanCellHeight in arcpy.Describe)."""
+    return abs(profile["transform"].e)
+
+
+def gtiff_profile(profile, dtype="float32", nodata=NODATA, compress=None):
+    """Profile of a tiled, compressed, sparse single band GeoTIFF on the grid of profile."""
+    out_profile = profile.copy()
+    out_profile.update(driver="GTiff", count=1, dtype=dtype, nodata=nodata, tiled=True,
+                       blockxsize=BLOCK, blockysize=BLOCK, sparse_ok=True, bigtiff="if_safer")
+    compress = (compress or COMPRESS).lower()
+    if compress == "none":
+        out_profile.pop("compress", None)
+        out_profile.pop("predictor", None)
+    else:
+        # horizontal differencing (floating point predictor for float rasters)
+        out_profile.update(compress=compress, predictor=3 if np.dtype(dtype).kind == "f" else 2)
+    return out_profile
+
+
+def _overviews(dst):
+    factors = []
+    while max(dst.width, dst.height) // (2 ** (len(factors) + 1)) >= BLOCK:
+        factors.append(2 ** (len(factors) + 1))
+    if factors:
+        dst.build_overviews(factors, rasterio.enums.Resampling.nearest)
+        dst.update_tags(ns="rio_overview", resampling="nearest")
+
+
+def write_raster(path, arr, profile, dtype="float32", nodata=NODATA, compress=None, overviews=False,
+                 window=None):
+    """Write an array as a single band GeoTIFF, NaN written as NoData.
+
+    window    : (row_off, col_off, nrows, ncols) of the raster of profile
+                covered by arr (e.g. msf_engine.Window); None = the whole raster.
+                The rest of the raster is NoData.
+    compress  : compression (default COMPRESS)
+    overviews : also build overviews (nearest neighbour, down to one tile)
+
+    The raster is written tile by tile and the tiles without data are
+    skipped, so no full-size copy is made and NoData costs nothing on disk.
+    """
+    out_profile = gtiff_profile(profile, dtype, nodata, compress)
+    height, width = out_profile["height"], out_profile["width"]
+    r0, c0 = (0, 0) if window is None else (int(window[0]), int(window[1]))
+    r1, c1 = r0 + arr.shape[0], c0 + arr.shape[1]
+    with rasterio.open(path, "w", **out_profile) as dst:
+        for tr in range(r0 // BLOCK * BLOCK, min(r1, height), BLOCK):
+            for tc in range(c0 // BLOCK * BLOCK, min(c1, width), BLOCK):
+                th, tw = min(BLOCK, height - tr), min(BLOCK, width - tc)
+                part = arr[max(tr - r0, 0):min(tr + th, r1) - r0, max(tc - c0, 0):min(tc + tw, c1) - c0]
+                valid = ~np.isnan(part)
+                if not valid.any():
+                    continue
+                tile = np.full((th, tw), nodata, dtype=dtype)
+                tile[max(r0 - tr, 0):max(r0 - tr, 0) + part.shape[0],
+                     max(c0 - tc, 0):max(c0 - tc, 0) + part.shape[1]] = np.where(valid, part, nodata)
+                dst.write(tile, 1, window=rasterio.windows.Window(tc, tr, tw, th))
+        if overviews:
+            _overviews(dst)
+
+
+def _nearest(n_src, n):
+    """Cell of a level of n_src cells sampled by every cell of the next level
+    of n cells (GDAL nearest resampling: floor(i * n_src / n + 0.5))."""
+    return (2 * np.arange(n, dtype=np.int64) * n_src + n) // (2 * n)
+
+
+def _update_overviews(path, window):
+    """Regenerate the overviews of a raster over window (row_off, col_off,
+    nrows, ncols) of the full resolution only.
+
+    Like GDAL, every level is sampled (nearest) from the previous one, so the
+    cells of a level depending on the window are found by following the
+    sampled rows and columns down the levels; the window is thus rounded out
+    to the cells of every level.
+    """
+    r0, c0 = int(window[0]), int(window[1])
+    r1, c1 = r0 + int(window[2]), c0 + int(window[3])
+    patches = []
+    with rasterio.open(path) as src:
+        # full resolution row/column sampled by every row/column of the level
+        rows, cols = np.arange(src.height), np.arange(src.width)
+        for level in range(len(src.overviews(1))):
+            with rasterio.open(path, overview_level=level) as ovr:
+                rows = rows[_nearest(rows.size, ovr.height)]
+                cols = cols[_nearest(cols.size, ovr.width)]
+            i0, i1 = np.searchsorted(rows, [r0, r1])
+            j0, j1 = np.searchsorted(cols, [c0, c1])
+            if i0 == i1 or j0 == j1:
+                break
+            block = src.read(1, window=rasterio.windows.Window.from_slices(
+                (rows[i0], rows[i1 - 1] + 1), (cols[j0], cols[j1 - 1] + 1)))
+            patches.append((level, i0, j0, block[np.ix_(rows[i0:i1] - rows[i0], cols[j0:j1] - cols[j0])]))
+    for level, i0, j0, data in patches:
+        with rasterio.open(path, "r+", overview_level=level) as dst:
+            dst.write(data, 1, window=rasterio.windows.Window(int(j0), int(i0), data.shape[1], data.shape[0]))
+
+
+def update_raster(path, arr, window):
+    """Write an array in place into window (row_off, col_off, nrows, ncols) of
+    an existing single band raster, NaN written as its NoData. Overviews, if
+    any, are regenerated over the window only."""
+    with rasterio.open(path, "r+") as dst:
+        data = np.where(np.isnan(arr), dst.nodata, arr).astype(dst.dtypes[0])
+        dst.write(data, 1, window=rasterio.windows.Window(int(window[1]), int(window[0]),
+                                                          arr.shape[1], arr.shape[0]))
+        overviews = bool(dst.overviews(1))
+    if overviews:
+        _update_overviews(path, window)
+
+
+def raster_info(path):
+    """Profile of a raster without reading its values."""
+    with rasterio.open(path) as src:
+        return src.profile.copy()
+
+
+def read_blocks(path, block_rows):
+    """Iterate over (row_off, array) blocks of block_rows full rows (NoData as NaN)."""
+    with rasterio.open(path) as src:
+        for row_off in range(0, src.height, block_rows):
+            nrows = min(block_rows, src.height - row_off)
+            window = rasterio.windows.Window(0, row_off, src.width, nrows)
+            arr = src.read(1, window=window, masked=True).astype(np.float64)
+            yield row_off, arr.filled(np.nan)
+
+
+def write_raster_blocks(path, profile, blocks, dtype="float32", nodata=NODATA, compress=None,
+                        overviews=False):
+    """Write a single band GeoTIFF from (row_off, col_off, array) blocks.
+
+    Only the given blocks are written (NaN as NoData); the rest of the raster
+    is NoData. Memory use is bounded by the size of one block. Blocks should
+    be aligned on BLOCK (a tile written twice is compressed twice).
+    """
+    with rasterio.open(path, "w", **gtiff_profile(profile, dtype, nodata, compress)) as dst:
+        for row_off, col_off, arr in blocks:
+            if np.isnan(arr).all():
+                continue
+            data = np.where(np.isnan(arr), nodata, arr).astype(dtype)
+            window = rasterio.windows.Window(col_off, row_off, arr.shape[1], arr.shape[0])
+            dst.write(data, 1, window=window)
+        if overviews:
+            _overviews(dst)
+
+
+def cell_blocks(rows, cols, values, shape):
+    """(row_off, col_off, block) blocks of write_raster_blocks holding scattered
+    cells: one block per BLOCK x BLOCK tile with cells, aligned on the tiles
+    (NaN elsewhere), so every tile is compressed once."""
+    rows, cols = np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    ntile_cols = -(-int(shape[1]) // BLOCK)
+    tile = (rows // BLOCK) * ntile_cols + cols // BLOCK
+    order = np.argsort(tile, kind="stable")
+    tiles, starts = np.unique(tile[order], return_index=True)
+    for t, a, b in zip(tiles, starts, np.append(starts[1:], order.size)):
+        r0, c0 = int(t // ntile_cols) * BLOCK, int(t % ntile_cols) * BLOCK
+        block = np.full((min(BLOCK, shape[0] - r0), min(BLOCK, shape[1] - c0)), np.nan)
+        sel = order[a:b]
+        block[rows[sel] - r0, cols[sel] - c0] = values[sel]
+        yield r0, c0, block
+
+
+class AsyncWriter:
+    """Writes rasters on a background thread.
+
+    write_raster() and write_raster_blocks() queue the write and return; the
+    writes run one at a time on a thread (GDAL releases the GIL while it
+    compresses and writes), so the computation goes on in the meantime. At
+    most max_pending writes wait in the queue: a producer faster than the
+    disk waits there instead of piling up arrays in memory. Arrays passed
+    must not be modified afterwards. With enabled=False every write runs at
+    once, as a plain call.
+
+        writer = AsyncWriter(4, compress="zstd")
+        writer.write_raster(path, arr, profile)
+        ...
+        writer.close()  # waits for the writes, raises IOError on failures
+    """
+
+    def __init__(self, max_pending=4, enabled=True, compress=None):
+        self.enabled = enabled
+        self.compress = compress
+        self.errors = []
+        if enabled:
+            self._queue = queue.Queue(max(int(max_pending), 1))
+            self._thread = threading.Thread(target=self._run, name="msf-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                func, path, args, kwargs = job
+                try:
+                    func(path, *args, **kwargs)
+                except Exception as e:
+                    self.errors.append((path, e))
+            finally:
+                self._queue.task_done()
+
+    def submit(self, func, path, *args, **kwargs):
+        """Run func(path, *args, **kwargs) on the writer thread."""
+        if self.enabled:
+            self._queue.put((func, path, args, kwargs))
+        else:
+            func(path, *args, **kwargs)
+
+    def write_raster(self, path, arr, profile, **kwargs):
+        kwargs.setdefault("compress", self.compress)
+        self.submit(write_raster, path, arr, profile, **kwargs)
+
+    def write_raster_blocks(self, path, profile, blocks, **kwargs):
+        kwargs.setdefault("compress", self.compress)
+        self.submit(write_raster_blocks, path, profile, blocks, **kwargs)
+
+    def flush(self):
+        """Wait until the queued writes are done; IOError if any failed."""
+        if self.enabled:
+            self._queue.join()
+        if self.errors:
+            errors, self.errors = self.errors, []
+            raise IOError("{} raster(s) not written: {}".format(
+                len(errors), "; ".join("{}: {}".format(p, e) for p, e in errors)))
+
+    def close(self):
+        """Wait for the queued writes and stop the thread (see flush)."""
+        if self.enabled and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self.flush()
+
+
+def read_source_points(path, fields=("Id", "Source"), xy_fields=("X", "Y"), layer=None):
+    """Read the source points as arrays (x, y, Id, Source).
+
+    path can be a shapefile, a GeoPackage (layer: layer name, default the
+    first one) or any other point format read by fiona, or a .csv file with
+    a header row holding the xy_fields coordinate columns and the fields.
+    """
+    if path.lower().endswith(".csv"):
+        data = np.atleast_1d(np.genfromtxt(path, delimiter=",", names=True, dtype=None,
+                                           encoding="utf-8"))
+        missing = [f for f in tuple(xy_fields) + tuple(fields) if f not in data.dtype.names]
+        if missing:
+            raise ValueError("Input CSV must contain the fields {}.".format(", ".join(missing)))
+        columns = [data[f] for f in tuple(xy_fields) + tuple(fields)]
+    else:
+        import fiona  # Requires fiona only when reading vector files
+        with fiona.open(path, layer=layer) as src:
+            missing = [f for f in fields if f not in src.schema["properties"]]
+            if missing:
+                raise ValueError("Input shapefile must contain 'Id' and 'Source' fields.")
+            rows = [tuple(feat["geometry"]["coordinates"][:2]) +
+                    tuple(feat["properties"][f] for f in fields) for feat in src]
+        columns = list(zip(*rows)) if rows else [()] * (2 + len(fields))
+    x, y = (np.asarray(c, dtype=np.float64) for c in columns[:2])
+    ids = np.asarray(columns[2])
+    values = np.asarray(columns[3], dtype=np.float64)
+    return x, y, ids, values
+
+
+def xy_to_cells(x, y, profile):
+    """Rows and columns (int64 arrays) of the DTM cells containing map coordinates x, y.
+
+    Cells are those of the DTM grid (the snap raster of PointToRaster); points
+    outside the DTM get rows/columns outside 0..height-1 / 0..width-1.
+    """
+    inv = ~profile["transform"]
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    cols = np.floor(inv.a * x + inv.b * y + inv.c).astype(np.int64)
+    rows = np.floor(inv.d * x + inv.e * y + inv.f).astype(np.int64)
+    return rows, cols
+
+
+def profile_to_dict(profile):
+    """JSON-serialisable copy of a raster profile (transform and CRS as text)."""
+    out = {}
+    for k, v in profile.items():
+        if k == "transform":
+            v = list(v)[:6]
+        elif k == "crs":
+            v = v.to_wkt() if v is not None else None
+        out[k] = v
+    return out
+
+
+def profile_from_dict(d):
+    """Inverse of profile_to_dict."""
+    profile = dict(d)
+    profile["transform"] = rasterio.Affine(*d["transform"])
+    if d.get("crs"):
+        profile["crs"] = rasterio.crs.CRS.from_wkt(d["crs"])
+    return profile
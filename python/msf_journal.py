@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+
+"""
+Run journal of long batch runs.
+
+The journal records the sources that are done or failed (with the number of
+attempts, the last error and when the next retry is due), and optionally a
+checkpoint of the running combined maximum. It is rewritten atomically
+(temporary file + rename) at most every interval_s seconds, so a run killed
+at any point leaves the last consistent state behind and a restarted run
+with the same run key picks up from there. A journal with another run key
+(different DTM, sources or parameters) is discarded.
+"""
+# Name: msf_journal.py
+# Description: Atomic run journal (done/failed sources, retry with backoff,
+#              running maximum checkpoint) for resumable batch runs.
+
+import os
+import json
+import time
+import hashlib
+
+import numpy as np
+
+
+def run_key(*parts):
+    """Key of a run from JSON-serialisable parts (DTM key, mode, source keys, ...)."""
+    text = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _replace_json(path, data):
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class RunJournal:
+    """Journal of a run kept in path (JSON) and path[:-5] + "_pq_max.npy".
+
+    max_attempts : runs of a failing source before it is given up (across
+                   restarts; delete the journal to try those sources again)
+    backoff_s    : wait before the first retry, doubled at every attempt
+    interval_s   : minimum time between two writes of the journal
+    """
+
+    def __init__(self, path, key, max_attempts=3, backoff_s=30.0, interval_s=60.0, log=print):
+        self.path = path
+        self.max_path = os.path.splitext(path)[0] + "_pq_max.npy"
+        self.key = key
+        self.max_attempts = int(max_attempts)
+        self.backoff_s = float(backoff_s)
+        self.interval_s = float(interval_s)
+        self._written = 0.0
+        self._pq_max = None
+        self.log = log
+        self.state = dict(key=key, sources={}, checkpoint=None)
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            if state.get("key") == key:
+                self.state = state
+                log("Resuming from the run journal {} ({} sources done, {} failed)".format(
+                    path, self.n_done(), len(self.failed())))
+            else:
+                log("Run journal {} belongs to another run, starting again".format(path))
+
+    def _entry(self, key):
+        return self.state["sources"].setdefault(key, dict(status="todo", attempts=0))
+
+    def done(self, key, fid=None):
+        """Mark a source as done."""
+        self._entry(key).update(fid=fid, status="done", error=None, next_try=None)
+
+    def fail(self, key, fid, error):
+        """Mark a source as failed and schedule its retry (exponential backoff)."""
+        entry = self._entry(key)
+        entry["attempts"] += 1
+        entry.update(fid=fid, status="failed", error=str(error),
+                     next_try=time.time() + self.backoff_s * 2 ** (entry["attempts"] - 1))
+
+    def is_done(self, key):
+        return self.state["sources"].get(key, {}).get("status") == "done"
+
+    def attempts(self, key):
+        """Number of failed runs of a source."""
+        return self.state["sources"].get(key, {}).get("attempts", 0)
+
+    def can_retry(self, key):
+        """True unless the source failed max_attempts times."""
+        return self.attempts(key) < self.max_attempts
+
+    def wait(self, keys):
+        """Seconds until the retry of all the given sources is due."""
+        due = [self.state["sources"].get(k, {}).get("next_try") or 0.0 for k in keys]
+        return max([0.0] + [t - time.time() for t in due])
+
+    def retry(self, keys):
+        """Failed sources among keys that can run again: the journal is saved,
+        then this waits until their retry is due."""
+        retry = [k for k in keys if not self.is_done(k) and self.can_retry(k)]
+        if retry:
+            wait = self.wait(retry)
+            self.log("\nRetrying {} failed source points in {:.0f} s...".format(len(retry), wait))
+            self.save(force=True)
+            time.sleep(wait)
+        return retry
+
+    def n_done(self):
+        return sum(1 for e in self.state["sources"].values() if e["status"] == "done")
+
+    def failed(self):
+        """List of (fid, attempts, last error) of the failed sources."""
+        return [(e.get("fid"), e["attempts"], e.get("error"))
+                for e in self.state["sources"].values() if e["status"] == "failed"]
+
+    def set_checkpoint(self, position, pq_max):
+        """Running maximum after the first position sources (saved with the journal)."""
+        self._pq_max = pq_max
+        self.state["checkpoint"] = int(position)
+
+    def checkpoint(self):
+        """(position, pq_max) of the last saved running maximum, None without one."""
+        if self.state["checkpoint"] is None or not os.path.exists(self.max_path):
+            return None
+        return self.state["checkpoint"], np.load(self.max_path)
+
+    def save(self, force=False):
+        """Write the journal (and running maximum) if interval_s has elapsed."""
+        now = time.time()
+        if not force and now - self._written < self.interval_s:
+            return
+        if self._pq_max is not None:
+            # the maximum goes first: if the run stops in between, the journal
+            # points to an older position and the batches run again on the
+            # newer maximum, which gives the same result (fmax is idempotent)
+            tmp = "{}.{}.tmp.npy".format(self.max_path[:-4], os.getpid())
+            np.save(tmp, self._pq_max)
+            os.replace(tmp, self.max_path)
+            self._pq_max = None
+        self.state["updated"] = now
+        _replace_json(self.path, self.state)
+        self._written = now
+
+    def finish(self):
+        """Write the final journal (run completed) and drop the running maximum."""
+        self._pq_max = None
+        self.state["checkpoint"] = None
+        self.state["finished"] = time.time()
+        self.save(force=True)
+        if os.path.exists(self.max_path):
+            os.remove(self.max_path)
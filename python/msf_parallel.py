@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+
+"""
+Parallel per-source MSF runs on a process pool.
+
+The DTM and fdir_deg are placed once in shared memory and attached by every
+worker. Each worker keeps its own running maximum of pq_lim (also in shared
+memory); the partial maxima are merged with a pairwise (tree) reduction when
+all sources are done. When the footprints are stored in a cache the
+combination is left to the caller and no partial maximum is kept.
+"""
+# Name: msf_parallel.py
+# Description: Process-pool executor of per-source MSF runs with per-source
+#              progress/failure reporting and a tree-reduced maximum.
+
+import os
+import sys
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import msf_engine
+import msf_footprints
+import msf_profile
+
+# Worker state, set by _init_worker in every worker process
+_worker = {}
+
+
+def _shared_array(arr, dtype=np.float64):
+    """Copy an array into a new shared memory block, return (block, view)."""
+    arr = np.asarray(arr, dtype=dtype)
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    view = np.ndarray(arr.shape, dtype=dtype, buffer=shm.buf)
+    view[...] = arr
+    return shm, view
+
+
+def _attach(name, shape, dtype):
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _init_worker(shape, dtm_name, fdir_deg_name, partial_names, counter, events, params):
+    blocks = []
+    shm, dtm = _attach(dtm_name, shape, np.float64)
+    blocks.append(shm)
+    shm, fdir_deg = _attach(fdir_deg_name, shape, np.float64)
+    blocks.append(shm)
+    # Every worker gets its own partial maximum slot, if any
+    partial = None
+    if partial_names:
+        with counter.get_lock():
+            slot = counter.value
+            counter.value += 1
+        shm, partial = _attach(partial_names[slot], shape, np.float32)
+        blocks.append(shm)
+    _worker.update(blocks=blocks, dtm=dtm, fdir_deg=fdir_deg, partial=partial,
+                   events=events, params=params)
+
+
+def _run_chunk(chunk):
+    """Run the MSF of a list of (fid, row, col, value) sources in a worker."""
+    p = _worker["params"]
+    dtm = _worker["dtm"]
+    vertical = dtm if p["use_vertical_raster"] else None
+    if p["graphs"] is not None and "runner" not in _worker:
+        import msf_graph
+        _worker["runner"] = msf_graph.GraphRunner(dtm, *[msf_graph.load_graph(folder)
+                                                         for folder in p["graphs"]])
+    prof = _worker.setdefault("profiler", msf_profile.RunProfiler())
+    for fid, row, col, value in chunk:
+        try:
+            with prof.source(fid):
+                src = (np.array([row]), np.array([col]), np.array([float(value)]))
+                if p["graphs"] is not None:
+                    fp = _graph_footprint(src, p, dtm, vertical, prof)
+                else:
+                    fp = _footprint(src, p, dtm, vertical, prof)
+                if _worker["partial"] is not None:
+                    partial = _worker["partial"].reshape(-1)
+                    partial[fp.cells] = np.fmax(partial[fp.cells], fp.values)
+                with prof.stage("store"):
+                    if p["results"] is not None:
+                        p["results"].store(p["keys"][fid], fp, dtm.shape)
+                    if p["outdir"] is not None:
+                        import msf_io
+                        # the window of the footprint only, tiles without data are not written
+                        w = fp.window or msf_engine.Window(0, 0, 0, 0)
+                        arr = np.full((w.nrows, w.ncols), np.nan, dtype=np.float32)
+                        rows, cols = np.divmod(fp.cells, dtm.shape[1])
+                        arr[rows - w.row_off, cols - w.col_off] = fp.values
+                        msf_io.write_raster(os.path.join(p["outdir"], "pq_lim_Id_{}.tif".format(fid)),
+                                            arr, p["profile"], window=w)
+            _worker["events"].put(("done", fid, int(fp.cells.size), prof.sources.pop()))
+        except Exception as e:
+            _worker["events"].put(("failed", fid, "{}: {}".format(type(e).__name__, e),
+                                   prof.sources.pop() if prof.sources else {}))
+
+
+def _footprint(src, p, dtm, vertical, prof):
+    """Footprint of the pq_lim of one source, run on the grids."""
+    if p["bounded"]:
+        result, window = msf_engine.run_msf_bounded(dtm, src, _worker["fdir_deg"],
+                                                    p["cellsize"], p["h_l_threshold"],
+                                                    p["hf_li"], p["hf_fri"], p["vf"],
+                                                    vertical, p["z_min"], False, prof)
+    else:
+        result = msf_engine.run_msf(dtm, src, _worker["fdir_deg"], p["cellsize"],
+                                    p["h_l_threshold"], p["hf_li"], p["hf_fri"],
+                                    p["vf"], vertical, False, prof)
+        window = msf_engine.Window(0, 0, dtm.shape[0], dtm.shape[1])
+    return msf_footprints.footprint(result.pq_lim, window, dtm.shape)
+
+
+def _graph_footprint(src, p, dtm, vertical, prof):
+    """Footprint of the pq_lim of one source, run on the precomputed graphs."""
+    li_max = fri_max = np.inf
+    if p["bounded"]:
+        with prof.stage("window"):
+            _, li_max, fri_max = msf_engine.msf_window(dtm, src[0], src[1], src[2], p["cellsize"],
+                                                       p["h_l_threshold"], p["hf_li"], p["hf_fri"],
+                                                       p["vf"], vertical, p["z_min"])
+    return _worker["runner"].footprint(src[0][0], src[1][0], src[2][0], p["h_l_threshold"],
+                                       li_max, fri_max, prof)
+
+
+def tree_max(arrays):
+    """Pairwise (tree) reduction of a list of arrays with np.fmax, in place."""
+    arrays = list(arrays)
+    while len(arrays) > 1:
+        merged = []
+        for i in range(0, len(arrays) - 1, 2):
+            np.fmax(arrays[i], arrays[i + 1], out=arrays[i])
+            merged.append(arrays[i])
+        if len(arrays) % 2:
+            merged.append(arrays[-1])
+        arrays = merged
+    return arrays[0]
+
+
+def run_parallel(dtm, fdir_deg, cellsize, sources, h_l_threshold=0.19,
+                 hf_li=msf_engine.HF_LI, hf_fri=msf_engine.HF_FRI, vf=msf_engine.VF_MSF,
+                 use_vertical_raster=False, n_workers=None, chunk_size=None,
+                 outdir=None, profile=None, log=print, bounded=True, z_min=None, results=None, keys=None,
+                 graphs=None, profiler=None):
+    """Run the MSF of every source on a process pool and combine the maximum.
+
+    sources : list of (fid, row, col, value), one MSF run per entry
+    outdir  : if given, every worker also writes pq_lim_Id_<fid>.tif there
+              (profile is the rasterio profile of the DTM)
+    log     : callable receiving the progress messages
+    bounded : crop every run to the window allowed by the H/L threshold
+    z_min   : lowest elevation of the DTM (e.g. msf_cache.DTMGrids.z_min;
+              default computed from dtm)
+    results : msf_cache.FootprintCache where the footprint of every source
+              is stored, under keys[fid]; the combined maximum is then not
+              computed (pq_max is None), the caller reduces the footprints
+    graphs  : (li, fri) msf_graph.Graph to run the sources on the precomputed
+              graphs (memory mapped by every worker) instead of the grids
+    profiler: msf_profile.RunProfiler receiving the figures of every source
+
+    Returns (pq_max, failed) with pq_max the combined float32 maximum (NaN is
+    NoData), equal to CellStatistics(MAXIMUM, DATA) of the per-source pq_lim
+    (None when results is given), and failed a list of (fid, error message).
+    """
+    n_workers = int(n_workers or os.cpu_count() or 1)
+    n_workers = max(1, min(n_workers, len(sources)))
+    if chunk_size is None:
+        # a few chunks per worker keeps the pool balanced
+        chunk_size = max(1, len(sources) // (4 * n_workers))
+    chunks = [sources[i:i + chunk_size] for i in range(0, len(sources), chunk_size)]
+
+    # fork on Linux (nothing to re-import), spawn elsewhere
+    ctx = mp.get_context("fork" if sys.platform.startswith("linux") else "spawn")
+    blocks = []
+    dtm_sh = fdir_sh = partial = partials = None
+    try:
+        shm, dtm_sh = _shared_array(dtm)
+        blocks.append(shm)
+        shm, fdir_sh = _shared_array(fdir_deg)
+        blocks.append(shm)
+        partials = []
+        for _ in range(n_workers if results is None else 0):
+            shm, partial = _shared_array(np.full(dtm_sh.shape, np.nan, dtype=np.float32),
+                                         dtype=np.float32)
+            blocks.append(shm)
+            partials.append(partial)
+        counter = ctx.Value("i", 0)
+        events = ctx.Queue()
+        params = dict(cellsize=float(cellsize), h_l_threshold=float(h_l_threshold),
+                      hf_li=hf_li, hf_fri=hf_fri, vf=vf,
+                      use_vertical_raster=use_vertical_raster, outdir=outdir, profile=profile,
+                      bounded=bounded, z_min=float(np.nanmin(dtm) if z_min is None else z_min),
+                      results=results, keys=keys,
+                      graphs=None if graphs is None else [g.folder for g in graphs])
+        initargs = (dtm_sh.shape, blocks[0].name, blocks[1].name,
+                    [b.name for b in blocks[2:]], counter, events, params)
+
+        failed = []
+        n_seen = 0
+        with ProcessPoolExecutor(n_workers, mp_context=ctx, initializer=_init_worker,
+                                 initargs=initargs) as pool:
+            futures = [pool.submit(_run_chunk, chunk) for chunk in chunks]
+            while n_seen < len(sources):
+                try:
+                    status, fid, info, figures = events.get(timeout=1.0)
+                except Exception:
+                    # no news: stop waiting if a worker died
+                    if all(f.done() for f in futures):
+                        for f in futures:
+                            if f.exception() is not None:
+                                log("  ERROR in worker: {}".format(f.exception()))
+                        break
+                    continue
+                n_seen += 1
+                if profiler is not None and figures:
+                    profiler.add_source(figures)
+                if status == "done":
+                    log("  [{}/{}] Id_{} done ({} cells)".format(n_seen, len(sources), fid, info))
+                else:
+                    failed.append((fid, info))
+                    log("  [{}/{}] Id_{} FAILED: {}".format(n_seen, len(sources), fid, info))
+        pq_max = tree_max(partials).copy() if partials else None
+    finally:
+        # views must be released before the blocks can be closed
+        dtm_sh = fdir_sh = partial = partials = None
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+    return pq_max, failed
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+
+"""
+Per-stage instrumentation of MSF runs and the JSON run report.
+
+A RunProfiler measures wall and CPU time of named stages (reading, flow
+direction, the li and fri passes, the calculator, the combination, writes,
+...), overall and per source, and keeps counters (cells visited by every
+propagation, cache hits and misses, ...). The report adds peak memory, the
+bytes read and written by the process and the size of the output files.
+
+External profilers plug in through hooks: objects with any of the methods
+    stage_start(name, source)
+    stage_end(name, source, wall, cpu)
+    run_end(report)
+(see ProfilerHook). CProfileHook runs cProfile during chosen stages.
+"""
+# Name: msf_profile.py
+# Description: Stage timer (wall/CPU, per source), counters, peak memory and
+#              I/O, JSON run report and hooks for external profilers.
+
+import os
+import sys
+import json
+import time
+from collections import OrderedDict
+
+
+def peak_rss_mb(children=False):
+    """Peak resident set size of this process (or of its finished children), MB;
+    None where the resource module is not available (Windows)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    scale = 1024.0 ** 2 if sys.platform == "darwin" else 1024.0  # bytes on macOS, KB on Linux
+    return usage.ru_maxrss / scale
+
+
+def process_io():
+    """Bytes read and written by this process (Linux /proc/self/io), None elsewhere.
+    rchar/wchar count all read/write calls, read_bytes/write_bytes the storage I/O."""
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(":") for line in f if ":" in line)
+    except (IOError, OSError):
+        return None
+    return OrderedDict((k, int(fields[k])) for k in ("rchar", "wchar", "read_bytes", "write_bytes")
+                       if k in fields)
+
+
+class ProfilerHook:
+    """Base class of profiler hooks (all methods optional, no-ops here)."""
+
+    def stage_start(self, name, source):
+        pass
+
+    def stage_end(self, name, source, wall, cpu):
+        pass
+
+    def run_end(self, report):
+        pass
+
+
+class CProfileHook(ProfilerHook):
+    """Run cProfile during the given stages (all stages when None) and save the
+    statistics to path at the end of the run (read with pstats or snakeviz)."""
+
+    def __init__(self, path, stages=None):
+        import cProfile
+        self.path = path
+        self.stages = None if stages is None else set(stages)
+        self.profile = cProfile.Profile()
+        self._depth = 0
+
+    def stage_start(self, name, source):
+        if self.stages is None or name in self.stages:
+            if self._depth == 0:
+                self.profile.enable()
+            self._depth += 1
+
+    def stage_end(self, name, source, wall, cpu):
+        if self.stages is None or name in self.stages:
+            self._depth -= 1
+            if self._depth == 0:
+                self.profile.disable()
+
+    def run_end(self, report):
+        self.profile.dump_stats(self.path)
+
+
+def _stage_entry():
+    return OrderedDict(wall_s=0.0, self_s=0.0, cpu_s=0.0, calls=0)
+
+
+class _Stage:
+    def __init__(self, profiler, name):
+        self.profiler, self.name = profiler, name
+
+    def __enter__(self):
+        p = self.profiler
+        for hook in p.hooks:
+            if hasattr(hook, "stage_start"):
+                hook.stage_start(self.name, p._source)
+        self.children = 0.0  # wall time of the stages nested in this one
+        p._open.append(self)
+        self.t0, self.c0 = time.perf_counter(), time.process_time()
+
+    def __exit__(self, *exc):
+        wall, cpu = time.perf_counter() - self.t0, time.process_time() - self.c0
+        p = self.profiler
+        p._open.pop()
+        if p._open:
+            p._open[-1].children += wall
+        own = wall - self.children
+        entry = p.stages.setdefault(self.name, _stage_entry())
+        entry["wall_s"] += wall
+        entry["self_s"] += own
+        entry["cpu_s"] += cpu
+        entry["calls"] += 1
+        if p._source is not None:
+            times = p._source_entry.setdefault("stages", OrderedDict())
+            times[self.name] = times.get(self.name, 0.0) + wall
+            times = p._source_entry.setdefault("stages_self", OrderedDict())
+            times[self.name] = times.get(self.name, 0.0) + own
+        for hook in p.hooks:
+            if hasattr(hook, "stage_end"):
+                hook.stage_end(self.name, p._source, wall, cpu)
+
+
+class _Source:
+    def __init__(self, profiler, fid):
+        self.profiler, self.fid = profiler, fid
+
+    def __enter__(self):
+        p = self.profiler
+        p._source = self.fid
+        p._source_entry = OrderedDict(id=self.fid)
+        self.t0, self.c0 = time.perf_counter(), time.process_time()
+
+    def __exit__(self, exc_type, exc, tb):
+        p = self.profiler
+        entry = p._source_entry
+        entry.update(wall_s=time.perf_counter() - self.t0, cpu_s=time.process_time() - self.c0,
+                     status="failed" if exc_type is not None else "done")
+        p.sources.append(entry)
+        p._source = p._source_entry = None
+
+
+class RunProfiler:
+    """Wall/CPU time of the stages of a run, per-source figures and counters.
+
+    Stage CPU times are the ones of this process (stages run by worker
+    processes only add their wall time, see add_source). Stages can be
+    nested: wall_s of a stage includes the stages run inside it, self_s
+    excludes them (the hot spots are ranked by self_s).
+
+        prof = RunProfiler()
+        with prof.stage("read_points"):
+            ...
+        with prof.source(fid):            # per-source figures
+            with prof.stage("li_pass"):
+                ...
+            prof.count("li_visited", n)
+        prof.write("run_report.json", run_mode="per_source")
+    """
+
+    def __init__(self, hooks=()):
+        self.hooks = list(hooks)
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+        self.sources = []
+        self.caches = OrderedDict()
+        self.outputs = OrderedDict()
+        self._source = self._source_entry = None
+        self._open = []  # stages being timed, innermost last
+        self._t0, self._c0 = time.perf_counter(), time.process_time()
+
+    def stage(self, name):
+        """Context manager timing a stage (nested stages are timed on their own
+        and left out of the self time of the enclosing stage)."""
+        return _Stage(self, name)
+
+    def source(self, fid):
+        """Context manager collecting the figures of one source."""
+        return _Source(self, fid)
+
+    def count(self, name, n=1):
+        """Add n to a counter (and to the counter of the current source)."""
+        n = n.item() if hasattr(n, "item") else n  # NumPy scalars are not JSON serialisable
+        self.counters[name] = self.counters.get(name, 0) + n
+        if self._source is not None:
+            counters = self._source_entry.setdefault("counters", OrderedDict())
+            counters[name] = counters.get(name, 0) + n
+
+    def add_source(self, entry):
+        """Per-source figures collected by another RunProfiler (e.g. in a worker
+        process); its stage wall times and counters are added to the totals."""
+        self.sources.append(entry)
+        own = entry.get("stages_self", {})
+        for name, wall in entry.get("stages", {}).items():
+            stage = self.stages.setdefault(name, _stage_entry())
+            stage["wall_s"] += wall
+            stage["self_s"] += own.get(name, wall)
+            stage["calls"] += 1
+        for name, n in entry.get("counters", {}).items():
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_cache(self, name, cache):
+        """Hit/miss statistics of a cache (msf_cache.GridCache or FootprintCache)."""
+        for kind, (hits, misses) in cache.stats.items():
+            self.caches["{}.{}".format(name, kind)] = OrderedDict(
+                hits=hits, misses=misses,
+                hit_rate=float(hits) / (hits + misses) if hits + misses else None)
+
+    def add_output(self, path):
+        """Record an output file and its size."""
+        if os.path.exists(path):
+            self.outputs[path] = os.path.getsize(path)
+
+    def report(self, **info):
+        """The run report as an ordered dict (info: run settings to include)."""
+        wall, cpu = time.perf_counter() - self._t0, time.process_time() - self._c0
+        report = OrderedDict(created=time.strftime("%Y-%m-%dT%H:%M:%S"))
+        report.update(info)
+        report.update(wall_s=wall, cpu_s=cpu, peak_rss_mb=peak_rss_mb(),
+                      peak_rss_children_mb=peak_rss_mb(children=True), io=process_io(),
+                      bytes_written=sum(self.outputs.values()), stages=self.stages,
+                      counters=self.counters, caches=self.caches, outputs=self.outputs)
+        # hot spots: stages by self time (nested stages excluded, so an
+        # enclosing stage does not outrank the work inside it), per-source summary
+        report["hot_spots"] = [name for name, _ in sorted(self.stages.items(),
+                                                           key=lambda kv: -kv[1]["self_s"])]
+        times = sorted(s["wall_s"] for s in self.sources if "wall_s" in s)
+        if times:
+            report["source_wall_s"] = OrderedDict(
+                n=len(times), total=sum(times), mean=sum(times) / len(times),
+                median=times[len(times) // 2], p95=times[min(len(times) - 1, int(0.95 * len(times)))],
+                max=times[-1])
+        report["sources"] = self.sources
+        return report
+
+    def write(self, path, **info):
+        """Write the JSON report to path and pass it to the hooks; returns it."""
+        report = self.report(**info)
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(report, f, indent=1, default=str)
+        os.replace(tmp, path)
+        for hook in self.hooks:
+            if hasattr(hook, "run_end"):
+                hook.run_end(report)
+        return report
+
+
+class NullProfiler:
+    """Does nothing: the default of the engine functions taking a profiler."""
+
+    class _Null:
+        def __enter__(self):
+            pass
+
+        def __exit__(self, *exc):
+            pass
+
+    _null = _Null()
+
+    def stage(self, name):
+        return self._null
+
+    def source(self, fid):
+        return self._null
+
+    def count(self, name, n=1):
+        pass
+
+
+NULL = NullProfiler()
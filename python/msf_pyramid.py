@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+
+"""
+Coarse-to-fine (pyramid) MSF runs.
+
+Each source is first run on the DTM aggregated by factor x factor blocks
+(mean elevation, filled again). Its coarse pq_lim footprint, grown by a
+safety buffer, is the search region of the run at full resolution: cells
+outside it are impassable, so the li and fri fronts only explore the cells
+the source can plausibly reach instead of the whole H/L bound window.
+
+The result equals the full resolution run as long as the fine footprint and
+the paths leading to it stay inside the region. When the fronts of the fine
+run reach the edge of the region so that the result may differ (the coarse
+DTM missed a path, see region_exact) the region is grown and the source run
+again, and after a few attempts the source is run without region. validate() runs the full resolution source as well and
+reports the cells that leak out of the region and the cells whose pq_lim
+differs.
+"""
+# Name: msf_pyramid.py
+# Description: Coarsened DTM grids, search regions from coarse footprints
+#              (with buffer) and fine runs restricted to them, with
+#              validation against the unrestricted runs.
+
+import math
+from collections import namedtuple
+
+import numpy as np
+from rasterio import Affine
+
+import msf_cache
+import msf_engine
+import msf_footprints
+import msf_profile
+from msf_engine import Window, window_slices
+
+Validation = namedtuple("Validation", "fine_cells leaked differ max_abs_diff")
+
+
+def coarsen(dtm, profile, factor):
+    """(DTM, profile) aggregated by factor x factor blocks (mean of the valid
+    cells, NoData where a block has none) and filled again."""
+    k = int(factor)
+    nrows, ncols = -(-dtm.shape[0] // k), -(-dtm.shape[1] // k)
+    z = np.full((nrows * k, ncols * k), np.nan)
+    z[:dtm.shape[0], :dtm.shape[1]] = dtm
+    blocks = z.reshape(nrows, k, ncols, k)
+    valid = ~np.isnan(blocks)
+    n = valid.sum(axis=(1, 3))
+    total = np.where(valid, blocks, 0.0).sum(axis=(1, 3))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        coarse = np.where(n > 0, total / n, np.nan)
+    out_profile = profile.copy()
+    out_profile.update(width=ncols, height=nrows, transform=profile["transform"] * Affine.scale(k))
+    return msf_engine.fill_depressions(coarse), out_profile
+
+
+def coarse_grids(grids, factor, cache=None, log=print):
+    """msf_cache.DTMGrids of the coarsened DTM of grids (kept in the cache)."""
+    dtm, profile = coarsen(grids.dtm, grids.profile, factor)
+    if cache is None:
+        return msf_cache.compute_grids(dtm, profile)
+    key = msf_cache.dtm_key(dtm, profile)
+    coarse = cache.load(key)
+    cache.count("grids", coarse is not None)
+    if coarse is None:
+        log("  Computing coarse DTM grids (x{}): {}".format(factor, key))
+        cache.store(msf_cache.compute_grids(dtm, profile, key))
+        coarse = cache.load(key)
+    return coarse
+
+
+def _dilate(mask, n):
+    """mask grown by n cells in every direction (square neighbourhood); the
+    result has n more cells on every side."""
+    if n <= 0:
+        return mask
+    h, w = mask.shape
+    rows = np.zeros((h, w + 2 * n), dtype=bool)
+    for d in range(2 * n + 1):
+        rows[:, d:d + w] |= mask
+    out = np.zeros((h + 2 * n, w + 2 * n), dtype=bool)
+    for d in range(2 * n + 1):
+        out[d:d + h, :] |= rows
+    return out
+
+
+def region_edge(region, window, shape):
+    """Cells of window (inside the region) on the edge of the search region
+    (Window, mask): True cells of mask with a neighbour inside the raster of
+    shape but outside the mask."""
+    reg, mask = region
+    h, w = mask.shape
+    rows = np.arange(-1, h + 1) + reg.row_off
+    cols = np.arange(-1, w + 1) + reg.col_off
+    outside = ~np.pad(mask, 1)
+    outside &= ((rows >= 0) & (rows < shape[0]))[:, None] & ((cols >= 0) & (cols < shape[1]))[None, :]
+    edge = np.zeros(mask.shape, dtype=bool)
+    for dr in (-1, 0, 1):
+        for dc in (-1, 0, 1):
+            edge |= outside[1 + dr:1 + dr + h, 1 + dc:1 + dc + w]
+    edge &= mask
+    r0, c0 = window.row_off - reg.row_off, window.col_off - reg.col_off
+    return edge[r0:r0 + window.nrows, c0:c0 + window.ncols]
+
+
+def region_exact(dtm, result, window, region, h_l_threshold):
+    """True when a run restricted to region (result: MSFResult over window)
+    has the pq_lim of the unrestricted run.
+
+    A path leaving the region crosses its edge, and costs only grow along a
+    path. So if the li front (stopped at the largest li that can matter)
+    does not reach the edge, li is exact wherever it matters and the cells
+    passing the H/L threshold are the same. fri is exact on the cells whose
+    fri is below the smallest fri reached on the edge.
+    """
+    edge = region_edge(region, window, dtm.shape)
+    if not np.isnan(result.li[edge]).all():
+        return False
+    fri_edge = result.fri[edge]
+    if np.isnan(fri_edge).all():
+        return True
+    with np.errstate(invalid="ignore", divide="ignore"):
+        passing = (result.start_z - dtm[window_slices(window)]) / (result.li + msf_engine.EPS) >= h_l_threshold
+    # NaN (not reached) fri fails the comparison: its cell may be reached from outside
+    return bool((result.fri[passing] < np.nanmin(fri_edge)).all())
+
+
+def search_region(fp, row, col, factor, shape, buffer_cells):
+    """(Window, mask) on the fine grid of shape covering the coarse footprint
+    fp (cells of the coarse grid) and the coarse cell of the source (row,
+    col on the fine grid), grown by buffer_cells coarse cells."""
+    k = int(factor)
+    ncols_c = -(-shape[1] // k)
+    cells = np.append(fp.cells, (row // k) * ncols_c + col // k)
+    rows_c, cols_c = np.divmod(cells, ncols_c)
+    r0, c0 = rows_c.min() - buffer_cells, cols_c.min() - buffer_cells
+    mask = np.zeros((rows_c.max() - rows_c.min() + 1, cols_c.max() - cols_c.min() + 1), dtype=bool)
+    mask[rows_c - rows_c.min(), cols_c - cols_c.min()] = True
+    mask = _dilate(mask, buffer_cells)
+    # coarse cells -> fine cells, clipped to the raster
+    fine = np.repeat(np.repeat(mask, k, axis=0), k, axis=1)
+    fr0, fc0 = r0 * k, c0 * k
+    fr1 = min(fr0 + fine.shape[0], shape[0])
+    fc1 = min(fc0 + fine.shape[1], shape[1])
+    fine = fine[max(-fr0, 0):fr1 - fr0, max(-fc0, 0):fc1 - fc0]
+    fr0, fc0 = max(fr0, 0), max(fc0, 0)
+    return Window(int(fr0), int(fc0), int(fr1 - fr0), int(fc1 - fc0)), fine
+
+
+class PyramidRunner:
+    """Coarse-to-fine runs of single sources on a DTM.
+
+    grids        : msf_cache.DTMGrids of the fine DTM
+    factor       : coarsening factor (e.g. 3 runs a 3 m DTM at 9 m first)
+    buffer_m     : safety buffer around the coarse footprint (metres, rounded
+                   up to whole coarse cells)
+    h_l_scale    : the coarse run uses h_l_threshold * h_l_scale (< 1 widens
+                   the coarse footprint, to make up for the smoothed DTM)
+    max_grow     : times the region of a source is grown (buffer doubled)
+                   when its fine run may differ from the unrestricted one,
+                   before the source is run without region
+    """
+
+    def __init__(self, grids, factor=3, buffer_m=30.0, h_l_scale=1.0, hf_li=msf_engine.HF_LI,
+                 hf_fri=msf_engine.HF_FRI, vf=msf_engine.VF_MSF, use_vertical_raster=False, cache=None,
+                 log=print, max_grow=2):
+        self.grids = grids
+        self.factor = int(factor)
+        self.coarse = coarse_grids(grids, self.factor, cache, log)
+        self.buffer_cells = int(math.ceil(float(buffer_m) / self.coarse.cellsize))
+        self.h_l_scale = float(h_l_scale)
+        self.max_grow = int(max_grow)
+        self.hf_li, self.hf_fri, self.vf = hf_li, hf_fri, vf
+        self.vertical = grids.dtm if use_vertical_raster else None
+        self.coarse_vertical = self.coarse.dtm if use_vertical_raster else None
+
+    def region(self, row, col, value, h_l_threshold, buffer_cells=None):
+        """Search region (Window, mask) of a source on the fine grid
+        (buffer_cells coarse cells of buffer, default from buffer_m)."""
+        c = self.coarse
+        src = (np.array([row // self.factor]), np.array([col // self.factor]), np.array([float(value)]))
+        result, window = msf_engine.run_msf_bounded(c.dtm, src, c.fdir_deg, c.cellsize,
+                                                    float(h_l_threshold) * self.h_l_scale, self.hf_li,
+                                                    self.hf_fri, self.vf, self.coarse_vertical, c.z_min,
+                                                    False)
+        fp = msf_footprints.footprint(result.pq_lim, window, c.dtm.shape)
+        if buffer_cells is None:
+            buffer_cells = self.buffer_cells
+        return search_region(fp, row, col, self.factor, self.grids.dtm.shape, buffer_cells)
+
+    def _fine(self, row, col, value, h_l_threshold, profiler, region):
+        """(Footprint, exact) of a fine run of one source in region (None: no
+        region), exact as given by region_exact."""
+        g = self.grids
+        src = (np.array([row]), np.array([col]), np.array([float(value)]))
+        result, window = msf_engine.run_msf_bounded(g.dtm, src, g.fdir_deg, g.cellsize, float(h_l_threshold),
+                                                    self.hf_li, self.hf_fri, self.vf, self.vertical,
+                                                    g.z_min, False, profiler, region=region)
+        exact = region is None or region_exact(g.dtm, result, window, region, float(h_l_threshold))
+        return msf_footprints.footprint(result.pq_lim, window, g.dtm.shape), exact
+
+    def footprint(self, row, col, value, h_l_threshold, profiler=None):
+        """(Footprint, region) of the pq_lim of one source run inside its search region.
+
+        While the run may differ from the unrestricted one (its fronts reach
+        the edge of the region, see region_exact), the buffer is doubled and
+        the source run again (max_grow times); then the source is run without
+        region and region is None.
+        """
+        prof = profiler or msf_profile.NULL
+        buffer_cells = self.buffer_cells
+        for _ in range(self.max_grow + 1):
+            with prof.stage("coarse_run"):
+                region = self.region(row, col, value, h_l_threshold, buffer_cells)
+            fp, exact = self._fine(row, col, value, h_l_threshold, profiler, region)
+            if exact:
+                return fp, region
+            prof.count("regions_grown")
+            buffer_cells = 2 * buffer_cells + 1
+        prof.count("regions_dropped")
+        return self._fine(row, col, value, h_l_threshold, profiler, None)[0], None
+
+    def validate(self, row, col, value, h_l_threshold, fp, region, profiler=None):
+        """Validation of the footprint fp of a source run in region (None: no
+        region) against the unrestricted run: cells of the fine footprint,
+        cells of it outside the region (leaks), cells whose pq_lim differs
+        and the largest difference."""
+        g = self.grids
+        src = (np.array([row]), np.array([col]), np.array([float(value)]))
+        result, window = msf_engine.run_msf_bounded(g.dtm, src, g.fdir_deg, g.cellsize, float(h_l_threshold),
+                                                    self.hf_li, self.hf_fri, self.vf, self.vertical,
+                                                    g.z_min, False, profiler)
+        full = msf_footprints.footprint(result.pq_lim, window, g.dtm.shape)
+        inside = np.ones(full.cells.size, dtype=bool)
+        if region is not None:
+            reg, mask = region
+            rows, cols = np.divmod(full.cells, g.dtm.shape[1])
+            rows, cols = rows - reg.row_off, cols - reg.col_off
+            inside = (rows >= 0) & (rows < reg.nrows) & (cols >= 0) & (cols < reg.ncols)
+            inside[inside] = mask[rows[inside], cols[inside]]
+        # pq_lim of the full run against the restricted one, cell by cell
+        cells = np.union1d(full.cells, fp.cells)
+        a = np.full(cells.size, np.nan, dtype=np.float32)
+        b = np.full(cells.size, np.nan, dtype=np.float32)
+        a[np.searchsorted(cells, full.cells)] = full.values
+        b[np.searchsorted(cells, fp.cells)] = fp.values
+        differ = ~((a == b) | (np.isnan(a) & np.isnan(b)))
+        diff = np.abs(a - b)
+        return Validation(int(full.cells.size), int((~inside).sum()), int(differ.sum()),
+                          float(np.nanmax(diff)) if (differ & ~np.isnan(diff)).any() else 0.0)
@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+
+"""
+Resident runout service for on-demand source queries.
+
+The service loads the DTM grids (flow direction, ...) and the li and fri
+propagation graphs once, then answers "what if a debris flow starts here?"
+over a local HTTP port or Unix socket. Each request runs the sources on the
+graphs (bounded by the H/L threshold) and returns the combined pq_lim
+footprint as sparse JSON or as a GeoTIFF of the reached window. Requests
+are served on threads; every thread takes one of n_runners distance buffers
+(two float64 arrays of DTM size each), and the propagation kernel releases
+the GIL. With a cache folder the grids and graphs are shared with
+MSF_multiple_points_native.py, and so are the footprints: a source already
+run by a batch run (same cell, value and parameters) is read, not run.
+
+API:
+    GET  /health
+    GET  /runout?x=X&y=Y&source=Z[&H_L_threshold=0.19][&format=json|geotiff]
+    POST /runout  {"points": [{"x": X, "y": Y, "id": 1, "source": Z}, ...],
+                   "H_L_threshold": 0.19, "format": "json"}
+Every point needs its source value (start_z, the Source field of the
+points of the batch runs), so that a point gives the same footprint (and
+cache key) as in a batch run.
+
+Command line:
+    python msf_service.py <DTM> [--cachedir folder] [--port 8765 | --socket /tmp/msf.sock]
+"""
+# Name: msf_service.py
+# Description: Long-lived runout service keeping the DTM grids and
+#              propagation graphs in memory, with an HTTP / Unix socket API
+#              returning pq_lim footprints as sparse JSON or GeoTIFF.
+
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import tempfile
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+import msf_cache
+import msf_engine
+import msf_graph
+import msf_io
+from msf_engine import Window
+
+
+def combine(footprints):
+    """Combined maximum of footprints as (cells, pq_lim, source Id) sorted by
+    cell, the Id of the first source in input order on ties (as
+    msf_footprints.reduce_footprints, without full-size rasters)."""
+    footprints = [(fid, fp) for fid, fp in footprints if fp is not None and fp.cells.size]
+    if not footprints:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32), []
+    cells = np.concatenate([fp.cells for fid, fp in footprints])
+    values = np.concatenate([fp.values for fid, fp in footprints])
+    order = np.concatenate([np.full(fp.cells.size, i) for i, (fid, fp) in enumerate(footprints)])
+    sort = np.lexsort((order, -values, cells))
+    first = np.ones(sort.size, dtype=bool)
+    first[1:] = cells[sort[1:]] != cells[sort[:-1]]
+    best = sort[first]
+    ids = [footprints[i][0] for i in order[best]]
+    return cells[best], values[best], ids
+
+
+def cells_window(cells, ncols):
+    """Bounding Window of flat cell indices, None when empty."""
+    if not cells.size:
+        return None
+    rows, cols = np.divmod(cells, ncols)
+    return Window(int(rows.min()), int(cols.min()), int(rows.max() - rows.min() + 1),
+                  int(cols.max() - cols.min() + 1))
+
+
+class RunoutModel:
+    """DTM grids, propagation graphs and distance buffers kept in memory.
+
+    DTM       : filled DTM (GeoTIFF)
+    cachedir  : msf_cache.GridCache folder (None: everything built in memory)
+    n_runners : concurrent runs (each holds two float64 buffers of DTM size)
+    """
+
+    def __init__(self, DTM, hf_li=msf_engine.HF_LI, hf_fri=msf_engine.HF_FRI, vf=msf_engine.VF_MSF,
+                 use_vertical_raster=False, bounded=True, cachedir=None, cache_max_gb=20,
+                 n_runners=None, max_points=1000, log=print):
+        self.DTM = DTM
+        self.hf_li, self.hf_fri, self.vf = hf_li, hf_fri, vf
+        self.use_vertical_raster = use_vertical_raster
+        self.bounded = bounded
+        self.max_points = int(max_points)
+        self.log = log
+        t0 = time.perf_counter()
+        self.cache = msf_cache.GridCache(cachedir, cache_max_gb * 1024 ** 3) if cachedir else None
+        self.results = None
+        if self.cache is not None:
+            self.results = msf_cache.FootprintCache(os.path.join(cachedir, "footprints"),
+                                                    cache_max_gb * 1024 ** 3)
+        self.grids = msf_cache.dtm_grids(DTM, self.cache, log)
+        self.dtm, self.profile = self.grids.dtm, self.grids.profile
+        self.vertical = self.dtm if use_vertical_raster else None
+        graphs = (msf_graph.graph_for(self.grids, hf_li, vf, use_vertical_raster, self.cache, log),
+                  msf_graph.graph_for(self.grids, hf_fri, vf, use_vertical_raster, self.cache, log))
+        if n_runners is None:
+            n_runners = min(4, os.cpu_count() or 1)
+        self.runners = queue.Queue()
+        for _ in range(max(int(n_runners), 1)):
+            self.runners.put(msf_graph.GraphRunner(self.dtm, *graphs))
+        self._warm_up()
+        log("Runout model of {} ready in {:.1f} s ({} x {} cells, {} runners)".format(
+            DTM, time.perf_counter() - t0, self.dtm.shape[0], self.dtm.shape[1], n_runners))
+
+    def _warm_up(self):
+        # compile the kernels (or load them from the Numba cache) before the first request
+        row, col = (int(v[0]) for v in np.nonzero(~np.isnan(self.dtm)))
+        runner = self.runners.get()
+        try:
+            runner.footprint(row, col, self.dtm[row, col], 1.0, 0.0, 0.0)
+        finally:
+            self.runners.put(runner)
+
+    def info(self):
+        """Description of the model (GET /health)."""
+        return dict(status="ok", DTM=self.DTM, key=self.grids.key, shape=list(self.dtm.shape),
+                    cellsize=self.grids.cellsize, transform=list(self.profile["transform"])[:6],
+                    crs=self.profile["crs"].to_wkt() if self.profile.get("crs") else None,
+                    hf_li=[type(self.hf_li).__name__] + list(self.hf_li),
+                    hf_fri=[type(self.hf_fri).__name__] + list(self.hf_fri),
+                    vf=[type(self.vf).__name__] + list(self.vf), use_vertical_raster=self.use_vertical_raster,
+                    bounded=self.bounded, runners=self.runners.qsize())
+
+    def footprint(self, row, col, value, h_l_threshold):
+        """(Footprint, cached) of one source cell."""
+        key = None
+        if self.results is not None:
+            key = msf_cache.source_key(self.grids.key, row, col, value, h_l_threshold, self.hf_li,
+                                       self.hf_fri, self.vf, self.use_vertical_raster)
+            fp = self.results.load(key)
+            if fp is not None:
+                return fp, True
+        li_max = fri_max = np.inf
+        if self.bounded:
+            _, li_max, fri_max = msf_engine.msf_window(self.dtm, np.array([row]), np.array([col]),
+                                                       np.array([value]), self.grids.cellsize,
+                                                       h_l_threshold, self.hf_li, self.hf_fri, self.vf,
+                                                       self.vertical, self.grids.z_min)
+        runner = self.runners.get()
+        try:
+            fp = runner.footprint(row, col, value, h_l_threshold, li_max, fri_max)
+        finally:
+            self.runners.put(runner)
+        if key is not None:
+            self.results.store(key, fp, self.dtm.shape)
+        return fp, False
+
+    def query(self, points, h_l_threshold=0.19):
+        """Run source points given as dicts with x, y, source (start_z, as the
+        Source field of the batch runs) and optionally id.
+
+        Returns (sources, footprints): per point a dict with its cell, value,
+        number of reached cells and whether it came from the cache (or an
+        error), and the (id, Footprint) list of the points that ran.
+        """
+        if len(points) > self.max_points:
+            raise ValueError("too many points ({} > {})".format(len(points), self.max_points))
+        if any(p.get("source") is None for p in points):
+            raise ValueError("every point needs a source value (the Source field of the batch runs)")
+        h_l_threshold = float(h_l_threshold)
+        x = np.array([float(p["x"]) for p in points])
+        y = np.array([float(p["y"]) for p in points])
+        rows, cols = msf_io.xy_to_cells(x, y, self.profile)
+        sources, footprints = [], []
+        for i, p in enumerate(points):
+            fid = p.get("id", i + 1)
+            row, col = int(rows[i]), int(cols[i])
+            src = dict(id=fid, x=float(x[i]), y=float(y[i]), row=row, col=col)
+            sources.append(src)
+            if not (0 <= row < self.dtm.shape[0] and 0 <= col < self.dtm.shape[1]) or \
+                    np.isnan(self.dtm[row, col]):
+                src["error"] = "outside the DTM"
+                continue
+            value = float(p["source"])
+            if not value > 0:
+                src["error"] = "source value not positive"
+                continue
+            fp, cached = self.footprint(row, col, value, h_l_threshold)
+            src.update(source=value, cells=int(fp.cells.size), cached=cached)
+            footprints.append((fid, fp))
+        return sources, footprints
+
+    def to_json(self, sources, footprints, h_l_threshold):
+        """Sparse JSON answer: rows, columns, pq_lim and source Id of the reached cells."""
+        cells, values, ids = combine(footprints)
+        rows, cols = np.divmod(cells, self.dtm.shape[1])
+        window = cells_window(cells, self.dtm.shape[1])
+        return dict(H_L_threshold=h_l_threshold, shape=list(self.dtm.shape),
+                    transform=list(self.profile["transform"])[:6], sources=sources,
+                    window=window._asdict() if window is not None else None, cells=int(cells.size),
+                    rows=rows.tolist(), cols=cols.tolist(), pq_lim=values.tolist(), source_id=ids)
+
+    def to_geotiff(self, footprints):
+        """GeoTIFF (bytes) of the combined pq_lim over the window of the reached cells."""
+        from rasterio.windows import Window as RioWindow, transform as window_transform
+        cells, values, ids = combine(footprints)
+        window = cells_window(cells, self.dtm.shape[1])
+        if window is None:
+            raise ValueError("no cell reached")
+        rows, cols = np.divmod(cells, self.dtm.shape[1])
+        arr = np.full((window.nrows, window.ncols), np.nan)
+        arr[rows - window.row_off, cols - window.col_off] = values
+        profile = dict(self.profile)
+        profile.update(width=window.ncols, height=window.nrows,
+                       transform=window_transform(RioWindow(window.col_off, window.row_off,
+                                                            window.ncols, window.nrows),
+                                                  self.profile["transform"]))
+        fd, path = tempfile.mkstemp(suffix=".tif")
+        os.close(fd)
+        try:
+            msf_io.write_raster(path, arr, profile)
+            with open(path, "rb") as f:
+                return f.read()
+        finally:
+            os.remove(path)
+
+
+# ---------------------------------------------------------------------------
+# HTTP API
+# ---------------------------------------------------------------------------
+class _Handler(BaseHTTPRequestHandler):
+    server_version = "MSFService/1.0"
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def _send(self, status, body, content_type="application/json"):
+        if content_type == "application/json":
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _runout(self, request):
+        model = self.server.model
+        t0 = time.perf_counter()
+        thr = float(request.get("H_L_threshold", self.server.h_l_threshold))
+        fmt = request.get("format", "json")
+        if fmt not in ("json", "geotiff"):
+            raise ValueError("format must be json or geotiff")
+        points = request.get("points")
+        if not points:
+            raise ValueError("no points")
+        sources, footprints = model.query(points, thr)
+        if fmt == "geotiff":
+            self._send(200, model.to_geotiff(footprints), "image/tiff")
+        else:
+            answer = model.to_json(sources, footprints, thr)
+            answer["elapsed_ms"] = (time.perf_counter() - t0) * 1000.0
+            self._send(200, answer)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        try:
+            if url.path == "/health":
+                self._send(200, self.server.model.info())
+            elif url.path == "/runout":
+                point = dict(x=query.pop("x"), y=query.pop("y"), source=query.pop("source", None))
+                if "id" in query:
+                    point["id"] = query.pop("id")
+                query["points"] = [point]
+                self._runout(query)
+            else:
+                self._send(404, dict(error="unknown path " + url.path))
+        except (KeyError, ValueError, TypeError) as e:
+            self._send(400, dict(error="bad request: {}".format(e)))
+        except Exception as e:
+            self._send(500, dict(error=str(e)))
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        try:
+            if url.path != "/runout":
+                self._send(404, dict(error="unknown path " + url.path))
+                return
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length).decode("utf-8"))
+            if not isinstance(request, dict):
+                raise ValueError("the request must be a JSON object")
+            points = request.get("points") or []
+            if not isinstance(points, list) or not all(isinstance(p, (list, dict)) for p in points):
+                raise ValueError("points must be a list of {x, y, source, ...} objects or [x, y, source] lists")
+            request["points"] = [dict(zip(("x", "y", "source"), p)) if isinstance(p, list) else p
+                                 for p in points]
+            self._runout(request)
+        except (KeyError, ValueError, TypeError) as e:
+            self._send(400, dict(error="bad request: {}".format(e)))
+        except Exception as e:
+            self._send(500, dict(error=str(e)))
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # listen backlog: bursts of requests are queued, not reset
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def make_server(model, host="127.0.0.1", port=8765, socket_path=None, h_l_threshold=0.19):
+    """Threaded HTTP server of a RunoutModel on host:port, or on a Unix
+    socket when socket_path is given (serve with .serve_forever())."""
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = _UnixHTTPServer(socket_path, _Handler)
+    else:
+        server = _HTTPServer((host, port), _Handler)
+    server.model = model
+    server.h_l_threshold = float(h_l_threshold)
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Resident MSF runout service.")
+    parser.add_argument("DTM", help="filled DTM (GeoTIFF)")
+    parser.add_argument("--cachedir", help="grid cache folder shared with the batch runs")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--socket", help="serve on this Unix socket instead of host:port")
+    parser.add_argument("--threshold", type=float, default=0.19, help="default H_L_threshold")
+    parser.add_argument("--runners", type=int, help="concurrent runs (default min(4, cores))")
+    parser.add_argument("--vertical-raster", action="store_true", help="use the DTM as vertical raster")
+    parser.add_argument("--unbounded", action="store_true", help="do not bound the propagation")
+    args = parser.parse_args(argv)
+
+    model = RunoutModel(args.DTM, use_vertical_raster=args.vertical_raster, bounded=not args.unbounded,
+                        cachedir=args.cachedir, n_runners=args.runners)
+    server = make_server(model, args.host, args.port, args.socket, args.threshold)
+    print("Serving on " + (args.socket or "http://{}:{}".format(args.host, args.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
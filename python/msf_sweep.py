@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+
+"""
+Parameter sweeps of the MSF model (calibration of H_L_threshold and of the
+horizontal/vertical factors).
+
+The H/L threshold only enters the final Con(h_l >= H_L_threshold) mask, so
+li and fri are propagated once and every threshold of the sweep is applied
+to the same h_l and pqi. Across factor settings the two passes are shared
+as far as possible: li only depends on the li horizontal factor and the
+vertical factor, fri only on the fri horizontal factor and the vertical
+factor, so e.g. a sweep over HfLinear parameters computes li once per
+source. sweep_members hands out the combined rasters one at a time, for
+sweeps whose rasters do not all fit in memory.
+"""
+# Name: msf_sweep.py
+# Description: Sweep of H_L_threshold values and factor settings sharing the
+#              path distance passes between the cases.
+
+import itertools
+from collections import namedtuple
+
+import numpy as np
+
+import msf_engine
+import msf_graph
+from msf_engine import Window, window_slices
+
+SweepCase = namedtuple("SweepCase", "hf_li hf_fri vf")
+
+
+def sweep_cases(hf_li=(msf_engine.HF_LI,), hf_fri=(msf_engine.HF_FRI,), vf=(msf_engine.VF_MSF,)):
+    """All combinations of the given factor settings, as SweepCase."""
+    return [SweepCase(a, b, c) for a, b, c in itertools.product(hf_li, hf_fri, vf)]
+
+
+def _union(a, b):
+    """Smallest Window containing a and b."""
+    r0 = min(a.row_off, b.row_off)
+    c0 = min(a.col_off, b.col_off)
+    r1 = max(a.row_off + a.nrows, b.row_off + b.nrows)
+    c1 = max(a.col_off + a.ncols, b.col_off + b.ncols)
+    return Window(r0, c0, r1 - r0, c1 - c0)
+
+
+def run_sweep(dtm, fdir_deg, cellsize, sources, thresholds, cases=None, vertical=None,
+              bounded=True, z_min=None, log=print, graphs=None):
+    """Combined pq_lim of per-source runs for every threshold and factor case.
+
+    sources    : list of (fid, row, col, value), one MSF run per entry
+    thresholds : H_L_threshold values of the sweep
+    cases      : list of SweepCase (default: the factors of the MSF model)
+    graphs     : optional dict (hf, vf) -> msf_graph.Graph of every factor
+                 setting of the cases (vf None without vertical raster);
+                 the passes then run on the precomputed graphs
+
+    Returns (pq_max, h_l_crit): pq_max[i][j] is the float32 combined maximum
+    of case i and threshold j (the same raster as a run with those settings),
+    h_l_crit[i] the critical threshold of case i, i.e. the largest threshold
+    at which each cell still has a pq_lim value (the maximum h_l over the
+    sources). With bounded=True the fronts stop at the bound of the lowest
+    threshold, so h_l_crit is NoData below min(thresholds).
+    """
+    dtm = np.asarray(dtm, dtype=np.float64)
+    thresholds = [float(t) for t in thresholds]
+    thr_min = min(thresholds)
+    cases = cases or sweep_cases()
+    if bounded and z_min is None:
+        z_min = np.nanmin(dtm)
+    # the vertical factor plays no role without a vertical raster
+    vkey = [case.vf if vertical is not None else None for case in cases]
+    pq_max = [[np.full(dtm.shape, np.nan, dtype=np.float32) for _ in thresholds] for _ in cases]
+    h_l_crit = [np.full(dtm.shape, np.nan, dtype=np.float32) for _ in cases]
+    full = Window(0, 0, dtm.shape[0], dtm.shape[1])
+    dist = np.full(dtm.size, np.inf) if graphs is not None else None
+
+    for n, (fid, row, col, value) in enumerate(sources):
+        src_r, src_c, src_val = np.array([row]), np.array([col]), np.array([float(value)])
+        # one li pass per (hf_li, vf) and one fri pass per (hf_fri, vf), over
+        # the union of the windows and up to the largest bound of the cases
+        li_max, fri_max = {}, {}
+        window = None
+        for case, vk in zip(cases, vkey):
+            w, lm, fm = None, np.inf, np.inf
+            if bounded:
+                w, lm, fm = msf_engine.msf_window(dtm, src_r, src_c, src_val, cellsize, thr_min,
+                                                  case.hf_li, case.hf_fri, case.vf, vertical, z_min)
+            w = w or full
+            window = w if window is None else _union(window, w)
+            li_max[(case.hf_li, vk)] = max(li_max.get((case.hf_li, vk), 0.0), lm)
+            fri_max[(case.hf_fri, vk)] = max(fri_max.get((case.hf_fri, vk), 0.0), fm)
+        win = window_slices(window)
+        dtm_w = dtm[win]
+        hdir_w = np.asarray(fdir_deg)[win]
+        vertical_w = None if vertical is None else np.asarray(vertical)[win]
+        src_w = (src_r - window.row_off, src_c - window.col_off, src_val)
+        if graphs is None:
+            li = dict((key, msf_engine.path_allocation(src_w, hdir_w, cellsize, key[0], key[1],
+                                                       vertical_w, cost).distance)
+                      for key, cost in li_max.items())
+            fri = dict((key, msf_engine.path_allocation(src_w, hdir_w, cellsize, key[0], key[1],
+                                                        vertical_w, cost).distance)
+                       for key, cost in fri_max.items())
+        else:
+            cell = [int(row) * dtm.shape[1] + int(col)]
+            li = dict((key, msf_graph.window_distance(graphs[key], cell, cost, dist, window))
+                      for key, cost in li_max.items())
+            fri = dict((key, msf_graph.window_distance(graphs[key], cell, cost, dist, window))
+                       for key, cost in fri_max.items())
+
+        for i, (case, vk) in enumerate(zip(cases, vkey)):
+            l = li[(case.hf_li, vk)]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                h_l = (float(value) - dtm_w) / (l + msf_engine.EPS)
+                pqi = l / (fri[(case.hf_fri, vk)] + msf_engine.EPS)
+                crit = np.where(~np.isnan(pqi) & (h_l >= thr_min), h_l, np.nan)
+                np.fmax(h_l_crit[i][win], crit, out=h_l_crit[i][win])
+                for j, thr in enumerate(thresholds):
+                    np.fmax(pq_max[i][j][win], np.where(h_l >= thr, pqi, np.nan),
+                            out=pq_max[i][j][win])
+        log("  [{}/{}] Id_{} done ({} li and {} fri passes for {} cases)".format(
+            n + 1, len(sources), fid, len(li), len(fri), len(cases)))
+    return pq_max, h_l_crit
+
+
+def sweep_members(dtm, fdir_deg, cellsize, sources, thresholds, cases=None, vertical=None,
+                  bounded=True, z_min=None, log=print, graphs=None, max_rasters=None):
+    """Combined pq_lim of every case and threshold of a sweep, one at a time.
+
+    Yields (i, j, pq_max) with pq_max the raster pq_max[i][j] of run_sweep.
+    The cases run in groups of max_rasters // len(thresholds) cases (at
+    least one, the default): only the rasters of one group are kept, at the
+    cost of running the li passes again for every group.
+    """
+    cases = cases or sweep_cases()
+    per_group = max(1, int(max_rasters or 0) // len(thresholds))
+    for start in range(0, len(cases), per_group):
+        pq_max, _ = run_sweep(dtm, fdir_deg, cellsize, sources, thresholds, cases[start:start + per_group],
+                              vertical, bounded, z_min, log, graphs)
+        for i, rasters in enumerate(pq_max):
+            for j in range(len(rasters)):
+                raster, rasters[j] = rasters[j], None
+                yield start + i, j, raster
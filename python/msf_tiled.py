@@ -0,0 +1,512 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+
+"""
+Out-of-core (tiled) MSF processing for DTMs larger than memory.
+
+The DTM is streamed from the GeoTIFF into memory-mapped .npy files and the
+flow direction is computed tile by tile with a one cell halo; flat areas
+that cross tile borders are resolved by passing the flat distances between
+neighbouring tiles until nothing changes. Path distances are propagated
+inside one tile at a time: costs leaving a tile are queued as seeds of the
+neighbour tile, and tiles are processed (lowest pending cost first) until
+no front is left. Only a bounded number of tiles is kept in memory, the
+others are spilled to disk, so memory use is set by the tile budget and
+not by the DTM size. Results are identical to the in-memory engine.
+"""
+# Name: msf_tiled.py
+# Description: Tiled flow direction, tiled path distance propagation with
+#              halo exchange and tile store with a memory budget.
+
+import os
+import heapq
+import shutil
+import tempfile
+import itertools
+from collections import OrderedDict, deque
+
+import numpy as np
+
+import msf_cache
+import msf_engine
+import msf_io
+from msf_engine import njit, Window, window_slices
+
+
+# ---------------------------------------------------------------------------
+# Tiles
+# ---------------------------------------------------------------------------
+class TileLayout:
+    """Regular tiling of a nrows x ncols raster in tiles of tile_size cells."""
+
+    def __init__(self, nrows, ncols, tile_size=1024):
+        self.nrows = int(nrows)
+        self.ncols = int(ncols)
+        self.tile_size = int(tile_size)
+        self.ntile_rows = -(-self.nrows // self.tile_size)
+        self.ntile_cols = -(-self.ncols // self.tile_size)
+
+    def tiles(self):
+        return itertools.product(range(self.ntile_rows), range(self.ntile_cols))
+
+    def tile_of(self, row, col):
+        return int(row) // self.tile_size, int(col) // self.tile_size
+
+    def window(self, tile):
+        r0, c0 = tile[0] * self.tile_size, tile[1] * self.tile_size
+        return Window(r0, c0, min(self.tile_size, self.nrows - r0), min(self.tile_size, self.ncols - c0))
+
+    def neighbours(self, tile):
+        ti, tj = tile
+        for di in (-1, 0, 1):
+            for dj in (-1, 0, 1):
+                if (di or dj) and 0 <= ti + di < self.ntile_rows and 0 <= tj + dj < self.ntile_cols:
+                    yield ti + di, tj + dj
+
+    def blocks(self, arr):
+        """(row_off, col_off, block) of every tile of a full-size array (for write_raster_blocks)."""
+        for tile in self.tiles():
+            w = self.window(tile)
+            yield w.row_off, w.col_off, np.asarray(arr[window_slices(w)])
+
+
+def read_halo(arr, window, fill):
+    """Block of arr covering window plus a one cell halo, fill outside the raster."""
+    nrows, ncols = arr.shape
+    out = np.full((window.nrows + 2, window.ncols + 2), fill, dtype=arr.dtype)
+    r0, c0 = window.row_off - 1, window.col_off - 1
+    r1, c1 = window.row_off + window.nrows + 1, window.col_off + window.ncols + 1
+    rr0, cc0 = max(r0, 0), max(c0, 0)
+    rr1, cc1 = min(r1, nrows), min(c1, ncols)
+    out[rr0 - r0:rr1 - r0, cc0 - c0:cc1 - c0] = arr[rr0:rr1, cc0:cc1]
+    return out
+
+
+class TileStore:
+    """Tiles of a raster created on demand (filled with fill) and kept in
+    memory up to max_tiles; the least recently used ones are spilled to
+    spilldir and loaded back when needed.
+
+    An array returned by get() is only valid until the next get() on the
+    same store (it may be spilled afterwards). With remove_dir, close() also
+    removes spilldir.
+    """
+
+    _names = itertools.count()
+
+    def __init__(self, layout, dtype, fill, max_tiles, spilldir, remove_dir=False):
+        self.layout = layout
+        self.dtype = dtype
+        self.fill = fill
+        self.max_tiles = max(1, int(max_tiles))
+        self.spilldir = spilldir
+        self.remove_dir = remove_dir
+        self._name = "tiles{}_{}".format(os.getpid(), next(TileStore._names))
+        self._resident = OrderedDict()
+        self._spilled = set()
+
+    def __contains__(self, tile):
+        return tile in self._resident or tile in self._spilled
+
+    def __len__(self):
+        return len(self._resident) + len(self._spilled)
+
+    def tiles(self):
+        return sorted(set(self._resident) | self._spilled)
+
+    def _path(self, tile):
+        return os.path.join(self.spilldir, "{}_{}_{}.npy".format(self._name, tile[0], tile[1]))
+
+    def get(self, tile, create=True):
+        """Array of a tile, None if the tile does not exist and create is False."""
+        arr = self._resident.get(tile)
+        if arr is not None:
+            self._resident.move_to_end(tile)
+            return arr
+        if tile in self._spilled:
+            path = self._path(tile)
+            arr = np.load(path)
+            os.remove(path)
+            self._spilled.discard(tile)
+        elif create:
+            w = self.layout.window(tile)
+            arr = np.full((w.nrows, w.ncols), self.fill, dtype=self.dtype)
+        else:
+            return None
+        self._resident[tile] = arr
+        while len(self._resident) > self.max_tiles:
+            old, old_arr = self._resident.popitem(last=False)
+            np.save(self._path(old), old_arr)
+            self._spilled.add(old)
+        return arr
+
+    def blocks(self):
+        """(row_off, col_off, array) of every existing tile (for write_raster_blocks)."""
+        for tile in self.tiles():
+            w = self.layout.window(tile)
+            yield w.row_off, w.col_off, self.get(tile, create=False)
+
+    def close(self):
+        """Drop every tile and remove the spilled files."""
+        for tile in self._spilled:
+            try:
+                os.remove(self._path(tile))
+            except OSError:
+                pass
+        self._spilled = set()
+        self._resident.clear()
+        if self.remove_dir:
+            shutil.rmtree(self.spilldir, ignore_errors=True)
+
+
+# ---------------------------------------------------------------------------
+# Tiled DTM preparation (flow direction with halo exchange)
+# ---------------------------------------------------------------------------
+def _flat_joins(z_h, fd_t, done_h):
+    """True if an unresolved flat cell of a tile (fd_t, DTM block with halo
+    z_h) touches a cell of the same elevation among the halo cells marked
+    in done_h: the flat area may then continue or drain there."""
+    flat = fd_t == msf_engine.FLAT_UNRESOLVED
+    if not flat.any():
+        return False
+    nrows, ncols = fd_t.shape
+    z = z_h[1:-1, 1:-1]
+    for dr, dc in zip(msf_engine.D8_DROW, msf_engine.D8_DCOL):
+        win = slice(1 + dr, 1 + dr + nrows), slice(1 + dc, 1 + dc + ncols)
+        if np.any(flat & done_h[win] & (z_h[win] == z)):
+            return True
+    return False
+
+
+def _tiled_flow_direction(dtm, fdir, layout, cellsize, scratch, log=print, tiles=None):
+    """D8 flow direction of a memory-mapped DTM written tile by tile into fdir.
+
+    With tiles, only these tiles are computed again (fdir holds the flow
+    direction of the others), plus the tiles sharing a flat area with them:
+    flats crossing the border of the updated tiles are resolved again as a
+    whole. Returns the list of tiles computed.
+    """
+    nrows, ncols = dtm.shape
+    fd = np.lib.format.open_memmap(scratch, mode="w+", dtype=np.int32, shape=dtm.shape)
+
+    def steepest(tile):
+        w = layout.window(tile)
+        fdir_t = np.zeros((w.nrows, w.ncols), dtype=np.int32)
+        fd_t = np.zeros((w.nrows, w.ncols), dtype=np.int32)
+        msf_engine._d8_steepest_kernel(read_halo(dtm, w, np.nan), float(cellsize), w.row_off,
+                                       w.col_off, nrows, ncols, fdir_t, fd_t)
+        fd[window_slices(w)] = fd_t
+        return fdir_t, fd_t
+
+    flats = []
+    done = set()
+    todo = list(layout.tiles()) if tiles is None else sorted(set(tiles))
+    while todo:
+        for tile in todo:
+            fdir_t, fd_t = steepest(tile)
+            fdir[window_slices(layout.window(tile))] = fdir_t
+            done.add(tile)
+            if np.any(fd_t == msf_engine.FLAT_UNRESOLVED):
+                flats.append(tile)
+        if tiles is None:
+            break
+        # Tiles around the updated ones: their flat distances are the halo of
+        # the updated tiles, and a flat area reaching an updated tile joins them
+        todo = []
+        for tile in sorted(set(nb for t in done for nb in layout.neighbours(t)) - done):
+            _, fd_t = steepest(tile)
+            done_h = np.zeros((fd_t.shape[0] + 2, fd_t.shape[1] + 2), dtype=bool)
+            for ti, tj in layout.neighbours(tile):
+                if (ti, tj) in done:
+                    di, dj = ti - tile[0], tj - tile[1]
+                    done_h[0 if di < 0 else -1 if di > 0 else slice(1, -1),
+                           0 if dj < 0 else -1 if dj > 0 else slice(1, -1)] = True
+            if _flat_joins(read_halo(dtm, layout.window(tile), np.nan), fd_t, done_h):
+                todo.append(tile)
+
+    # Flat distances: a tile is updated again whenever a neighbour changed
+    # the distances on their common border, until no border changes
+    flat_tiles = set(flats)
+    queue = deque(flats)
+    queued = set(flats)
+    n_updates = 0
+    while queue:
+        tile = queue.popleft()
+        queued.discard(tile)
+        w = layout.window(tile)
+        fd_h = read_halo(fd, w, msf_engine.FLAT_NODATA)
+        border = msf_engine._flat_distance_kernel(read_halo(dtm, w, np.nan), fd_h)
+        fd[window_slices(w)] = fd_h[1:-1, 1:-1]
+        n_updates += 1
+        if border:
+            for nb in layout.neighbours(tile):
+                if nb in flat_tiles and nb not in queued:
+                    queue.append(nb)
+                    queued.add(nb)
+    if flats:
+        log("  Flats resolved in {} tiles ({} tile updates)".format(len(flats), n_updates))
+
+    for tile in flats:
+        w = layout.window(tile)
+        win = window_slices(w)
+        fdir_t = np.asarray(fdir[win], dtype=np.int32)
+        msf_engine._flat_assign_kernel(read_halo(dtm, w, np.nan),
+                                       read_halo(fd, w, msf_engine.FLAT_NODATA), fdir_t)
+        fdir[win] = fdir_t
+    del fd
+    os.remove(scratch)
+    return sorted(done)
+
+
+def tiled_grids(path, cache=None, workdir=None, tile_size=1024, log=print):
+    """msf_cache.DTMGrids of a DTM file computed tile by tile, never holding
+    the whole DTM in memory.
+
+    The arrays are memory-mapped .npy files stored in the cache (same key and
+    layout as msf_cache.dtm_grids, so both share the entries) or, without a
+    cache, in workdir (a new temporary folder if None).
+    """
+    if cache is not None:
+        key = cache.key_for_file(path)
+        if key is not None:
+            grids = cache.load(key)
+            if grids is not None:
+                log("  DTM grids loaded from cache: " + key)
+                cache.count("grids", True)
+                return grids
+    profile = msf_io.raster_info(path)
+    nrows, ncols = profile["height"], profile["width"]
+    cellsize = msf_io.cell_size(profile)
+    layout = TileLayout(nrows, ncols, tile_size)
+    if cache is not None:
+        folder = cache.new_entry("incoming")
+    else:
+        folder = workdir or tempfile.mkdtemp(prefix="msf_grids_")
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    def create(name, dtype):
+        return np.lib.format.open_memmap(os.path.join(folder, name + ".npy"), mode="w+",
+                                         dtype=dtype, shape=(nrows, ncols))
+
+    # DTM streamed by rows: copy, content key and statistics in one read
+    dtm = create("dtm", np.float64)
+    stats = dict(z_min=np.inf, z_max=-np.inf, total=0.0, count=0)
+
+    def rows():
+        for row_off, block in msf_io.read_blocks(path, layout.tile_size):
+            dtm[row_off:row_off + block.shape[0]] = block
+            valid = block[~np.isnan(block)]
+            if valid.size:
+                stats["z_min"] = min(stats["z_min"], float(valid.min()))
+                stats["z_max"] = max(stats["z_max"], float(valid.max()))
+                stats["total"] += float(valid.sum())
+                stats["count"] += valid.size
+            yield block
+
+    key = msf_cache.dtm_key_blocks(rows(), profile)
+    if cache is not None:
+        cache.count("grids", cache.has(key))
+    if cache is not None and cache.has(key):
+        del dtm
+        shutil.rmtree(folder, ignore_errors=True)
+        cache.remember_file(path, key)
+        log("  DTM grids loaded from cache: " + key)
+        return cache.load(key)
+
+    log("  Computing DTM grids tile by tile ({}x{} tiles): {}".format(
+        layout.ntile_rows, layout.ntile_cols, key))
+    fdir = create("fdir", np.uint8)
+    _tiled_flow_direction(dtm, fdir, layout, cellsize, os.path.join(folder, "fd_scratch.npy"), log)
+    fdir_deg = create("fdir_deg", np.float32)  # exact, as in msf_cache.GridCache
+    nbr_mask = create("nbr_mask", np.uint8)
+    for tile in layout.tiles():
+        w = layout.window(tile)
+        win = window_slices(w)
+        fdir_deg[win] = msf_engine.fdir_to_degrees(fdir[win])
+        nbr_mask[win] = msf_cache.neighbour_mask(read_halo(dtm, w, np.nan))[1:-1, 1:-1]
+    for arr in (dtm, fdir, fdir_deg, nbr_mask):
+        arr.flush()
+    grids = msf_cache.DTMGrids(key=key, dtm=dtm, profile=profile, cellsize=cellsize, fdir=fdir,
+                               fdir_deg=fdir_deg, nbr_mask=nbr_mask,
+                               nbr_dist=msf_cache.neighbour_distances(cellsize),
+                               z_min=stats["z_min"], z_max=stats["z_max"],
+                               z_mean=stats["total"] / max(stats["count"], 1))
+    if cache is None:
+        return grids
+    meta = msf_cache.grids_meta(grids)
+    del dtm, fdir, fdir_deg, nbr_mask, grids
+    cache.commit(key, folder, meta)
+    cache.remember_file(path, key)
+    return cache.load(key)
+
+
+# ---------------------------------------------------------------------------
+# Tiled path distance propagation
+# ---------------------------------------------------------------------------
+@njit(cache=True)
+def _tile_kernel(hdir_h, vz_h, cellsize, hf_kind, hf0, hf1, hf2, use_vf, vf0, vf_lo, vf_hi,
+                 row_off, col_off, nrows_all, ncols_all, max_cost, dist, seed_r, seed_c, seed_d,
+                 out_d):
+    # Dijkstra inside one tile. hdir_h / vz_h have a one cell halo, dist
+    # covers the tile; the costs reaching halo cells (i.e. leaving the tile)
+    # are kept in out_d (halo sized) and become seeds of the neighbour tiles.
+    nrows, ncols = dist.shape
+    heap = [(0.0, np.int64(0))]
+    heap.pop()
+    for i in range(seed_r.size):
+        r = seed_r[i]
+        c = seed_c[i]
+        if seed_d[i] < dist[r, c]:
+            dist[r, c] = seed_d[i]
+            heapq.heappush(heap, (seed_d[i], np.int64(r * ncols + c)))
+    visited = 0
+    while len(heap) > 0:
+        d, idx = heapq.heappop(heap)
+        r = idx // ncols
+        c = idx - r * ncols
+        if d > dist[r, c]:
+            continue
+        visited += 1
+        for k in range(8):
+            rr = r + msf_engine.D8_DROW[k]
+            cc = c + msf_engine.D8_DCOL[k]
+            gr = row_off + rr
+            gc = col_off + cc
+            if gr < 0 or gr >= nrows_all or gc < 0 or gc >= ncols_all:
+                continue
+            nd = d + msf_engine._edge_cost(r + 1, c + 1, k, hdir_h, vz_h, cellsize, hf_kind, hf0,
+                                           hf1, hf2, use_vf, vf0, vf_lo, vf_hi)
+            if nd > max_cost:
+                continue
+            if 0 <= rr < nrows and 0 <= cc < ncols:
+                if nd < dist[rr, cc]:
+                    dist[rr, cc] = nd
+                    heapq.heappush(heap, (nd, np.int64(rr * ncols + cc)))
+            elif nd < out_d[rr + 1, cc + 1]:
+                out_d[rr + 1, cc + 1] = nd
+    return visited
+
+
+def tiled_distances(grids, layout, src_rows, src_cols, store, hf=msf_engine.HF_LI, vf=None,
+                    vertical=None, max_cost=np.inf):
+    """Path distances of a group of source cells computed tile by tile.
+
+    The costs are written in store (a TileStore of float64 filled with inf,
+    inf where unreached); only the tiles the fronts reach are created.
+    Returns the number of cells visited (re-visits included).
+    """
+    hf_kind, hf0, hf1, hf2 = msf_engine._hf_args(hf)
+    use_vf, vf0, vf_lo, vf_hi = msf_engine._vf_args(vf, vertical)
+    no_vz = np.empty((1, 1))
+    pending = {}
+    heap = []
+    for r, c in zip(src_rows, src_cols):
+        tile = layout.tile_of(r, c)
+        pending.setdefault(tile, []).append((0.0, int(r), int(c)))
+        heapq.heappush(heap, (0.0, tile))
+    visited = 0
+    while heap:
+        _, tile = heapq.heappop(heap)
+        seeds = pending.pop(tile, None)
+        if not seeds:
+            continue
+        w = layout.window(tile)
+        seed_d, seed_r, seed_c = np.array(seeds).T
+        out_d = np.full((w.nrows + 2, w.ncols + 2), np.inf)
+        visited += _tile_kernel(read_halo(grids.fdir_deg, w, np.nan),
+                                read_halo(vertical, w, np.nan) if use_vf else no_vz,
+                                float(grids.cellsize), hf_kind, hf0, hf1, hf2,
+                                use_vf, vf0, vf_lo, vf_hi, w.row_off, w.col_off,
+                                layout.nrows, layout.ncols, float(max_cost), store.get(tile),
+                                seed_r.astype(np.int64) - w.row_off,
+                                seed_c.astype(np.int64) - w.col_off, seed_d, out_d)
+        # pass the costs that left the tile to the neighbour tiles
+        rr, cc = np.nonzero(np.isfinite(out_d))
+        first = {}
+        for r, c, d in zip(rr + w.row_off - 1, cc + w.col_off - 1, out_d[rr, cc]):
+            nb = layout.tile_of(r, c)
+            pending.setdefault(nb, []).append((float(d), int(r), int(c)))
+            first[nb] = min(first.get(nb, np.inf), d)
+        for nb, d in first.items():
+            heapq.heappush(heap, (d, nb))
+    return visited
+
+
+def run_tiled(grids, sources, h_l_threshold=0.19, hf_li=msf_engine.HF_LI,
+              hf_fri=msf_engine.HF_FRI, vf=msf_engine.VF_MSF, use_vertical_raster=False,
+              tile_size=1024, memory_mb=1024, workdir=None, bounded=True, log=print):
+    """Per-source MSF runs combined with the maximum, processed tile by tile.
+
+    grids     : msf_cache.DTMGrids (e.g. from tiled_grids, memory-mapped)
+    sources   : list of (fid, row, col, value), one MSF run per entry
+    memory_mb : budget for the tiles kept in memory (li, fri and the combined
+                maximum); tiles beyond it are spilled to workdir
+    bounded   : stop every front at the H/L threshold bound
+
+    Returns (pq_max, failed): pq_max is a TileStore of the combined float32
+    maximum (write it with msf_io.write_raster_blocks(path, profile,
+    pq_max.blocks()), then call pq_max.close()), failed a list of
+    (fid, error message).
+    """
+    nrows, ncols = grids.dtm.shape
+    layout = TileLayout(nrows, ncols, tile_size)
+    tile_bytes = 8 * layout.tile_size ** 2
+    max_tiles = max(2, int(memory_mb * 1024 ** 2) // (3 * tile_bytes))
+    spilldir = workdir or tempfile.mkdtemp(prefix="msf_tiles_")
+    if not os.path.exists(spilldir):
+        os.makedirs(spilldir)
+    # the folder of a temporary spill goes away with the combined maximum
+    vertical = grids.dtm if use_vertical_raster else None
+    thr = float(h_l_threshold)
+    pq_max = TileStore(layout, np.float32, np.nan, 2 * max_tiles, spilldir,
+                       remove_dir=workdir is None)
+    failed = []
+    for i, (fid, row, col, value) in enumerate(sources):
+        li = TileStore(layout, np.float64, np.inf, max_tiles, spilldir)
+        fri = TileStore(layout, np.float64, np.inf, max_tiles, spilldir)
+        try:
+            li_max = fri_max = np.inf
+            if bounded:
+                li_max, fri_max, _ = msf_engine.propagation_bounds(value, grids.z_min, thr, hf_li,
+                                                                   hf_fri, vf, vertical)
+            visited = tiled_distances(grids, layout, [row], [col], li, hf_li, vf, vertical, li_max)
+            visited += tiled_distances(grids, layout, [row], [col], fri, hf_fri, vf, vertical,
+                                       fri_max)
+            for tile in li.tiles():
+                if tile not in fri:
+                    continue
+                w = layout.window(tile)
+                li_t = li.get(tile)
+                li_t = np.where(np.isinf(li_t), np.nan, li_t)
+                fri_t = fri.get(tile)
+                fri_t = np.where(np.isinf(fri_t), np.nan, fri_t)
+                pq = msf_engine.pq_lim_fused(np.asarray(grids.dtm[window_slices(w)]),
+                                             np.full(li_t.shape, float(value)), li_t, fri_t, thr)
+                if np.all(np.isnan(pq)):
+                    continue
+                out = pq_max.get(tile)
+                np.fmax(out, pq, out=out)
+            log("  [{}/{}] Id_{} done ({} tiles, {} cells visited)".format(
+                i + 1, len(sources), fid, len(li), visited))
+        except Exception as e:
+            failed.append((fid, "{}: {}".format(type(e).__name__, e)))
+            log("  [{}/{}] Id_{} FAILED: {}".format(i + 1, len(sources), fid, e))
+        finally:
+            li.close()
+            fri.close()
+    return pq_max, failed
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+
+"""
+Incremental update of a run after a local change of the DTM (a landslide,
+dredging, a new check dam, ...).
+
+The DTM is compared tile by tile with the one of the previous run (whose
+grids are in the cache): flow direction is computed again only in the
+changed tiles and their neighbours (and in the tiles sharing a flat area
+with them), the other tiles are copied. A source is run again only if a
+changed cell (DTM or flow direction) lies in the window its propagation can
+reach or in its previous footprint; the footprints of the other sources are
+kept under their new keys. The combined rasters are then patched in place
+over the window covering the old and new footprints of the sources run
+again, instead of being written again.
+
+The state of the last run (DTM key and sources) is kept in
+pq_lim_all/run_state.json.
+"""
+# Name: msf_update.py
+# Description: DTM diff, flow direction update of the changed tiles, choice
+#              of the sources to run again and in-place patch of the
+#              combined rasters.
+
+import os
+import json
+import shutil
+import tempfile
+
+import numpy as np
+
+import msf_cache
+import msf_engine
+import msf_footprints
+import msf_io
+import msf_journal
+import msf_tiled
+from msf_engine import Window, window_slices
+
+
+# ---------------------------------------------------------------------------
+# Run state
+# ---------------------------------------------------------------------------
+def read_state(path):
+    """State of the last run (dict with dtm_key and sources), None if missing."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_state(path, dtm_key, source_keys):
+    """Save the DTM key and the footprint keys of the sources of a run."""
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(dict(dtm_key=dtm_key, sources=sources_key(source_keys)), f, indent=1)
+    os.replace(tmp, path)
+
+
+def sources_key(source_keys):
+    """Key of a set of source footprint keys (dict fid -> key)."""
+    return msf_journal.run_key(sorted(source_keys.values()))
+
+
+# ---------------------------------------------------------------------------
+# DTM diff and grid update
+# ---------------------------------------------------------------------------
+def _differ(a, b):
+    """Cells where two arrays differ, NaN equal to NaN."""
+    a, b = np.asarray(a), np.asarray(b)
+    if a.dtype.kind != "f":
+        return a != b
+    return ~((a == b) | (np.isnan(a) & np.isnan(b)))
+
+
+def changed_tiles(old_dtm, new_dtm, layout):
+    """Tiles of layout where two DTMs of the same shape differ."""
+    return [tile for tile in layout.tiles()
+            if _differ(old_dtm[window_slices(layout.window(tile))],
+                       new_dtm[window_slices(layout.window(tile))]).any()]
+
+
+def update_grids(old, dtm, profile, tiles, layout, cache=None, log=print):
+    """msf_cache.DTMGrids of dtm from the grids old of a DTM differing only in
+    tiles: flow direction and neighbour masks are computed again in these
+    tiles and their neighbours (see msf_tiled._tiled_flow_direction), the
+    rest is copied. Stored in the cache when given."""
+    key = msf_cache.dtm_key(dtm, profile)
+    cellsize = msf_io.cell_size(profile)
+    folder = cache.new_entry(key) if cache is not None else None
+    arrays = {}
+    for name in ("fdir", "fdir_deg", "nbr_mask"):
+        if folder is None:
+            arrays[name] = np.array(getattr(old, name))
+        else:
+            path = os.path.join(folder, name + ".npy")
+            shutil.copyfile(os.path.join(cache.open_entry(old.key), name + ".npy"), path)
+            arrays[name] = np.load(path, mmap_mode="r+")
+    dirty = set(tiles)
+    for tile in tiles:
+        dirty.update(layout.neighbours(tile))
+    scratchdir = folder or tempfile.mkdtemp(prefix="msf_update_")
+    done = msf_tiled._tiled_flow_direction(dtm, arrays["fdir"], layout, cellsize,
+                                           os.path.join(scratchdir, "fd_scratch.npy"), log, dirty)
+    if folder is None:
+        shutil.rmtree(scratchdir, ignore_errors=True)
+    for tile in done:
+        w = layout.window(tile)
+        win = window_slices(w)
+        arrays["fdir_deg"][win] = msf_engine.fdir_to_degrees(arrays["fdir"][win])
+        arrays["nbr_mask"][win] = msf_cache.neighbour_mask(msf_tiled.read_halo(dtm, w, np.nan))[1:-1, 1:-1]
+    log("  Flow direction updated in {} of {} tiles ({} changed)".format(
+        len(done), layout.ntile_rows * layout.ntile_cols, len(tiles)))
+    grids = msf_cache.DTMGrids(key=key, dtm=dtm, profile=profile, cellsize=cellsize,
+                               nbr_dist=msf_cache.neighbour_distances(cellsize),
+                               z_min=float(np.nanmin(dtm)), z_max=float(np.nanmax(dtm)),
+                               z_mean=float(np.nanmean(dtm)), **arrays)
+    if cache is None:
+        return grids
+    np.save(os.path.join(folder, "dtm.npy"), dtm)
+    for arr in arrays.values():
+        arr.flush()
+    meta = msf_cache.grids_meta(grids)
+    del arrays, grids
+    cache.commit(key, folder, meta)
+    return cache.load(key)
+
+
+def dtm_grids_update(path, state, cache, tile_size=1024, log=print):
+    """(grids, old grids) of a DTM file for an incremental update.
+
+    old grids are the cached grids of the DTM of the last run (state, see
+    read_state) when the file differs from it only locally, None otherwise
+    (no state, first run, DTM unchanged, or another grid): then grids come
+    from msf_cache.dtm_grids and everything runs as usual.
+    """
+    old = cache.load(state["dtm_key"]) if state else None
+    if old is None or cache.key_for_file(path) == old.key:
+        return msf_cache.dtm_grids(path, cache, log), None
+    dtm, profile = msf_io.read_raster(path)
+    if dtm.shape != old.dtm.shape or profile["transform"] != old.profile["transform"]:
+        log("  The DTM grid changed since the last run: full update")
+        return msf_cache.dtm_grids(path, cache, log), None
+    key = msf_cache.dtm_key(dtm, profile)
+    if key == old.key:
+        cache.remember_file(path, key)
+        return old, None
+    grids = cache.load(key)
+    cache.count("grids", grids is not None)
+    if grids is None:
+        layout = msf_tiled.TileLayout(dtm.shape[0], dtm.shape[1], tile_size)
+        tiles = changed_tiles(old.dtm, dtm, layout)
+        log("  DTM changed in {} of {} tiles since the last run: {}".format(
+            len(tiles), layout.ntile_rows * layout.ntile_cols, key))
+        update_grids(old, dtm, profile, tiles, layout, cache, log)
+        grids = cache.load(key)
+    cache.remember_file(path, key)
+    return grids, old
+
+
+def changed_cells(old, new, tile_size=1024):
+    """Sorted flat indices of the cells whose DTM or flow direction differs
+    between two DTMGrids of the same grid."""
+    layout = msf_tiled.TileLayout(new.dtm.shape[0], new.dtm.shape[1], tile_size)
+    out = []
+    for tile in layout.tiles():
+        w = layout.window(tile)
+        win = window_slices(w)
+        rows, cols = np.nonzero(_differ(old.dtm[win], new.dtm[win]) | _differ(old.fdir[win], new.fdir[win]))
+        out.append((rows + w.row_off).astype(np.int64) * new.dtm.shape[1] + cols + w.col_off)
+    return np.sort(np.concatenate(out)) if out else np.zeros(0, dtype=np.int64)
+
+
+# ---------------------------------------------------------------------------
+# Sources to run again
+# ---------------------------------------------------------------------------
+def union_window(a, b):
+    """Smallest Window covering two windows (either may be None)."""
+    if a is None or b is None:
+        return a if b is None else b
+    r0, c0 = min(a.row_off, b.row_off), min(a.col_off, b.col_off)
+    r1 = max(a.row_off + a.nrows, b.row_off + b.nrows)
+    c1 = max(a.col_off + a.ncols, b.col_off + b.ncols)
+    return Window(r0, c0, r1 - r0, c1 - c0)
+
+
+def carry_over(grids, sources, changed, results, old_keys, keys, h_l_threshold, hf_li=msf_engine.HF_LI,
+               hf_fri=msf_engine.HF_FRI, vf=msf_engine.VF_MSF, use_vertical_raster=False):
+    """Keep the footprints of the sources the change cannot affect.
+
+    A source is affected when a changed cell (see changed_cells) lies in the
+    window its propagation can reach on the new DTM (msf_engine.msf_window)
+    or in its previous footprint, or when it has no previous footprint. The
+    footprints of the others are stored under their new keys (results is the
+    msf_cache.FootprintCache, old_keys and keys dict fid -> footprint key
+    on the old and the new DTM).
+
+    Returns (affected fids, Window of the previous footprints of the affected
+    sources or None).
+    """
+    ncols = grids.dtm.shape[1]
+    ch_rows, ch_cols = np.divmod(changed, ncols)
+    vertical = grids.dtm if use_vertical_raster else None
+    affected, window = [], None
+    for fid, row, col, value in sources:
+        if results.has(keys[fid]):
+            continue
+        fp = results.load(old_keys[fid])
+        if fp is not None and changed.size:
+            w, _, _ = msf_engine.msf_window(grids.dtm, np.array([row]), np.array([col]), np.array([value]),
+                                            grids.cellsize, h_l_threshold, hf_li, hf_fri, vf, vertical,
+                                            grids.z_min)
+            if w is None or ((ch_rows >= w.row_off) & (ch_rows < w.row_off + w.nrows) &
+                             (ch_cols >= w.col_off) & (ch_cols < w.col_off + w.ncols)).any():
+                fp_hit = True
+            else:
+                k = np.searchsorted(changed, fp.cells)
+                fp_hit = (changed[np.minimum(k, changed.size - 1)] == fp.cells).any()
+        else:
+            fp_hit = fp is None
+        if fp_hit:
+            affected.append(fid)
+            if fp is not None:
+                window = union_window(window, fp.window)
+        else:
+            results.store(keys[fid], fp, grids.dtm.shape)
+    return affected, window
+
+
+# ---------------------------------------------------------------------------
+# In-place patch of the combined rasters
+# ---------------------------------------------------------------------------
+def patch_combined(paths, footprints, shape, window):
+    """Combine the footprints over window and write the result in place.
+
+    paths      : (pq_lim_combined_max, pq_lim_source_id, pq_lim_overlap_count)
+                 rasters of the previous run
+    footprints : iterable of (fid, Footprint) of all the sources, in the
+                 order of the full combination (same ties)
+    Returns the number of footprints reaching the window.
+    """
+    cropped = ((fid, msf_footprints.crop(fp, window, shape)) for fid, fp in footprints)
+    pq_max, src_id, n_overlap, n = msf_footprints.reduce_footprints(
+        ((fid, fp) for fid, fp in cropped if fp is not None and fp.cells.size),
+        (window.nrows, window.ncols))
+    msf_io.update_raster(paths[0], pq_max, window)
+    msf_io.update_raster(paths[1], src_id, window)
+    msf_io.update_raster(paths[2], np.where(n_overlap > 0, n_overlap, np.nan), window)
+    return n
@@ -4,13 +4,37 @@ Created on Fri Mar 17 14:36:16 2017
 
 @author: stefano
 """
-import shutil
+# Name: pulisci_files_msf.py
+# Description: Prunes the caches of MSF_multiple_points_native.py (DTM grids
+#              and per-source pq_lim footprints) to their age and size
+#              limits. Run journals and combined outputs are left in place.
 
-res = "10m"
+import os
+
+import msf_cache
+
+# Same settings as MSF_multiple_points_native.py
+res = "3m"
 #
-msfdir = "E:/PhD/assegno/CSAsN_PC/analisi/"+res+"/MSF/" # folder to store single MSF results
-rasterdir = "E:/PhD/assegno/CSAsN_PC/analisi/"+res+"/raster_source_split"
+base_path = "C:/test/simulazioni/" + res + "/"
+msfdir = os.path.join(base_path, "MSF") # folder to store single MSF results
+cachedir = "C:/test/simulazioni/cache" # None: no cache
+cache_max_gb = 20 # least recently used DTM grids are removed above this size
+results_max_gb = 20 # least recently used footprints are removed above this size
+max_age_days = 90 # footprints not used for this many days are removed (None: no age limit)
 
-shutil.rmtree(msfdir)
-shutil.rmtree(rasterdir)
-#
\ No newline at end of file
+# Footprints of the result cache, and of the runs without it (msfdir/footprints)
+folders = [os.path.join(msfdir, "footprints")]
+if cachedir:
+    folders.insert(0, os.path.join(cachedir, "footprints"))
+for folder in folders:
+    if os.path.exists(folder):
+        results = msf_cache.FootprintCache(folder, results_max_gb * 1024 ** 3)
+        removed = results.prune(max_age_days=max_age_days)
+        print("Removed {} footprints from {}, {} left".format(len(removed), folder, len(results.entries())))
+
+if cachedir and os.path.exists(cachedir):
+    grids = msf_cache.GridCache(cachedir, cache_max_gb * 1024 ** 3)
+    removed = grids.evict()
+    print("Removed {} cached DTM grids, {} left".format(len(removed), len(grids.entries())))
+#
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+
+# Name: conftest.py
+# Description: Synthetic DTMs and source cells shared by the tests of the
+#              native MSF modules (run with: python -m pytest python/tests).
+
+import os
+import sys
+
+import numpy as np
+import pytest
+from rasterio.transform import from_origin
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import msf_engine  # noqa: E402
+
+CELLSIZE = 3.0
+
+
+def make_dtm(size=40, seed=0, plateau=None, slope=0.4, valleys=3.0):
+    """Filled synthetic DTM of size x size cells: a slope towards south with
+    valleys (of depth about valleys metres) and some noise. plateau: (row0,
+    row1, col0, col1) block set to a single elevation (a flat area)."""
+    rng = np.random.RandomState(seed)
+    rows, cols = np.mgrid[0:size, 0:size].astype(np.float64) * CELLSIZE
+    z = 1000.0 + slope * (size * CELLSIZE - rows) + valleys * np.sin(cols / 12.0) * (1.0 + rows / 60.0)
+    z += rng.normal(0.0, 0.2, z.shape)
+    if plateau is not None:
+        r0, r1, c0, c1 = plateau
+        z[r0:r1, c0:c1] = z[r0:r1, c0:c1].mean()
+    return msf_engine.fill_depressions(z)
+
+
+def make_profile(shape):
+    """Rasterio profile of a synthetic DTM."""
+    return dict(driver="GTiff", height=shape[0], width=shape[1], count=1, dtype="float32", crs=None,
+                transform=from_origin(500000.0, 5000000.0 + shape[0] * CELLSIZE, CELLSIZE, CELLSIZE),
+                nodata=-9999.0)
+
+
+def make_sources(dtm, n, seed=0):
+    """(rows, cols, values) of n source cells on the upper half of a DTM,
+    start_z 2 m above the DTM."""
+    rng = np.random.RandomState(seed)
+    inner = np.zeros(dtm.shape, dtype=bool)
+    inner[1:-1, 1:-1] = True
+    cells = rng.choice(np.flatnonzero(inner & (dtm >= np.median(dtm))), n, replace=False)
+    rows, cols = np.divmod(cells, dtm.shape[1])
+    return rows, cols, dtm[rows, cols] + 2.0
+
+
+def per_source_max(dtm, fdir_deg, sources, h_l_threshold=0.19, **kw):
+    """float32 CellStatistics(MAXIMUM, DATA) of run_msf of every source cell."""
+    out = np.full(dtm.shape, np.nan)
+    for row, col, value in zip(*sources):
+        src = (np.array([row]), np.array([col]), np.array([value]))
+        result = msf_engine.run_msf(dtm, src, fdir_deg, CELLSIZE, h_l_threshold, intermediates=False, **kw)
+        np.fmax(out, result.pq_lim, out=out)
+    return out.astype(np.float32)
+
+
+@pytest.fixture(scope="session")
+def dtm():
+    return make_dtm()
+
+
+@pytest.fixture(scope="session")
+def fdir_deg(dtm):
+    return msf_engine.fdir_to_degrees(msf_engine.flow_direction(dtm, CELLSIZE))
+
+
+@pytest.fixture(scope="session")
+def sources(dtm):
+    return make_sources(dtm, 6)
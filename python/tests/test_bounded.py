@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+
+
+# Name: test_bounded.py
+# Description: Runs cropped to the H/L threshold window equal the full runs.
+
+import numpy as np
+import pytest
+
+import msf_engine
+from conftest import CELLSIZE
+from msf_engine import window_slices
+
+
+@pytest.mark.parametrize("h_l_threshold", [0.1, 0.19, 0.3])
+def test_bounded_equals_full(dtm, fdir_deg, sources, h_l_threshold):
+    z_min = float(np.nanmin(dtm))
+    for row, col, value in zip(*sources):
+        src = (np.array([row]), np.array([col]), np.array([value]))
+        full = msf_engine.run_msf(dtm, src, fdir_deg, CELLSIZE, h_l_threshold)
+        result, window = msf_engine.run_msf_bounded(dtm, src, fdir_deg, CELLSIZE, h_l_threshold, z_min=z_min)
+        pq_lim = np.full(dtm.shape, np.nan)
+        pq_lim[window_slices(window)] = result.pq_lim
+        assert np.array_equal(pq_lim, full.pq_lim, equal_nan=True)
+
+
+def test_window_holds_the_footprint(dtm, fdir_deg, sources):
+    src = tuple(np.array([a[0]]) for a in sources)
+    full = msf_engine.run_msf(dtm, src, fdir_deg, CELLSIZE, 0.19)
+    window, li_max, fri_max = msf_engine.msf_window(dtm, src[0], src[1], src[2], CELLSIZE, 0.19)
+    rows, cols = np.nonzero(~np.isnan(full.pq_lim))
+    assert window is not None
+    assert (rows >= window.row_off).all() and (rows < window.row_off + window.nrows).all()
+    assert (cols >= window.col_off).all() and (cols < window.col_off + window.ncols).all()
+    assert (full.li[rows, cols] <= li_max).all() and (full.fri[rows, cols] <= fri_max).all()
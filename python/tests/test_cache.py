@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+
+# Name: test_cache.py
+# Description: Content keys, round trip and LRU eviction of the caches.
+
+import os
+import time
+
+import numpy as np
+from rasterio.transform import from_origin
+
+import msf_cache
+import msf_engine
+import msf_footprints
+import msf_io
+from conftest import make_profile
+
+
+def test_dtm_key(dtm):
+    profile = make_profile(dtm.shape)
+    key = msf_cache.dtm_key(dtm, profile)
+    assert msf_cache.dtm_key(dtm.copy(), dict(profile)) == key
+    changed = dtm.copy()
+    changed[5, 7] += 0.01
+    assert msf_cache.dtm_key(changed, profile) != key
+    # same values at another resolution, or moved
+    t = profile["transform"]
+    coarse = dict(profile, transform=from_origin(t.c, t.f, 5.0, 5.0))
+    moved = dict(profile, transform=from_origin(t.c + 3.0, t.f, t.a, -t.e))
+    assert msf_cache.dtm_key(dtm, coarse) != key
+    assert msf_cache.dtm_key(dtm, moved) != key
+    assert msf_cache.dtm_key(dtm, coarse) != msf_cache.dtm_key(dtm, moved)
+
+
+def test_grid_cache_round_trip(dtm, tmp_path):
+    path = str(tmp_path / "dtm.tif")
+    msf_io.write_raster(path, dtm, make_profile(dtm.shape))
+    cache = msf_cache.GridCache(str(tmp_path / "cache"))
+    first = msf_cache.dtm_grids(path, cache, log=lambda msg: None)
+    # warm start from the file index, without reading the DTM again
+    grids = msf_cache.dtm_grids(path, cache, log=lambda msg: None)
+    assert grids.key == first.key
+    fresh = msf_cache.compute_grids(*msf_io.read_raster(path))
+    assert grids.key == fresh.key
+    for name in ("dtm", "fdir", "nbr_mask"):
+        assert np.array_equal(getattr(grids, name), getattr(fresh, name))
+    assert grids.fdir_deg.dtype == np.float32
+    assert np.array_equal(grids.fdir_deg, msf_engine.fdir_to_degrees(fresh.fdir), equal_nan=True)
+    assert (grids.z_min, grids.z_max, grids.z_mean) == (fresh.z_min, fresh.z_max, fresh.z_mean)
+
+
+def test_grid_cache_evicts_least_recently_used(dtm, tmp_path):
+    profile = make_profile(dtm.shape)
+    a, b, c = (msf_cache.compute_grids(dtm + dz, profile) for dz in (0.0, 1.0, 2.0))
+    cache = msf_cache.GridCache(str(tmp_path))
+    cache.store(a)
+    size = cache.entries()[0][1]
+    cache.max_bytes = int(2.5 * size)  # room for two entries
+    cache.store(b)
+    assert cache.load(a.key) is not None  # a used after b
+    cache.store(c)
+    assert cache.has(a.key) and cache.has(c.key) and not cache.has(b.key)
+    assert sorted(os.listdir(str(tmp_path))) == sorted([a.key, c.key])
+
+
+def _footprint(seed, shape=(40, 40), n=200):
+    rng = np.random.RandomState(seed)
+    cells = np.sort(rng.choice(shape[0] * shape[1], n, replace=False))
+    return msf_footprints.from_cells(cells, rng.random_sample(n), shape[1])
+
+
+def test_footprint_cache_round_trip(tmp_path):
+    cache = msf_cache.FootprintCache(str(tmp_path))
+    fp = _footprint(0)
+    cache.store("ab01", fp, (40, 40))
+    got = cache.load("ab01")
+    assert np.array_equal(got.cells, fp.cells) and np.array_equal(got.values, fp.values)
+    assert got.window == fp.window
+    assert cache.load("ab02") is None
+
+
+def test_footprint_cache_size_limit(tmp_path):
+    cache = msf_cache.FootprintCache(str(tmp_path))
+    cache.store("k00", _footprint(0), (40, 40))
+    size = cache.entries()[0][1]
+    cache.max_bytes = int(4.5 * size)
+    cache.keep = {"k00"}  # e.g. the sources of the current run
+    for i in range(1, 12):
+        cache.store("k{:02d}".format(i), _footprint(i), (40, 40))
+        assert sum(s for _, s, _ in cache.entries()) <= cache.max_bytes
+        assert cache.has("k00") and cache.has("k{:02d}".format(i))
+    # loading does not protect a key from pruning
+    assert cache.load("k05") is None
+    assert cache.load("k09") is not None
+    assert cache.keep == {"k00"}
+
+
+def test_footprint_cache_prune_by_age(tmp_path):
+    cache = msf_cache.FootprintCache(str(tmp_path))
+    for i in range(3):
+        cache.store("k{:02d}".format(i), _footprint(i), (40, 40))
+    old = time.time() - 10 * 86400.0
+    os.utime(cache._path("k01"), (old, old))
+    assert cache.prune(keep={"k00"}, max_age_days=5) == ["k01"]
+    os.utime(cache._path("k00"), (old, old))
+    assert cache.prune(keep={"k00"}, max_age_days=5) == []
+    assert sorted(key for _, _, key in cache.entries()) == ["k00", "k02"]
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+
+# Name: test_engine.py
+# Description: Sanity checks of the native MSF engine (fill, flow direction,
+#              path allocation and the raster calculator chain).
+
+import numpy as np
+
+import msf_engine
+from conftest import CELLSIZE
+
+
+def test_fill_leaves_no_pits(dtm):
+    z = np.pad(dtm, 1, constant_values=np.inf)
+    lowest = np.min([z[1 + dr:z.shape[0] - 1 + dr, 1 + dc:z.shape[1] - 1 + dc]
+                     for dr in (-1, 0, 1) for dc in (-1, 0, 1) if dr or dc], axis=0)
+    # every inner cell has a neighbour at most as high
+    assert (lowest[1:-1, 1:-1] <= dtm[1:-1, 1:-1]).all()
+
+
+def test_flow_direction_of_a_plane():
+    rows, cols = np.mgrid[0:10, 0:12].astype(np.float64)
+    fdir_deg = msf_engine.fdir_to_degrees(msf_engine.flow_direction(100.0 - rows, CELLSIZE))
+    assert (fdir_deg[:-1] == 180.0).all()
+
+
+def test_flow_direction_drains_every_cell(dtm):
+    fdir = msf_engine.flow_direction(dtm, CELLSIZE)
+    assert (fdir[1:-1, 1:-1] > 0).all()
+
+
+def test_run_msf(dtm, fdir_deg, sources):
+    src = tuple(np.array([a[0]]) for a in sources)
+    result = msf_engine.run_msf(dtm, src, fdir_deg, CELLSIZE, 0.19)
+    row, col, value = (a[0] for a in sources)
+    assert result.li[row, col] == 0.0
+    reached = ~np.isnan(result.li)
+    assert reached.sum() > 1
+    assert (result.start_z[reached] == value).all()
+    # pq_lim only where the source gets with h_l >= H_L_threshold
+    valid = ~np.isnan(result.pq_lim)
+    assert valid.any()
+    assert (result.h_l[valid] >= 0.19).all()
+    assert np.allclose(result.pq_lim[valid], result.li[valid] / (result.fri[valid] + msf_engine.EPS))
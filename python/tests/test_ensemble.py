@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+# Name: test_ensemble.py
+# Description: Streaming exceedance and percentile rasters of an ensemble
+#              against the members kept in memory, and the pq_lim range.
+
+import numpy as np
+import pytest
+
+import msf_cache
+import msf_engine
+import msf_ensemble
+from conftest import make_profile
+
+QS = (5, 25, 50, 90, 100)
+
+
+def _expected(members, levels, qs):
+    """Exceedance and inverted-CDF percentiles of a stack of member rasters,
+    members not reaching a cell counting as below every value."""
+    stack = np.stack([np.asarray(m, dtype=np.float64) for m in members])
+    exceed = [((stack >= level).sum(axis=0) / float(len(members))).astype(np.float32) for level in levels]
+    low = np.where(np.isnan(stack), -np.inf, stack)
+    pct = []
+    for q in qs:
+        p = np.percentile(low, q, axis=0, method="inverted_cdf")
+        pct.append(np.where(np.isinf(p), np.nan, p))
+    return exceed, pct
+
+
+def _check(stats, members, levels):
+    exceed, pct = _expected(members, levels, QS)
+    for k in range(len(levels)):
+        assert np.array_equal(stats.exceedance(k), exceed[k])
+    width = np.diff(stats.edges).max()
+    for q, expected in zip(QS, pct):
+        got = stats.percentile(q)
+        assert np.array_equal(np.isnan(got), np.isnan(expected)), q
+        ok = ~np.isnan(expected)
+        assert (np.abs(got[ok] - expected[ok]) <= width * (1 + 1e-6)).all(), q
+
+
+def test_stats_equal_the_members(monkeypatch):
+    # few distinct values (ties, values on the bin edges) and cells reached
+    # by some members only
+    rng = np.random.RandomState(0)
+    shape, levels = (20, 30), (0.0, 0.5, 1.25)
+    members = []
+    for _ in range(37):
+        pq_lim = rng.randint(0, 9, shape) * 0.25
+        pq_lim[rng.random_sample(shape) < rng.uniform(0.2, 0.8)] = np.nan
+        pq_lim[:3] = np.nan  # never reached
+        members.append(pq_lim.astype(np.float32))
+    stats = msf_ensemble.EnsembleStats(shape, levels, np.linspace(0.0, 2.0, 9), len(members))
+    for pq_lim in members:
+        stats.add(pq_lim)
+    assert stats.n == len(members)
+    assert stats.n_cells == int((~np.isnan(np.stack(members))).any(axis=0).sum())
+    _check(stats, members, levels)
+    assert np.isnan(stats.percentile(50)[:3]).all()
+    assert (stats.exceedance(0)[:3] == 0).all()
+
+
+@pytest.fixture(scope="module")
+def grids(dtm):
+    return msf_cache.compute_grids(dtm, make_profile(dtm.shape))
+
+
+def test_ensemble_equals_the_members(grids, sources, monkeypatch):
+    members = []
+    add = msf_ensemble.EnsembleStats.add
+
+    def keep(self, pq_lim):
+        members.append(np.array(pq_lim))
+        add(self, pq_lim)
+
+    monkeypatch.setattr(msf_ensemble.EnsembleStats, "add", keep)
+    run_sources = list(zip(range(len(sources[0])), *sources))
+    hf_fri_list = [msf_engine.HF_FRI._replace(slope=s) for s in (0.006, 0.011111, 0.016)]
+    levels = (0.0, 1.0, 2.0)
+    stats, info = msf_ensemble.run_ensemble(grids, run_sources, [0.15, 0.19, 0.24], hf_fri_list, n_dtm=2,
+                                            dtm_sd=0.5, dtm_corr=15.0, levels=levels, bins=32, seed=3,
+                                            log=lambda msg: None)
+    assert len(members) == len(info) == stats.n == 2 * 3 * 3
+    _check(stats, members, levels)
+
+    # the histogram covers every member's pq_lim
+    lo, hi = msf_ensemble.pq_range(msf_engine.HF_LI, hf_fri_list)
+    assert (lo, hi) == (stats.edges[0], stats.edges[-1])
+    for pq_lim in members:
+        reached = pq_lim[~np.isnan(pq_lim)]
+        assert reached.size
+        assert (reached >= np.float32(lo)).all() and (reached <= np.float32(hi)).all()
+
+
+def test_pq_range_bounds_every_factor(dtm, fdir_deg, sources):
+    run_sources = list(zip(range(len(sources[0])), *sources))
+    for hf_fri in (msf_engine.HF_FRI, msf_engine.HF_FRI._replace(slope=0.02),
+                   msf_engine.HfForward(0.8, 1.5)):
+        lo, hi = msf_ensemble.pq_range(msf_engine.HF_LI, [hf_fri])
+        for fid, row, col, value in run_sources:
+            src = (np.array([row]), np.array([col]), np.array([value]))
+            pq_lim = msf_engine.run_msf(dtm, src, fdir_deg, 3.0, 0.0, hf_fri=hf_fri, intermediates=False).pq_lim
+            reached = pq_lim[~np.isnan(pq_lim)]
+            assert (reached >= lo - 1e-9).all() and (reached <= hi + 1e-9).all()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+
+# Name: test_footprints.py
+# Description: Round trip of the footprint files, cropping and the streaming
+#              max / argmax / overlap count against a dense stack.
+
+import numpy as np
+
+import msf_footprints
+from msf_engine import Window
+
+
+def _random_footprints(shape, n, seed, levels=4):
+    # few distinct values, so that sources tie in many cells
+    rng = np.random.RandomState(seed)
+    out = []
+    for i in range(n):
+        pq_lim = np.full(shape[0] * shape[1], np.nan)
+        cells = rng.choice(pq_lim.size, rng.randint(1, 60), replace=False)
+        pq_lim[cells] = rng.randint(0, levels, cells.size) * 0.5
+        out.append((10 * (i + 1), msf_footprints.footprint(pq_lim.reshape(shape), Window(0, 0, *shape), shape)))
+    return out
+
+
+def _dense(fp, shape):
+    out = np.full(shape[0] * shape[1], np.nan, dtype=np.float32)
+    out[fp.cells] = fp.values
+    return out.reshape(shape)
+
+
+def _assert_same(a, b):
+    assert a.window == b.window
+    assert np.array_equal(a.cells, b.cells) and a.cells.dtype == np.int64
+    assert np.array_equal(a.values, b.values) and a.values.dtype == np.float32
+
+
+def test_save_load_round_trip(tmp_path):
+    shape = (30, 40)
+    empty = msf_footprints.footprint(np.full(shape, np.nan), Window(0, 0, *shape), shape)
+    for i, (fid, fp) in enumerate(_random_footprints(shape, 5, seed=0) + [(0, empty)]):
+        path = str(tmp_path / "fp{}.npz".format(i))
+        msf_footprints.save(path, fp, shape)
+        _assert_same(msf_footprints.load(path), fp)
+    assert empty.window is None
+
+
+def test_save_load_large_window(tmp_path):
+    # a window of 10^10 cells: indices relative to it do not fit in uint32
+    shape = (100000, 100000)
+    cells = np.array([0, 5 * 10 ** 9 + 77, shape[0] * shape[1] - 1], dtype=np.int64)
+    fp = msf_footprints.Footprint(cells, np.array([1.0, 2.0, 3.0], dtype=np.float32), Window(0, 0, *shape))
+    path = str(tmp_path / "big.npz")
+    msf_footprints.save(path, fp, shape)
+    _assert_same(msf_footprints.load(path), fp)
+    with np.load(path) as data:
+        assert data["cells"].dtype == np.uint64
+
+
+def test_crop():
+    shape = (30, 40)
+    window = Window(5, 12, 10, 20)
+    for fid, fp in _random_footprints(shape, 5, seed=1):
+        cropped = msf_footprints.crop(fp, window, shape)
+        expected = _dense(fp, shape)[5:15, 12:32]
+        assert np.array_equal(_dense(cropped, (10, 20)), expected, equal_nan=True)
+    assert msf_footprints.crop(None, window, shape) is None
+
+
+def test_reduce_equals_dense_stack():
+    shape = (20, 25)
+    footprints = _random_footprints(shape, 12, seed=2)
+    footprints.insert(3, (99, None))  # skipped
+    pq_max, src_id, count, n = msf_footprints.reduce_footprints(iter(footprints), shape)
+    footprints = [(fid, fp) for fid, fp in footprints if fp is not None]
+    assert n == len(footprints)
+    stack = np.array([_dense(fp, shape) for fid, fp in footprints])
+    reached = ~np.isnan(stack)
+    expected = np.fmax.reduce(stack, axis=0)
+    assert pq_max.dtype == np.float32
+    assert np.array_equal(pq_max, expected, equal_nan=True)
+    assert np.array_equal(count, reached.sum(axis=0))
+    # the Id of the first source in input order reaching the maximum
+    ids = np.array([fid for fid, fp in footprints], dtype=np.float64)
+    first = np.argmax(reached & (stack == expected), axis=0)
+    assert np.array_equal(src_id, np.where(reached.any(axis=0), ids[first], np.nan), equal_nan=True)
+    assert (count > 1).sum() > 0 and ((stack == expected).sum(axis=0) > 1).any()  # ties occur
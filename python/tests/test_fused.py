@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+
+
+# Name: test_fused.py
+# Description: The fused pq_lim kernel equals the raster calculator chain.
+
+import numpy as np
+import pytest
+
+import msf_engine
+from conftest import CELLSIZE
+
+
+@pytest.mark.parametrize("h_l_threshold", [0.0, 0.19, 0.5])
+def test_fused_equals_calculator_chain(dtm, fdir_deg, sources, h_l_threshold):
+    result = msf_engine.run_msf(dtm, sources, fdir_deg, CELLSIZE, h_l_threshold)
+    chain = msf_engine.msf_calculator(dtm, result.start_z, result.li, result.fri, h_l_threshold)
+    fused = msf_engine.pq_lim_fused(dtm, result.start_z, result.li, result.fri, h_l_threshold)
+    assert np.array_equal(fused, chain[-1], equal_nan=True)
+    assert np.array_equal(fused, result.pq_lim, equal_nan=True)
+
+
+def test_run_without_intermediates(dtm, fdir_deg, sources):
+    full = msf_engine.run_msf(dtm, sources, fdir_deg, CELLSIZE, 0.19)
+    fused = msf_engine.run_msf(dtm, sources, fdir_deg, CELLSIZE, 0.19, intermediates=False)
+    assert fused.h_l is None and fused.pqi is None
+    assert np.array_equal(fused.pq_lim, full.pq_lim, equal_nan=True)
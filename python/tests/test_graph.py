@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+
+
+# Name: test_graph.py
+# Description: Runs on the precomputed propagation graphs equal the runs on
+#              the grids.
+
+import numpy as np
+import pytest
+
+import msf_engine
+import msf_footprints
+import msf_graph
+from conftest import CELLSIZE
+from msf_engine import Window
+
+
+@pytest.mark.parametrize("use_vertical_raster", [False, True])
+def test_graph_equals_grid(dtm, fdir_deg, sources, tmp_path, use_vertical_raster):
+    vertical = dtm if use_vertical_raster else None
+    graphs = []
+    for name, hf in (("li", msf_engine.HF_LI), ("fri", msf_engine.HF_FRI)):
+        folder = str(tmp_path / name)
+        msf_graph.build_graph(folder, fdir_deg, CELLSIZE, hf, msf_engine.VF_MSF, vertical)
+        graphs.append(msf_graph.load_graph(folder))
+    runner = msf_graph.GraphRunner(dtm, *graphs)
+    full = Window(0, 0, dtm.shape[0], dtm.shape[1])
+    for row, col, value in zip(*sources):
+        src = (np.array([row]), np.array([col]), np.array([value]))
+        result = msf_engine.run_msf(dtm, src, fdir_deg, CELLSIZE, 0.19, vertical=vertical, intermediates=False)
+        expected = msf_footprints.footprint(result.pq_lim, full, dtm.shape)
+        _, li_max, fri_max = msf_engine.msf_window(dtm, src[0], src[1], src[2], CELLSIZE, 0.19,
+                                                   vertical=vertical)
+        for bounds in ((np.inf, np.inf), (li_max, fri_max)):
+            fp = runner.footprint(row, col, value, 0.19, *bounds)
+            assert np.array_equal(fp.cells, expected.cells)
+            assert np.array_equal(fp.values, expected.values)
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+# Name: test_index.py
+# Description: Point, bounding box and polygon queries of the source index
+#              against brute force over the footprints, and the command line.
+
+import json
+
+import numpy as np
+import pytest
+
+import msf_footprints
+import msf_index
+from msf_engine import Window
+from conftest import CELLSIZE, make_profile
+
+SHAPE = (30, 40)
+
+
+@pytest.fixture(scope="module")
+def run(tmp_path_factory):
+    """Index of random footprints (few distinct values, so that sources tie)
+    and the dense stack of their pq_lim."""
+    rng = np.random.RandomState(0)
+    ids = [7, 3, 12, 5, 9, 1]
+    stack = np.full((len(ids), SHAPE[0] * SHAPE[1]), np.nan, dtype=np.float32)
+    footprints = []
+    for i, fid in enumerate(ids):
+        cells = rng.choice(stack.shape[1], rng.randint(1, 300), replace=False)
+        stack[i, cells] = rng.randint(0, 4, cells.size) * 0.5
+        pq_lim = stack[i].reshape(SHAPE)
+        footprints.append((fid, msf_footprints.footprint(pq_lim, Window(0, 0, *SHAPE), SHAPE)))
+    footprints.append((20, None))
+    folder = str(tmp_path_factory.mktemp("index"))
+    index = msf_index.build_index(folder, lambda: iter(footprints), SHAPE, make_profile(SHAPE))
+    return folder, index, ids, stack.reshape((len(ids),) + SHAPE)
+
+
+def _brute(ids, stack, mask):
+    """(Id, max pq_lim, reached cells) of the sources reaching the cells of mask,
+    highest pq_lim first, then lowest Id."""
+    out = []
+    for fid, pq_lim in zip(ids, stack):
+        values = pq_lim[mask & ~np.isnan(pq_lim)]
+        if values.size:
+            out.append((fid, float(values.max()), int(values.size)))
+    return sorted(out, key=lambda t: (-t[1], t[0]))
+
+
+def _centres():
+    """Map coordinates of the cell centres."""
+    rows, cols = np.mgrid[0:SHAPE[0], 0:SHAPE[1]]
+    transform = make_profile(SHAPE)["transform"]
+    return transform * (cols + 0.5, rows + 0.5)
+
+
+def _xy(row, col):
+    """Map coordinates of a position in cell units (row, col from the top left corner)."""
+    return make_profile(SHAPE)["transform"] * (col, row)
+
+
+def _diamond(row, col, radius):
+    x, y = _xy(row, col)
+    r = radius * CELLSIZE
+    return [(x - r, y), (x, y + r), (x + r, y), (x, y - r), (x - r, y)]
+
+
+def _square(row, col, half):
+    x, y = _xy(row, col)
+    h = half * CELLSIZE
+    return [(x - h, y - h), (x + h, y - h), (x + h, y + h), (x - h, y + h), (x - h, y - h)]
+
+
+def _in_diamond(row, col, radius):
+    x, y = _xy(row, col)
+    px, py = _centres()
+    return np.abs(px - x) + np.abs(py - y) < radius * CELLSIZE
+
+
+def _in_square(row, col, half):
+    x, y = _xy(row, col)
+    px, py = _centres()
+    return (np.abs(px - x) < half * CELLSIZE) & (np.abs(py - y) < half * CELLSIZE)
+
+
+def test_cell_and_point(run):
+    folder, index, ids, stack = run
+    for row in range(SHAPE[0]):
+        for col in range(SHAPE[1]):
+            mask = np.zeros(SHAPE, dtype=bool)
+            mask[row, col] = True
+            expected = _brute(ids, stack, mask)
+            assert index.cell(row, col) == expected
+            # anywhere inside the cell
+            assert index.point(*_xy(row + 0.1, col + 0.9)) == expected
+    assert index.point(*_xy(-0.5, 3)) == []
+    assert index.point(*_xy(3, SHAPE[1] + 0.5)) == []
+
+
+def test_bbox(run):
+    folder, index, ids, stack = run
+    for r0, r1, c0, c1 in [(0, 0, 0, 0), (2, 11, 5, 30), (0, SHAPE[0] - 1, 0, SHAPE[1] - 1), (25, 29, 35, 39)]:
+        mask = np.zeros(SHAPE, dtype=bool)
+        mask[r0:r1 + 1, c0:c1 + 1] = True
+        (xmin, ymin), (xmax, ymax) = _xy(r1 + 0.5, c0 + 0.5), _xy(r0 + 0.5, c1 + 0.5)
+        assert index.bbox(xmin, ymin, xmax, ymax) == _brute(ids, stack, mask)
+    # partly outside the grid: clipped; outside: nothing
+    mask = np.zeros(SHAPE, dtype=bool)
+    mask[20:, 30:] = True
+    (xmin, ymin), (xmax, ymax) = _xy(SHAPE[0] + 5, 30.5), _xy(20.5, SHAPE[1] + 5)
+    assert index.bbox(xmin, ymin, xmax, ymax) == _brute(ids, stack, mask)
+    (xmin, ymin), (xmax, ymax) = _xy(-2, -8), _xy(-5, -1)
+    assert index.bbox(xmin, ymin, xmax, ymax) == []
+
+
+def test_polygon_with_hole(run):
+    folder, index, ids, stack = run
+    # centres offset from the cell centres, so no cell centre lies on an edge
+    rings = [_diamond(14.3, 19.3, 9.5), _square(14.3, 19.3, 2.5)]
+    mask = _in_diamond(14.3, 19.3, 9.5) & ~_in_square(14.3, 19.3, 2.5)
+    assert index.polygon(rings) == _brute(ids, stack, mask)
+    assert index.polygon([_square(-20.3, -20.3, 2.5)]) == []
+
+
+def test_overlapping_polygons_count_cells_once(run):
+    folder, index, ids, stack = run
+    polygons = [[_diamond(10.3, 12.3, 7.5)], [_diamond(13.3, 16.3, 7.5)],
+                [_square(22.3, 30.3, 6.5), _square(22.3, 30.3, 2.5)]]
+    mask = (_in_diamond(10.3, 12.3, 7.5) | _in_diamond(13.3, 16.3, 7.5)
+            | (_in_square(22.3, 30.3, 6.5) & ~_in_square(22.3, 30.3, 2.5)))
+    assert index.polygons(polygons) == _brute(ids, stack, mask)
+    assert index.polygons([]) == []
+
+
+def _cli(capsys, argv):
+    msf_index.main(argv)
+    return [(d["Id"], d["pq_lim"], d["cells"]) for d in json.loads(capsys.readouterr().out)]
+
+
+def test_command_line_json(run, capsys, tmp_path):
+    folder, index, ids, stack = run
+    x, y = _xy(14.5, 19.5)
+    assert _cli(capsys, [folder, "point", str(x), str(y), "--json"]) == index.point(x, y)
+    (xmin, ymin), (xmax, ymax) = _xy(11.5, 2.5), _xy(2.5, 30.5)
+    assert _cli(capsys, [folder, "bbox", str(xmin), str(ymin), str(xmax), str(ymax), "--json"]) == \
+        index.bbox(xmin, ymin, xmax, ymax)
+
+    pytest.importorskip("fiona")
+    polygon = [_diamond(10.3, 12.3, 7.5)]
+    multipolygon = [[_diamond(13.3, 16.3, 7.5)], [_square(22.3, 30.3, 6.5), _square(22.3, 30.3, 2.5)]]
+    features = [dict(type="Feature", properties={}, geometry=dict(type="Polygon", coordinates=polygon)),
+                dict(type="Feature", properties={}, geometry=dict(type="MultiPolygon", coordinates=multipolygon))]
+    path = str(tmp_path / "polygons.geojson")
+    with open(path, "w") as f:
+        json.dump(dict(type="FeatureCollection", features=features), f)
+    assert _cli(capsys, [folder, "polygon", path, "--json"]) == index.polygons([polygon] + multipolygon)
+    assert index.polygons([polygon] + multipolygon)
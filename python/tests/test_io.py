@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+# Name: test_io.py
+# Description: Sparse tiled GeoTIFFs (tiles without data skipped) and the
+#              background raster writer.
+
+import threading
+
+import numpy as np
+import pytest
+import rasterio
+
+import msf_io
+from conftest import make_profile
+
+SHAPE = (600, 700)  # 3 x 3 tiles, the last row and column partial
+
+
+def _sparse(seed):
+    """Raster with data in some tiles only (one of them a single cell)."""
+    rng = np.random.RandomState(seed)
+    arr = np.full(SHAPE, np.nan)
+    arr[:256, :256] = rng.random_sample((256, 256))
+    arr[300:600, 520:700] = rng.random_sample((300, 180))
+    arr[300:600, 520:700][arr[300:600, 520:700] < 0.5] = np.nan
+    arr[511, 300] = 2.5
+    return arr
+
+
+def _tiles(path):
+    """Tiles (row, column) stored in a GeoTIFF."""
+    with rasterio.open(path) as src:
+        n_rows, n_cols = -(-src.height // msf_io.BLOCK), -(-src.width // msf_io.BLOCK)
+        return set((i, j) for i in range(n_rows) for j in range(n_cols)
+                   if src.get_tag_item("BLOCK_OFFSET_{}_{}".format(j, i), "TIFF", bidx=1) is not None)
+
+
+def _stored(arr):
+    """Tiles (row, column) with data."""
+    rows, cols = np.nonzero(~np.isnan(arr))
+    return set(zip((rows // msf_io.BLOCK).tolist(), (cols // msf_io.BLOCK).tolist()))
+
+
+@pytest.mark.parametrize("compress", [None, "lzw", "none"])
+def test_write_raster_skips_nodata_tiles(tmp_path, compress):
+    arr = _sparse(0)
+    path = str(tmp_path / "sparse.tif")
+    msf_io.write_raster(path, arr, make_profile(SHAPE), compress=compress)
+    out, profile = msf_io.read_raster(path)
+    assert np.array_equal(out, arr.astype(np.float32), equal_nan=True)
+    assert (profile["height"], profile["width"]) == SHAPE
+    assert _tiles(path) == _stored(arr) == {(0, 0), (1, 2), (2, 2), (1, 1)}
+
+
+def test_write_raster_window(tmp_path):
+    arr = _sparse(1)
+    window = (250, 260, 340, 420)
+    part = arr[250:590, 260:680]
+    path = str(tmp_path / "window.tif")
+    msf_io.write_raster(path, part, make_profile(SHAPE), window=window)
+    expected = np.full(SHAPE, np.nan)
+    expected[250:590, 260:680] = part
+    out, _ = msf_io.read_raster(path)
+    assert np.array_equal(out, expected.astype(np.float32), equal_nan=True)
+    assert _tiles(path) == _stored(expected)
+
+
+def test_write_raster_blocks_of_cells(tmp_path):
+    arr = _sparse(2)
+    rows, cols = np.nonzero(~np.isnan(arr))
+    path = str(tmp_path / "cells.tif")
+    msf_io.write_raster_blocks(path, make_profile(SHAPE), msf_io.cell_blocks(rows, cols, arr[rows, cols], SHAPE))
+    out, _ = msf_io.read_raster(path)
+    assert np.array_equal(out, arr.astype(np.float32), equal_nan=True)
+    assert _tiles(path) == _stored(arr)
+
+
+def test_async_writer_round_trip(tmp_path):
+    writer = msf_io.AsyncWriter(2, compress="lzw")
+    arrays = [_sparse(seed) for seed in range(5)]
+    for i, arr in enumerate(arrays):
+        writer.write_raster(str(tmp_path / "{}.tif".format(i)), arr, make_profile(SHAPE))
+    writer.close()
+    for i, arr in enumerate(arrays):
+        out, profile = msf_io.read_raster(str(tmp_path / "{}.tif".format(i)))
+        assert np.array_equal(out, arr.astype(np.float32), equal_nan=True)
+        assert profile["compress"] == "lzw"
+
+
+def test_async_writer_queue_is_bounded():
+    writer = msf_io.AsyncWriter(max_pending=2)
+    release = threading.Event()
+    started = threading.Event()
+    done = []
+
+    def write(path):
+        started.set()
+        release.wait()
+        done.append(path)
+
+    writer.submit(write, "a")
+    assert started.wait(10)  # "a" runs on the writer thread and blocks it
+    writer.submit(write, "b")
+    writer.submit(write, "c")  # the queue is full
+    producer = threading.Thread(target=writer.submit, args=(write, "d"))
+    producer.start()
+    producer.join(0.3)
+    assert producer.is_alive()  # the producer waits for room in the queue
+    release.set()
+    producer.join(10)
+    assert not producer.is_alive()
+    writer.close()
+    assert done == ["a", "b", "c", "d"]
+
+
+def test_async_writer_passes_errors_back():
+    writer = msf_io.AsyncWriter(max_pending=1)
+    done = []
+
+    def write(path):
+        if path.startswith("bad"):
+            raise ValueError("cannot write " + path)
+        done.append(path)
+
+    for path in ("ok1", "bad1", "ok2", "bad2"):
+        writer.submit(write, path)
+    with pytest.raises(IOError) as e:
+        writer.flush()
+    assert "2 raster(s)" in str(e.value) and "cannot write bad1" in str(e.value) and "bad2" in str(e.value)
+    assert done == ["ok1", "ok2"]
+    # the errors are reported once; the writer keeps working
+    writer.submit(write, "ok3")
+    writer.close()
+    assert done == ["ok1", "ok2", "ok3"]
+
+    # without the thread the error is raised by the call itself
+    writer = msf_io.AsyncWriter(enabled=False)
+    with pytest.raises(ValueError):
+        writer.submit(write, "bad3")
+    writer.close()
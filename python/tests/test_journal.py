@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+# Name: test_journal.py
+# Description: A multi-source run interrupted and resumed from its journal
+#              equals an uninterrupted run; failing sources are retried with
+#              backoff and given up, also across restarts.
+
+import os
+
+import numpy as np
+import pytest
+
+import msf_engine
+import msf_journal
+from conftest import CELLSIZE, make_sources
+
+BATCH = 3
+
+
+class Killed(Exception):
+    """The run stops (the process is killed) after a checkpoint."""
+
+
+@pytest.fixture(scope="module")
+def multi(dtm, fdir_deg):
+    src_cells = msf_engine.most_frequent(*make_sources(dtm, 14, seed=2))
+    expected = msf_engine.run_msf_multi(dtm, src_cells, fdir_deg, CELLSIZE, batch_size=BATCH)
+    return src_cells, expected
+
+
+def _run(dtm, fdir_deg, src_cells, journal, kill_at=None):
+    """Multi-source run checkpointed to the journal as in MSF_multiple_points_native.py."""
+    def save_checkpoint(n, pq):
+        journal.set_checkpoint(n, pq)
+        journal.save()
+        if kill_at is not None and n >= kill_at:
+            raise Killed()
+
+    return msf_engine.run_msf_multi(dtm, src_cells, fdir_deg, CELLSIZE, batch_size=BATCH,
+                                    checkpoint=save_checkpoint, resume=journal.checkpoint())
+
+
+@pytest.mark.parametrize("interval_s", [0.0, 3600.0])
+def test_resumed_run_equals_uninterrupted_run(tmp_path, dtm, fdir_deg, multi, interval_s):
+    src_cells, expected = multi
+    path = str(tmp_path / "run_journal.json")
+    key = msf_journal.run_key("multi_source", [a.tolist() for a in src_cells])
+    journal = msf_journal.RunJournal(path, key, interval_s=interval_s, log=lambda msg: None)
+    with pytest.raises(Killed):
+        _run(dtm, fdir_deg, src_cells, journal, kill_at=9)
+    assert os.path.exists(journal.max_path)
+
+    journal = msf_journal.RunJournal(path, key, interval_s=interval_s, log=lambda msg: None)
+    position, pq_max = journal.checkpoint()
+    # with a long interval only the first checkpoint was written
+    assert position == (9 if interval_s == 0 else BATCH)
+    with pytest.raises(Killed):
+        _run(dtm, fdir_deg, src_cells, journal, kill_at=12)
+    journal = msf_journal.RunJournal(path, key, interval_s=interval_s, log=lambda msg: None)
+    pq_max = _run(dtm, fdir_deg, src_cells, journal)
+    assert np.array_equal(pq_max, expected, equal_nan=True)
+    journal.finish()
+    assert not os.path.exists(journal.max_path)
+    assert msf_journal.RunJournal(path, key, log=lambda msg: None).checkpoint() is None
+
+
+def test_resume_from_a_newer_maximum(tmp_path, dtm, fdir_deg, multi):
+    # killed between writing the maximum and the journal: the journal points
+    # to an older position, the batches after it run again on the newer maximum
+    src_cells, expected = multi
+    path = str(tmp_path / "run_journal.json")
+    journal = msf_journal.RunJournal(path, "k", interval_s=0.0, log=lambda msg: None)
+    with pytest.raises(Killed):
+        _run(dtm, fdir_deg, src_cells, journal, kill_at=BATCH)
+    newer = msf_engine.run_msf_multi(dtm, tuple(a[:9] for a in src_cells), fdir_deg, CELLSIZE)
+    np.save(journal.max_path, newer.ravel())
+    journal = msf_journal.RunJournal(path, "k", log=lambda msg: None)
+    assert journal.checkpoint()[0] == BATCH
+    assert np.array_equal(_run(dtm, fdir_deg, src_cells, journal), expected, equal_nan=True)
+
+
+def test_journal_of_another_run_is_discarded(tmp_path, dtm, fdir_deg, multi):
+    src_cells, expected = multi
+    path = str(tmp_path / "run_journal.json")
+    journal = msf_journal.RunJournal(path, "a", interval_s=0.0, log=lambda msg: None)
+    journal.done("s1", 1)
+    with pytest.raises(Killed):
+        _run(dtm, fdir_deg, src_cells, journal, kill_at=BATCH)
+    journal = msf_journal.RunJournal(path, "b", log=lambda msg: None)
+    assert journal.checkpoint() is None and journal.n_done() == 0 and not journal.is_done("s1")
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Clock of the journal; sleeping advances it and records the waits."""
+    now = [1000.0]
+    waits = []
+
+    def sleep(s):
+        waits.append(s)
+        now[0] += s
+
+    monkeypatch.setattr(msf_journal.time, "time", lambda: now[0])
+    monkeypatch.setattr(msf_journal.time, "sleep", sleep)
+    return now, waits
+
+
+def _run_sources(journal, sources, run):
+    """Per-source loop of MSF_multiple_points_native.py: run the sources not
+    tried yet, then retry the failed ones once their backoff is over."""
+    todo = [s for s in sources if journal.attempts(s) == 0 and not journal.is_done(s)]
+    while todo:
+        for key in todo:
+            try:
+                run(key)
+                journal.done(key, key)
+            except Exception as e:
+                journal.fail(key, key, e)
+            journal.save()
+        todo = journal.retry(sources)
+
+
+def test_failing_source_is_retried_with_backoff_then_given_up(tmp_path, clock):
+    now, waits = clock
+    path = str(tmp_path / "run_journal.json")
+    calls = []
+
+    def run(key):
+        calls.append(key)
+        if key == "bad":
+            raise RuntimeError("no convergence")
+        now[0] += 1.0
+
+    sources = ["a", "bad", "b"]
+    journal = msf_journal.RunJournal(path, "k", max_attempts=4, backoff_s=30.0, interval_s=0.0,
+                                     log=lambda msg: None)
+    _run_sources(journal, sources, run)
+    assert os.path.exists(path)
+    assert calls == ["a", "bad", "b", "bad", "bad", "bad"]
+    # 30 s after the first failure (less the 1 s of "b"), then doubled
+    assert waits == [29.0, 60.0, 120.0]
+    assert journal.attempts("bad") == 4 and not journal.can_retry("bad")
+    assert journal.failed() == [("bad", 4, "no convergence")]
+    assert journal.is_done("a") and journal.is_done("b") and journal.n_done() == 2
+
+    # a restarted run neither runs the sources done nor the source given up
+    journal.finish()
+    journal = msf_journal.RunJournal(path, "k", max_attempts=4, backoff_s=30.0, log=lambda msg: None)
+    calls[:] = []
+    _run_sources(journal, sources, run)
+    assert calls == [] and journal.failed() == [("bad", 4, "no convergence")]
+
+
+def test_failed_source_recovers_after_restart(tmp_path, clock):
+    now, waits = clock
+    path = str(tmp_path / "run_journal.json")
+    attempts = []
+
+    def flaky(key):
+        attempts.append(key)
+        if len(attempts) < 3:
+            raise IOError("disk full")
+
+    journal = msf_journal.RunJournal(path, "k", max_attempts=2, backoff_s=5.0, interval_s=0.0,
+                                     log=lambda msg: None)
+    _run_sources(journal, ["x"], flaky)
+    assert waits == [5.0] and journal.failed() == [("x", 2, "disk full")]
+    # the journal is deleted to try the sources given up again
+    os.remove(path)
+    journal = msf_journal.RunJournal(path, "k", max_attempts=2, backoff_s=5.0, log=lambda msg: None)
+    _run_sources(journal, ["x"], flaky)
+    assert journal.is_done("x") and journal.failed() == [] and len(attempts) == 3
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+
+
+# Name: test_multi_source.py
+# Description: The labelled multi-source pass equals the maximum of the
+#              per-source runs.
+
+import numpy as np
+import pytest
+
+import msf_engine
+from conftest import CELLSIZE, make_sources, per_source_max
+
+
+@pytest.mark.parametrize("bounded", [False, True])
+@pytest.mark.parametrize("batch_size", [1, 4, 1024])
+def test_multi_equals_per_source_max(dtm, fdir_deg, bounded, batch_size):
+    sources = make_sources(dtm, 10, seed=1)
+    pq_max = msf_engine.run_msf_multi(dtm, sources, fdir_deg, CELLSIZE, 0.19, batch_size=batch_size,
+                                      bounded=bounded)
+    expected = per_source_max(dtm, fdir_deg, sources)
+    assert np.array_equal(np.asarray(pq_max).astype(np.float32), expected, equal_nan=True)
+
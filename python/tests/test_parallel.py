@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+
+# Name: test_parallel.py
+# Description: The process-pool runs give the same combined maximum as the
+#              serial per-source runs.
+
+import numpy as np
+
+import msf_cache
+import msf_engine
+import msf_footprints
+import msf_graph
+import msf_parallel
+from conftest import CELLSIZE, per_source_max
+
+
+def _sources(sources):
+    return [(i + 1, int(r), int(c), float(v)) for i, (r, c, v) in enumerate(zip(*sources))]
+
+
+def test_parallel_equals_serial(dtm, fdir_deg, sources):
+    expected = per_source_max(dtm, fdir_deg, sources)
+    for n_workers in (1, 3):
+        pq_max, failed = msf_parallel.run_parallel(dtm, fdir_deg, CELLSIZE, _sources(sources), 0.19,
+                                                   n_workers=n_workers, log=lambda msg: None)
+        assert failed == []
+        assert pq_max.dtype == np.float32
+        assert np.array_equal(pq_max, expected, equal_nan=True)
+
+
+def test_parallel_on_graphs_equals_serial(dtm, fdir_deg, sources, tmp_path):
+    graphs = []
+    for name, hf in (("li", msf_engine.HF_LI), ("fri", msf_engine.HF_FRI)):
+        msf_graph.build_graph(str(tmp_path / name), fdir_deg, CELLSIZE, hf, msf_engine.VF_MSF)
+        graphs.append(msf_graph.load_graph(str(tmp_path / name)))
+    pq_max, failed = msf_parallel.run_parallel(dtm, fdir_deg, CELLSIZE, _sources(sources), 0.19, n_workers=2,
+                                               log=lambda msg: None, graphs=graphs)
+    assert failed == []
+    assert np.array_equal(pq_max, per_source_max(dtm, fdir_deg, sources), equal_nan=True)
+
+
+def test_parallel_footprints_equal_serial(dtm, fdir_deg, sources, tmp_path):
+    # with a footprint cache every source is stored, the caller combines them
+    results = msf_cache.FootprintCache(str(tmp_path))
+    run = _sources(sources)
+    keys = dict((fid, "{:04d}".format(fid)) for fid, _, _, _ in run)
+    pq_max, failed = msf_parallel.run_parallel(dtm, fdir_deg, CELLSIZE, run, 0.19, n_workers=2,
+                                               log=lambda msg: None, results=results, keys=keys)
+    assert pq_max is None and failed == []
+    combined, _, _, n = msf_footprints.reduce_footprints(((fid, results.load(keys[fid])) for fid in keys),
+                                                        dtm.shape)
+    assert n == len(run)
+    assert np.array_equal(combined, per_source_max(dtm, fdir_deg, sources), equal_nan=True)
+
+
+def test_tree_max():
+    rng = np.random.RandomState(0)
+    arrays = [np.where(rng.random_sample((4, 5)) < 0.5, np.nan, rng.random_sample((4, 5))) for _ in range(5)]
+    expected = np.fmax.reduce(np.array(arrays), axis=0)
+    assert np.array_equal(msf_parallel.tree_max([a.copy() for a in arrays]), expected, equal_nan=True)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+# Name: test_points.py
+# Description: Reading the source points (CSV and vector files), their cells
+#              on the DTM grid and the MOST_FREQUENT rule of PointToRaster.
+
+from collections import Counter
+
+import numpy as np
+import pytest
+
+import msf_engine
+import msf_io
+from conftest import CELLSIZE, make_profile
+
+SHAPE = (20, 30)
+POINTS = [(500001.5, 5000058.5, 1, 1012.5), (500044.25, 5000013.0, 7, 1003.0), (500089.9, 5000000.1, 3, 997.25)]
+
+
+def _write_csv(path, rows, header="X,Y,Id,Source"):
+    with open(path, "w") as f:
+        f.write(header + "\n")
+        for row in rows:
+            f.write(",".join(str(v) for v in row) + "\n")
+
+
+def _check(points):
+    x, y, ids, values = points
+    assert np.array_equal(x, [p[0] for p in POINTS]) and x.dtype == np.float64
+    assert np.array_equal(y, [p[1] for p in POINTS]) and y.dtype == np.float64
+    assert ids.tolist() == [p[2] for p in POINTS]
+    assert np.array_equal(values, [p[3] for p in POINTS]) and values.dtype == np.float64
+
+
+def test_read_csv(tmp_path):
+    path = str(tmp_path / "points.csv")
+    _write_csv(path, POINTS)
+    _check(msf_io.read_source_points(path))
+    # columns in any order, extra columns ignored
+    _write_csv(path, [(p[2], "a", p[3], p[1], p[0]) for p in POINTS], "Id,Name,Source,Y,X")
+    _check(msf_io.read_source_points(path))
+    # a single point
+    _write_csv(path, POINTS[:1])
+    x, y, ids, values = msf_io.read_source_points(path)
+    assert x.shape == y.shape == ids.shape == values.shape == (1,)
+    _write_csv(path, [p[:3] for p in POINTS], "X,Y,Id")
+    with pytest.raises(ValueError, match="Source"):
+        msf_io.read_source_points(path)
+
+
+@pytest.mark.parametrize("driver, name", [("ESRI Shapefile", "points.shp"), ("GPKG", "points.gpkg")])
+def test_read_vector(tmp_path, driver, name):
+    fiona = pytest.importorskip("fiona")
+    path = str(tmp_path / name)
+    schema = {"geometry": "Point", "properties": {"Id": "int", "Source": "float"}}
+    with fiona.open(path, "w", driver=driver, schema=schema) as dst:
+        for x, y, fid, value in POINTS:
+            dst.write({"geometry": {"type": "Point", "coordinates": (x, y)},
+                       "properties": {"Id": fid, "Source": value}})
+    _check(msf_io.read_source_points(path))
+    schema = {"geometry": "Point", "properties": {"Id": "int"}}
+    with fiona.open(str(tmp_path / "no_source.shp"), "w", driver="ESRI Shapefile", schema=schema) as dst:
+        dst.write({"geometry": {"type": "Point", "coordinates": (500001.5, 5000058.5)}, "properties": {"Id": 1}})
+    with pytest.raises(ValueError):
+        msf_io.read_source_points(str(tmp_path / "no_source.shp"))
+
+
+def test_xy_to_cells():
+    profile = make_profile(SHAPE)
+    x0, top = 500000.0, 5000000.0 + SHAPE[0] * CELLSIZE
+    # cell centres
+    rows, cols = np.mgrid[0:SHAPE[0], 0:SHAPE[1]]
+    r, c = msf_io.xy_to_cells(x0 + (cols + 0.5) * CELLSIZE, top - (rows + 0.5) * CELLSIZE, profile)
+    assert np.array_equal(r, rows) and np.array_equal(c, cols) and r.dtype == np.int64
+    # points on a cell edge belong to the cell east / south of it
+    r, c = msf_io.xy_to_cells([x0, x0 + 3 * CELLSIZE, x0 + 0.5], [top, top - 0.5, top - 7 * CELLSIZE], profile)
+    assert r.tolist() == [0, 0, 7] and c.tolist() == [0, 3, 0]
+    # outside the grid: rows/columns out of 0..height-1 / 0..width-1, also
+    # just west / north of the grid (not rounded to 0)
+    x = [x0 - 0.01, x0 + SHAPE[1] * CELLSIZE, x0 + 1.0, x0 + 1.0, x0 - 100.0]
+    y = [top - 1.0, top - 1.0, top + 0.01, top - SHAPE[0] * CELLSIZE, top + 100.0]
+    r, c = msf_io.xy_to_cells(x, y, profile)
+    inside = (r >= 0) & (r < SHAPE[0]) & (c >= 0) & (c < SHAPE[1])
+    assert not inside.any()
+    assert r.tolist() == [0, 0, -1, SHAPE[0], -34] and c.tolist() == [-1, SHAPE[1], 0, 0, -34]
+
+
+def test_most_frequent_equals_point_to_raster_rule():
+    rng = np.random.RandomState(0)
+    n = 500
+    rows, cols = rng.randint(0, 4, n), rng.randint(0, 5, n)
+    values = rng.randint(0, 4, n) * 1.5  # few values: many ties
+    r, c, v = msf_engine.most_frequent(rows, cols, values)
+    expected = []
+    for cell in sorted(set(zip(rows.tolist(), cols.tolist()))):
+        counts = Counter(values[(rows == cell[0]) & (cols == cell[1])].tolist())
+        top = max(counts.values())
+        expected.append(cell + (min(k for k, m in counts.items() if m == top),))
+    assert list(zip(r.tolist(), c.tolist(), v.tolist())) == expected
+
+
+def test_most_frequent_ties():
+    # cell (0, 0): 2.0 twice, 1.0 and 3.0 once -> 2.0; cell (0, 1): a tie of
+    # 5.0 and 4.0 -> the lowest; cell (1, 0): a single point
+    rows = [0, 0, 0, 0, 0, 0, 1, 0]
+    cols = [0, 0, 0, 0, 1, 1, 0, 1]
+    values = [3.0, 2.0, 1.0, 2.0, 5.0, 4.0, 9.0, 5.0]
+    r, c, v = msf_engine.most_frequent(rows, cols, values)
+    assert (r.tolist(), c.tolist(), v.tolist()) == ([0, 0, 1], [0, 1, 0], [2.0, 5.0, 9.0])
+    r, c, v = msf_engine.most_frequent(rows[:6], cols[:6], values[:6])
+    assert v.tolist() == [2.0, 4.0]
+    r, c, v = msf_engine.most_frequent([], [], [])
+    assert r.size == c.size == v.size == 0
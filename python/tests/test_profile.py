@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+# Name: test_profile.py
+# Description: Wall and self time of nested stages and the ranking of the
+#              hot spots of the run report.
+
+import pytest
+
+import msf_profile
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Clock of the profiler, advanced by hand."""
+    now = [0.0]
+    monkeypatch.setattr(msf_profile.time, "perf_counter", lambda: now[0])
+    return now
+
+
+def _run(prof, clock):
+    with prof.stage("outer"):
+        clock[0] += 1.0
+        with prof.stage("inner"):
+            clock[0] += 3.0
+            with prof.stage("innermost"):
+                clock[0] += 0.5
+        clock[0] += 1.0
+        with prof.stage("inner"):
+            clock[0] += 2.0
+    with prof.stage("write"):
+        clock[0] += 1.5
+
+
+def test_nested_stages(clock):
+    prof = msf_profile.RunProfiler()
+    _run(prof, clock)
+    wall = dict((name, entry["wall_s"]) for name, entry in prof.stages.items())
+    own = dict((name, entry["self_s"]) for name, entry in prof.stages.items())
+    assert wall == dict(outer=7.5, inner=5.5, innermost=0.5, write=1.5)
+    assert own == dict(outer=2.0, inner=5.0, innermost=0.5, write=1.5)
+    assert prof.stages["inner"]["calls"] == 2
+    # by wall time "outer" would come first
+    assert prof.report()["hot_spots"] == ["inner", "outer", "write", "innermost"]
+
+
+def test_nested_stages_of_sources(clock):
+    worker = msf_profile.RunProfiler()
+    with worker.source(4):
+        _run(worker, clock)
+    entry = worker.sources[0]
+    assert entry["stages"] == dict(outer=7.5, inner=5.5, innermost=0.5, write=1.5)
+    assert entry["stages_self"] == dict(outer=2.0, inner=5.0, innermost=0.5, write=1.5)
+    # figures of a worker process added to the run
+    prof = msf_profile.RunProfiler()
+    with prof.stage("parallel_runs"):
+        prof.add_source(entry)
+        prof.add_source(dict(id=5, stages=dict(write=0.5)))  # no self times: taken as wall times
+        clock[0] += 9.0
+    assert prof.stages["outer"]["self_s"] == 2.0 and prof.stages["outer"]["wall_s"] == 7.5
+    assert prof.stages["write"]["self_s"] == prof.stages["write"]["wall_s"] == 2.0
+    # the workers ran beside this process: nothing is taken from parallel_runs
+    assert prof.stages["parallel_runs"]["self_s"] == 9.0
+    assert prof.report()["hot_spots"][:3] == ["parallel_runs", "inner", "outer"]
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+# Name: test_pyramid.py
+# Description: Coarse-to-fine runs equal the unrestricted runs, also when the
+#              coarse DTM misses a path and the search region must grow.
+
+import numpy as np
+import pytest
+
+import msf_cache
+import msf_engine
+import msf_footprints
+import msf_profile
+import msf_pyramid
+from conftest import CELLSIZE, make_dtm, make_profile, make_sources
+
+THRESHOLD = 0.19
+
+
+@pytest.fixture(scope="module")
+def channel():
+    """DTM with a narrow channel the coarse DTMs smooth away, and its sources
+    (some near the edges and corners of the raster)."""
+    dtm = make_dtm(60, seed=4)
+    dtm[20:58, 30] -= 3.0
+    dtm = msf_engine.fill_depressions(dtm)
+    rows, cols, values = make_sources(dtm, 10, seed=0)
+    sources = list(zip(rows.tolist(), cols.tolist(), values.tolist()))
+    for row, col in ((1, dtm.shape[1] - 2), (0, 0), (2, 1), (18, 30)):
+        sources.append((row, col, float(dtm[row, col]) + 2.0))
+    return msf_cache.compute_grids(dtm, make_profile(dtm.shape)), sources
+
+
+def _full(grids, row, col, value):
+    """Footprint of the unrestricted run of a source."""
+    src = (np.array([row]), np.array([col]), np.array([value]))
+    result, window = msf_engine.run_msf_bounded(grids.dtm, src, grids.fdir_deg, CELLSIZE, THRESHOLD,
+                                                z_min=grids.z_min)
+    return msf_footprints.footprint(result.pq_lim, window, grids.dtm.shape)
+
+
+def _same(a, b):
+    return np.array_equal(a.cells, b.cells) and np.array_equal(a.values, b.values)
+
+
+@pytest.mark.parametrize("factor", [2, 3, 5])
+@pytest.mark.parametrize("buffer_m", [0.0, 9.0, 30.0])
+def test_pyramid_equals_unrestricted_runs(channel, factor, buffer_m):
+    grids, sources = channel
+    prof = msf_profile.RunProfiler()
+    runner = msf_pyramid.PyramidRunner(grids, factor, buffer_m, 0.9, log=lambda msg: None)
+    for row, col, value in sources:
+        fp, region = runner.footprint(row, col, value, THRESHOLD, prof)
+        assert _same(fp, _full(grids, row, col, value)), (row, col)
+        if region is not None:
+            v = runner.validate(row, col, value, THRESHOLD, fp, region)
+            assert v.differ == 0 and v.max_abs_diff == 0.0
+    if buffer_m == 0.0:
+        assert prof.counters.get("regions_grown", 0) > 0
+
+
+def test_region_grows_where_the_coarse_dtm_misses_a_path(channel):
+    grids, sources = channel
+    runner = msf_pyramid.PyramidRunner(grids, 3, 0.0, 1.0, log=lambda msg: None, max_grow=2)
+    missed = 0
+    for row, col, value in sources:
+        full = _full(grids, row, col, value)
+        first, exact = runner._fine(row, col, value, THRESHOLD, None, runner.region(row, col, value, THRESHOLD))
+        # a run found exact is the unrestricted one
+        assert _same(first, full) or not exact
+        missed += not _same(first, full)
+        assert _same(runner.footprint(row, col, value, THRESHOLD)[0], full)
+    assert missed > 0
+    # without growing, the sources are run again without region
+    runner.max_grow = 0
+    prof = msf_profile.RunProfiler()
+    for row, col, value in sources:
+        fp, region = runner.footprint(row, col, value, THRESHOLD, prof)
+        assert _same(fp, _full(grids, row, col, value))
+    assert prof.counters["regions_dropped"] > 0
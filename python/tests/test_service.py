@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+
+# Name: test_service.py
+# Description: Requests to the HTTP API of the runout service equal the
+#              batch runs, and concurrent requests keep the footprint cache
+#              within its size limit.
+
+import json
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+import msf_engine
+import msf_io
+import msf_service
+from conftest import CELLSIZE, make_dtm, make_profile, make_sources, per_source_max
+
+
+@pytest.fixture(scope="module")
+def server(tmp_path_factory):
+    folder = tmp_path_factory.mktemp("service")
+    path = str(folder / "dtm.tif")
+    dtm = make_dtm(48, seed=3)
+    msf_io.write_raster(path, dtm, make_profile(dtm.shape))
+    model = msf_service.RunoutModel(path, cachedir=str(folder / "cache"), n_runners=2, log=lambda msg: None)
+    server = msf_service.make_server(model, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _request(server, path, body=None):
+    url = "http://127.0.0.1:{}{}".format(server.server_address[1], path)
+    data = None if body is None else json.dumps(body).encode("utf-8")
+    try:
+        with urllib.request.urlopen(url, data, timeout=60) as f:
+            return f.status, json.loads(f.read().decode("utf-8"))
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read().decode("utf-8"))
+
+
+def _points(model, n, seed):
+    """Source points at the centre of n source cells (fid, x, y, value)."""
+    rows, cols, values = make_sources(model.dtm, n, seed)
+    t = model.profile["transform"]
+    return [(i + 1, t.c + (c + 0.5) * CELLSIZE, t.f - (r + 0.5) * CELLSIZE, float(v))
+            for i, (r, c, v) in enumerate(zip(rows, cols, values))], (rows, cols, values)
+
+
+def _raster(answer, shape):
+    out = np.full(shape, np.nan, dtype=np.float32)
+    out[answer["rows"], answer["cols"]] = answer["pq_lim"]
+    return out
+
+
+def test_runout_equals_batch_runs(server):
+    model = server.model
+    status, info = _request(server, "/health")
+    assert status == 200 and info["key"] == model.grids.key
+    points, sources = _points(model, 3, seed=1)
+    fdir_deg = np.asarray(model.grids.fdir_deg)
+    fid, x, y, value = points[0]
+    status, answer = _request(server, "/runout?x={}&y={}&source={}".format(x, y, value))
+    assert status == 200
+    single = tuple(a[:1] for a in sources)
+    assert np.array_equal(_raster(answer, model.dtm.shape), per_source_max(model.dtm, fdir_deg, single),
+                          equal_nan=True)
+    body = dict(points=[[x, y, value] for fid, x, y, value in points], H_L_threshold=0.19)
+    status, answer = _request(server, "/runout", body)
+    assert status == 200
+    assert [s["cached"] for s in answer["sources"]] == [True, False, False]
+    expected = per_source_max(model.dtm, fdir_deg, sources)
+    assert np.array_equal(_raster(answer, model.dtm.shape), expected, equal_nan=True)
+    # the source Id of every reached cell gives its value
+    for fid, x, y, value in points:
+        mine = np.array(answer["source_id"]) == fid
+        single = tuple(a[fid - 1:fid] for a in sources)
+        pq_lim = per_source_max(model.dtm, fdir_deg, single)
+        assert np.array_equal(np.array(answer["pq_lim"], dtype=np.float32)[mine],
+                              pq_lim[np.array(answer["rows"])[mine], np.array(answer["cols"])[mine]])
+
+
+def test_bad_requests(server):
+    points, _ = _points(server.model, 1, seed=2)
+    fid, x, y, value = points[0]
+    # the source value is required, as the Source field of the batch runs
+    assert _request(server, "/runout?x={}&y={}".format(x, y))[0] == 400
+    assert _request(server, "/runout", dict(points=[[x, y]]))[0] == 400
+    assert _request(server, "/runout", dict(points=[[x, y, value]], format="png"))[0] == 400
+    assert _request(server, "/nothing")[0] == 404
+    status, answer = _request(server, "/runout", dict(points=[[x + 1e6, y, value]]))
+    assert status == 200 and answer["sources"][0]["error"] == "outside the DTM" and answer["cells"] == 0
+
+
+def test_concurrent_requests_keep_the_cache_limit(server):
+    model = server.model
+    results = model.results
+    points, sources = _points(model, 24, seed=4)
+    sizes = sorted(size for _, size, _ in results.entries())
+    results.max_bytes = int(4 * sizes[-1])
+    with ThreadPoolExecutor(8) as pool:
+        answers = list(pool.map(lambda p: _request(server, "/runout", dict(points=[list(p[1:])])), points))
+    assert all(status == 200 for status, answer in answers)
+    assert sum(size for _, size, _ in results.entries()) <= results.max_bytes
+    assert results._bytes == sum(size for _, size, _ in results.entries())
+    fdir_deg = np.asarray(model.grids.fdir_deg)
+    for i, (status, answer) in enumerate(answers):
+        single = tuple(a[i:i + 1] for a in sources)
+        assert np.array_equal(_raster(answer, model.dtm.shape), per_source_max(model.dtm, fdir_deg, single),
+                              equal_nan=True)
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+
+
+# Name: test_sweep.py
+# Description: Every threshold and factor case of a sweep equals a separate
+#              run with those settings.
+
+import numpy as np
+import pytest
+
+import msf_engine
+import msf_sweep
+from conftest import CELLSIZE, per_source_max
+
+THRESHOLDS = [0.15, 0.19, 0.25]
+
+
+@pytest.mark.parametrize("bounded", [False, True])
+def test_sweep_equals_separate_runs(dtm, fdir_deg, sources, bounded):
+    hf_fri = [msf_engine.HF_FRI._replace(slope=s) for s in (0.008, 0.014)]
+    cases = msf_sweep.sweep_cases([msf_engine.HF_LI], hf_fri, [msf_engine.VF_MSF])
+    run_sources = list(zip(range(len(sources[0])), *sources))
+    pq_max, h_l_crit = msf_sweep.run_sweep(dtm, fdir_deg, CELLSIZE, run_sources, THRESHOLDS, cases,
+                                           bounded=bounded, log=lambda msg: None)
+    for i, case in enumerate(cases):
+        for j, thr in enumerate(THRESHOLDS):
+            expected = per_source_max(dtm, fdir_deg, sources, thr, hf_li=case.hf_li, hf_fri=case.hf_fri,
+                                      vf=case.vf)
+            assert np.array_equal(pq_max[i][j], expected, equal_nan=True)
+            # a cell keeps a pq_lim up to its critical threshold
+            assert (h_l_crit[i][~np.isnan(expected)] >= np.float32(thr)).all()
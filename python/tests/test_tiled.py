@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+
+
+# Name: test_tiled.py
+# Description: The tiled (out-of-core) grids and runs equal the in-memory
+#              ones, flat areas crossing tile borders included.
+
+import numpy as np
+import pytest
+
+import msf_cache
+import msf_engine
+import msf_io
+import msf_tiled
+from conftest import make_dtm, make_profile, make_sources
+
+TILE = 16
+
+
+@pytest.fixture(scope="module")
+def dtm_path(tmp_path_factory):
+    # the plateau crosses the borders of four tiles
+    dtm = make_dtm(50, seed=3, plateau=(10, 22, 12, 40))
+    path = str(tmp_path_factory.mktemp("tiled") / "dtm.tif")
+    msf_io.write_raster(path, dtm, make_profile(dtm.shape))
+    return path
+
+
+def test_tiled_grids_equal_in_memory(dtm_path, tmp_path):
+    dtm, profile = msf_io.read_raster(dtm_path)
+    assert np.unique(dtm[10:22, 12:40]).size == 1
+    expected = msf_cache.compute_grids(dtm, profile)
+    grids = msf_tiled.tiled_grids(dtm_path, None, str(tmp_path), TILE, log=lambda msg: None)
+    assert np.array_equal(np.asarray(grids.dtm), expected.dtm, equal_nan=True)
+    assert np.array_equal(np.asarray(grids.fdir), expected.fdir)
+    assert np.array_equal(np.asarray(grids.fdir_deg), expected.fdir_deg, equal_nan=True)
+    assert np.array_equal(np.asarray(grids.nbr_mask), expected.nbr_mask)
+
+
+@pytest.mark.parametrize("bounded", [False, True])
+def test_run_tiled_equals_in_memory(dtm_path, tmp_path, bounded):
+    grids = msf_tiled.tiled_grids(dtm_path, None, str(tmp_path / "grids"), TILE, log=lambda msg: None)
+    dtm = np.asarray(grids.dtm)
+    rows, cols, values = make_sources(dtm, 8, seed=4)
+    sources = list(zip(range(1, 9), rows, cols, values))
+    # a memory budget of a few tiles: most tiles are spilled to disk
+    store, failed = msf_tiled.run_tiled(grids, sources, 0.19, tile_size=TILE, memory_mb=0.01,
+                                        workdir=str(tmp_path / "tiles"), bounded=bounded, log=lambda msg: None)
+    assert not failed
+    pq_max = np.full(dtm.shape, np.nan, dtype=np.float32)
+    for row_off, col_off, block in store.blocks():
+        pq_max[row_off:row_off + block.shape[0], col_off:col_off + block.shape[1]] = block
+    store.close()
+    expected = msf_engine.run_msf_multi(dtm, (rows, cols, values), np.asarray(grids.fdir_deg),
+                                        grids.cellsize, 0.19)
+    assert np.array_equal(pq_max, np.asarray(expected).astype(np.float32), equal_nan=True)
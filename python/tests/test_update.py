@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of the MSF - Modified Single Flow DF runout Model toolbox.
+#
+# MSF - Modified Single Flow DF runout Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# MSF - Modified Single Flow DF runout Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License (version 2)
+# along with this program (check the LICENSE file in the repository).
+# If not, see <https://www.gnu.org/licenses/old-licenses/gpl-2.0.html>.
+
+
+# Name: test_update.py
+# Description: The incremental update after a local DTM change (grids,
+#              footprints kept, combined rasters patched in place) equals a
+#              full recomputation.
+
+import numpy as np
+import pytest
+import rasterio
+
+import msf_cache
+import msf_engine
+import msf_footprints
+import msf_io
+import msf_tiled
+import msf_update
+from conftest import make_dtm, make_profile, make_sources
+
+TILE = 16
+H_L = 0.19
+NODATA_ID = -2147483648
+
+
+def _footprint(grids, row, col, value):
+    src = (np.array([row]), np.array([col]), np.array([value]))
+    result, window = msf_engine.run_msf_bounded(grids.dtm, src, grids.fdir_deg, grids.cellsize, H_L,
+                                                z_min=grids.z_min, intermediates=False)
+    return msf_footprints.footprint(result.pq_lim, window, grids.dtm.shape)
+
+
+def _key(grids, row, col, value):
+    return msf_cache.source_key(grids.key, row, col, value, H_L, msf_engine.HF_LI, msf_engine.HF_FRI,
+                                msf_engine.VF_MSF, False)
+
+
+def _read(path):
+    with rasterio.open(path) as src:
+        return src.read(1)
+
+
+@pytest.fixture(scope="module")
+def grids():
+    # gentle slope: the change is out of reach of some sources
+    old = make_dtm(96, seed=5, slope=0.03, valleys=0.5)
+    # a check dam across the slope, the DTM filled again behind it (the
+    # pond is a flat area crossing tile borders)
+    new = old.copy()
+    new[84:86, 60:90] += 2.0
+    new = msf_engine.fill_depressions(new)
+    profile = make_profile(old.shape)
+    return msf_cache.compute_grids(old, profile), msf_cache.compute_grids(new, profile)
+
+
+def test_update_grids_equals_recompute(grids):
+    old, new = grids
+    layout = msf_tiled.TileLayout(new.dtm.shape[0], new.dtm.shape[1], TILE)
+    tiles = msf_update.changed_tiles(old.dtm, new.dtm, layout)
+    assert 0 < len(tiles) < layout.ntile_rows * layout.ntile_cols
+    updated = msf_update.update_grids(old, new.dtm, new.profile, tiles, layout, log=lambda msg: None)
+    assert updated.key == new.key
+    assert np.array_equal(updated.fdir, new.fdir)
+    assert np.array_equal(updated.fdir_deg, new.fdir_deg, equal_nan=True)
+    assert np.array_equal(updated.nbr_mask, new.nbr_mask)
+
+
+def test_update_run_equals_recompute(grids, tmp_path):
+    old, new = grids
+    shape = new.dtm.shape
+    rows, cols, values = make_sources(old.dtm, 12, seed=6)
+    sources = list(zip(range(1, 13), rows, cols, values))
+    results = msf_cache.FootprintCache(str(tmp_path / "footprints"))
+    old_keys = dict((fid, _key(old, row, col, value)) for fid, row, col, value in sources)
+    keys = dict((fid, _key(new, row, col, value)) for fid, row, col, value in sources)
+
+    # the run on the old DTM and its combined rasters
+    old_fps = [(fid, _footprint(old, row, col, value)) for fid, row, col, value in sources]
+    for fid, fp in old_fps:
+        results.store(old_keys[fid], fp, shape)
+    pq_max, src_id, count, _ = msf_footprints.reduce_footprints(old_fps, shape)
+    paths = [str(tmp_path / name) for name in ("max.tif", "id.tif", "count.tif")]
+    msf_io.write_raster(paths[0], pq_max, new.profile)
+    msf_io.write_raster(paths[1], src_id, new.profile, dtype="int32", nodata=NODATA_ID)
+    msf_io.write_raster(paths[2], count, new.profile, dtype="int32", nodata=0)
+
+    # the update: unaffected footprints kept, the others run again
+    changed = msf_update.changed_cells(old, new, TILE)
+    affected, window = msf_update.carry_over(new, sources, changed, results, old_keys, keys, H_L)
+    assert 0 < len(affected) < len(sources)
+    fresh = dict((fid, _footprint(new, row, col, value)) for fid, row, col, value in sources)
+    for fid, row, col, value in sources:
+        if fid in affected:
+            results.store(keys[fid], fresh[fid], shape)
+            window = msf_update.union_window(window, fresh[fid].window)
+        else:
+            kept = results.load(keys[fid])
+            assert np.array_equal(kept.cells, fresh[fid].cells)
+            assert np.array_equal(kept.values, fresh[fid].values)
+    assert window is not None
+    msf_update.patch_combined(paths, ((fid, results.load(keys[fid])) for fid, _, _, _ in sources), shape, window)
+
+    pq_max, src_id, count, _ = msf_footprints.reduce_footprints(sorted(fresh.items()), shape)
+    assert np.array_equal(_read(paths[0]), np.where(np.isnan(pq_max), msf_io.NODATA, pq_max))
+    assert np.array_equal(_read(paths[1]), np.where(np.isnan(src_id), NODATA_ID, src_id))
+    assert np.array_equal(_read(paths[2]), count)
+
+
+def test_update_raster_patches_the_overviews(tmp_path):
+    rng = np.random.RandomState(7)
+    shape = (700, 530)
+    arr = rng.random_sample(shape).astype(np.float32)
+    arr[arr < 0.3] = np.nan
+    profile = make_profile(shape)
+    msf_io.write_raster(str(tmp_path / "patched.tif"), arr, profile, overviews=True)
+    for row_off, col_off, nrows, ncols in ((0, 0, 5, 7), (301, 257, 150, 90), (690, 500, 10, 30)):
+        patch = rng.random_sample((nrows, ncols)).astype(np.float32)
+        arr[row_off:row_off + nrows, col_off:col_off + ncols] = patch
+        msf_io.update_raster(str(tmp_path / "patched.tif"), patch, (row_off, col_off, nrows, ncols))
+    msf_io.write_raster(str(tmp_path / "full.tif"), arr, profile, overviews=True)
+    with rasterio.open(str(tmp_path / "full.tif")) as src:
+        levels = len(src.overviews(1))
+    assert levels > 0
+    for name in ("patched.tif", "full.tif"):
+        with rasterio.open(str(tmp_path / name)) as src:
+            assert np.array_equal(src.read(1), np.where(np.isnan(arr), msf_io.NODATA, arr))
+    for level in range(levels):
+        with rasterio.open(str(tmp_path / "patched.tif"), overview_level=level) as a:
+            with rasterio.open(str(tmp_path / "full.tif"), overview_level=level) as b:
+                assert np.array_equal(a.read(1), b.read(1))
+
+
+def test_update_raster_leaves_the_overviews_outside_the_window(tmp_path):
+    rng = np.random.RandomState(8)
+    shape = (600, 450)
+    path = str(tmp_path / "patched.tif")
+    msf_io.write_raster(path, rng.random_sample(shape).astype(np.float32), make_profile(shape), overviews=True)
+    # a marker in the first overview level shows the cells written again
+    with rasterio.open(path, "r+", overview_level=0) as dst:
+        ovr_shape = (dst.height, dst.width)
+        dst.write(np.full(ovr_shape, 7.0, dtype=np.float32), 1)
+    row_off, col_off, nrows, ncols = 250, 100, 40, 30
+    patch = rng.random_sample((nrows, ncols)).astype(np.float32)
+    msf_io.update_raster(path, patch, (row_off, col_off, nrows, ncols))
+    rows = msf_io._nearest(shape[0], ovr_shape[0])
+    cols = msf_io._nearest(shape[1], ovr_shape[1])
+    in_rows = (rows >= row_off) & (rows < row_off + nrows)
+    in_cols = (cols >= col_off) & (cols < col_off + ncols)
+    with rasterio.open(path, overview_level=0) as src:
+        ovr = src.read(1)
+    assert in_rows.any() and in_cols.any()
+    assert np.array_equal(ovr[np.ix_(in_rows, in_cols)], patch[np.ix_(rows[in_rows] - row_off, cols[in_cols] - col_off)])
+    ovr[np.ix_(in_rows, in_cols)] = 7.0
+    assert (ovr == 7.0).all()